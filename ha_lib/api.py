@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module with a small HTTP server to read the usage from other devices
+
+Every response is JSON:
+    /totals                 total received and send bytes of this month and today of each interface.
+    /stats                  running rate statistics of each interface and of all interfaces together.
+    /history?start=&end=&points=&interface=
+                            totals in a time range, reduced to at most points rows of each interface.
+    /rates?start=&end=&interface=
+                            peak, mean and 95th percentile rates stored by the sampler.
+The metrics for Prometheus are served as text on /metrics.
+
+Queries run in the database thread and large responses are streamed in chunks.
+Responses of time ranges that are over are kept in a cache, so dashboards that poll often don't query again.
+"""
+
+import json
+import math
+import time
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+from . import logger, processor, database, stats, metrics
+
+# Encoded responses of closed time ranges, the least recently used are removed when the cache is too large
+cache = OrderedDict()
+cache_size = 0
+
+# Limits the amount of queries that wait for the database at the same time
+queries = None
+
+# Rows that are encoded into a single chunk
+CHUNK_ROWS = 500
+
+COLUMNS = {
+    'history': ['timestamp', 'interface', 'received', 'send'],
+    'rates': ['timestamp', 'interface', 'received_peak', 'received_mean', 'received_p95',
+              'send_peak', 'send_mean', 'send_p95'],
+}
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class BadRequest(Exception):
+    """The request can't be answered, the message is send to the client"""
+
+
+async def loop():
+    # Serve the API until the program stops
+    global queries
+    settings = processor.settings.api
+    if not settings.enabled:
+        return
+    queries = asyncio.Semaphore(settings.max_queries)
+    try:
+        server = await asyncio.start_server(handle, settings.host, settings.port)
+    except OSError as e:
+        logger.err(f'Can\'t start the API on {settings.host}:{settings.port}: {e}')
+        return
+    logger.debug(f'API listening on {settings.host}:{settings.port}')
+    async with server:
+        await server.serve_forever()
+
+
+async def handle(reader, writer):
+    # Answer a single request and close the connection
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        method, target, _ = request.decode('latin-1').split(' ', 2)
+        if method != 'GET':
+            await respond(writer, 405, {'error': 'Only GET is supported'})
+            return
+
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/')
+        if path == '/totals':
+            await respond(writer, 200, totals())
+        elif path == '/stats':
+            await respond(writer, 200, rate_stats())
+        elif path == '/metrics':
+            await respond_text(writer, metrics.render())
+        elif path in ('/history', '/rates'):
+            await stream(writer, path[1:], params)
+        else:
+            await respond(writer, 404, {'error': f'Unknown path {url.path}'})
+
+    except BadRequest as e:
+        await respond(writer, 400, {'error': str(e)})
+    except ValueError:
+        await respond(writer, 400, {'error': 'Invalid request'})
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def respond(writer, status, content):
+    # Send a small JSON response at once
+    body = json.dumps(content).encode()
+    writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+
+async def respond_text(writer, text):
+    # Send metrics in the Prometheus text format
+    body = text.encode()
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                 b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+    await writer.drain()
+
+
+async def stream(writer, kind, params):
+    # Send the rows of a time range in chunks, from the cache when the range is over
+    now = int(time.time())
+    end = int(params.get('end', now))
+    start = int(params.get('start', end - 86400))
+    points = min(int(params.get('points', processor.settings.api.max_points)), processor.settings.api.max_points)
+    name = params.get('interface')
+    if start >= end or points < 1:
+        raise BadRequest('start must be before end and points must be at least 1')
+
+    # A range is over when no new measurement can end up in it anymore
+    key = (kind, start, end, points, name)
+    closed = end < now - processor.settings.network.measure_delay - processor.settings.database.flush_interval
+    chunks = cache.get(key)
+    if chunks is not None:
+        cache.move_to_end(key)
+    elif not database.enabled:
+        chunks = await encode(kind, [])
+    else:
+        async with queries:
+            if kind == 'history':
+                rows = await database.run(read_history, start, end, points, name)
+            else:
+                rows = await database.run(database.read_rates, start, end, name)
+        chunks = await encode(kind, rows)
+        if closed:
+            store(key, chunks)
+
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                 b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+    for chunk in chunks:
+        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        await writer.drain()
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+async def encode(kind, rows):
+    """Encode rows into JSON chunks and give the other tasks room between the chunks
+
+    Returns:
+        List of chunks that together form a single JSON object with the columns and rows.
+    """
+    chunks = [f'{{"columns": {json.dumps(COLUMNS[kind])}, "rows": ['.encode()]
+    for i in range(0, len(rows), CHUNK_ROWS):
+        text = json.dumps(rows[i:i + CHUNK_ROWS])[1:-1]
+        chunks.append(((', ' if i else '') + text).encode())
+        await asyncio.sleep(0)
+    chunks.append(b']}')
+    return chunks
+
+
+def store(key, chunks):
+    # Add a response to the cache and remove the least recently used ones when it is too large
+    global cache_size
+    size = sum(len(chunk) for chunk in chunks)
+    limit = processor.settings.api.cache_bytes
+    if size > limit:
+        return
+    cache[key] = chunks
+    cache_size += size
+    while cache_size > limit:
+        _, old = cache.popitem(last=False)
+        cache_size -= sum(len(chunk) for chunk in old)
+
+
+def read_history(start, end, points, name):
+    """Read the totals in a time range and keep the last row of each interface in every bucket.
+
+    This runs in the database thread.
+    The coarsest tier that is fine enough for the amount of points is used, so long ranges read few rows.
+
+    Args:
+        start: timestamp where the range starts.
+        end: timestamp where the range ends, this one isn't included.
+        points: most amount of rows of each interface.
+        name: name of the interface, None for all interfaces.
+    Returns:
+        List with the timestamp, interface, received and send bytes of each row.
+    """
+    size = max(1, math.ceil((end - start) / points))
+    last = {}
+    for row in database.read_range(start, end, size, name):
+        last[(row[0] - start) // size, row[1]] = row
+    return sorted(last.values())
+
+
+def totals():
+    # The totals of this month and today from the cache of the database
+    start_values = database.get_start_values()
+    result = {}
+    for name, (received, send) in processor.totals.items():
+        start_rx, start_tx = start_values.get(name, (received, send))
+        result[name] = {'received': received, 'send': send,
+                        'today_received': received - start_rx, 'today_send': send - start_tx}
+    return result
+
+
+def rate_stats():
+    # The running statistics of each interface, all is the sum of all interfaces
+    result = {}
+    for name, (rx_stats, tx_stats) in stats.stats.items():
+        result['all' if name is None else name] = {'received': describe(rx_stats), 'send': describe(tx_stats)}
+    return result
+
+
+def describe(rate):
+    # Turn the statistics of a single rate into JSON
+    return {
+        'rate': rate.rate,
+        'averages': {f'{horizon:g}': average for horizon, average in zip(rate.horizons, rate.averages)},
+        'minimum': rate.minimum,
+        'maximum': rate.maximum,
+        'mean': rate.mean,
+        'percentiles': {f'p{q * 100:g}': value for q, value in rate.percentiles.items()},
+    }
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark and soak test of the measurement, database, rollover and publish paths
+
+Months of measurements are run in seconds on a simulated clock.
+A synthetic counter source takes the place of the kernel counters and the MQTT values go to the broker of broker.py.
+Nothing sleeps, every measurement runs right after the previous one and only the work itself is timed.
+
+Run this module to print a report, for example 90 days with a measurement every minute:
+    python -m ha_lib.bench --days 90 --delay 60
+Add --engine segments to store the raw measurements in the segment log instead of sqlite.
+Save the results with --save and compare a later run with --baseline to catch regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from array import array
+from . import processor, database, interface, mqtt, stats, metrics, forecast, logger, broker, settings as settings_module
+
+# Results where higher is worse, a regression is reported when they grew more than the tolerance
+LOWER_IS_BETTER = ['tick_p50', 'tick_p99', 'maintain_p99', 'rollover_max', 'flush_per_row', 'bytes_per_row',
+                   'written_per_row']
+
+
+class Clock:
+    """Simulated clock that only moves when it is told to.
+
+    Args:
+        start: unix timestamp the clock starts at.
+    """
+
+    def __init__(self, start):
+        self.wall = start
+        self.mono = 0.0
+
+    def time(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    def advance(self, seconds):
+        self.wall += seconds
+        self.mono += seconds
+
+
+class FakeCounters:
+    """Synthetic counter source with the same interface as interface.CounterReader.
+
+    Every interface has its own average rate, each reading adds a random amount around it
+    for the time that passed on the clock. The counters wrap around like on 32 bit kernels when wrap is set.
+
+    Args:
+        interfaces: names of the interfaces.
+        clock: the clock that decides how much time passed.
+        rate: average bytes per second of each interface.
+        wrap: value the counters wrap around at, None for 64 bit counters.
+        seed: seed of the random numbers so runs can be compared.
+    """
+
+    def __init__(self, interfaces, clock, rate=250000, wrap=interface.COUNTER_WRAP, seed=1):
+        self.interfaces = list(interfaces)
+        self.clock = clock
+        self.wrap = wrap
+        self.random = random.Random(seed)
+        self.rates = {name: rate * (i + 1) for i, name in enumerate(self.interfaces)}
+        self.last = {name: (0, 0) for name in self.interfaces}
+        self.last_time = clock.monotonic()
+        self.source = 'fake'
+
+    def read(self, strict=False):
+        elapsed = self.clock.monotonic() - self.last_time
+        self.last_time = self.clock.monotonic()
+        for name, (rx, tx) in self.last.items():
+            rate = self.rates[name]
+            rx += int(self.random.expovariate(1 / rate) * elapsed)
+            tx += int(self.random.expovariate(4 / rate) * elapsed)
+            if self.wrap:
+                rx, tx = rx % self.wrap, tx % self.wrap
+            self.last[name] = rx, tx
+        return dict(self.last)
+
+    def close(self):
+        pass
+
+
+def percentile(values, q):
+    """The value below which a fraction q of the sorted values are"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def rss():
+    """Resident memory of this process in bytes, 0 when it can't be read"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def file_size(path):
+    """Size of the database including its write ahead log and segment log"""
+    size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    if database.log is not None:
+        size += database.log.disk_size()
+    return size
+
+
+def written():
+    """Bytes this process has written to files, 0 when the kernel doesn't tell"""
+    try:
+        with open('/proc/self/io') as file:
+            return next(int(line.split()[1]) for line in file if line.startswith('wchar:'))
+    except (OSError, ValueError, StopIteration):
+        return 0
+
+
+def make_settings(config_file, directory, port, interfaces, delay, engine='sqlite'):
+    """Read the config file and overrule everything that would reach outside of the benchmark"""
+    config = settings_module.ConfigParser()
+    config.read(config_file)
+    config.read_dict({
+        'NETWORK': {'interface': ', '.join(interfaces), 'measuredelay': str(delay), 'sampleinterval': '0',
+                    'startonboot': 'False', 'disabletrigger': 'False'},
+        'DATABASE': {'enabled': 'True', 'file': os.path.join(directory, 'bench.sqlite'), 'engine': engine},
+        'EMAIL': {'enabled': 'False'},
+        'MQTT': {'enabled': 'True', 'backend': 'mqtt', 'host': '127.0.0.1', 'port': str(port), 'tls': 'False'},
+        'MQTTNUMPAD': {'enabled': 'False'},
+        'API': {'enabled': 'False'},
+        'LOGGING': {'enabled': 'False'},
+    })
+    return settings_module.parse(config)
+
+
+async def soak(days=30, delay=300, interfaces=2, start=None, config_file=processor.CONFIG_FILE, engine='sqlite'):
+    """Run days of measurements on a simulated clock and time every part.
+
+    Args:
+        days: simulated days to run.
+        delay: simulated seconds between two measurements.
+        interfaces: amount of fake interfaces.
+        start: unix timestamp the clock starts at, now when None.
+        config_file: config file the other settings are read from.
+        engine: where the raw measurements are stored, sqlite or segments.
+    Returns:
+        Dictionary with the results.
+    """
+    # The logger would print every measurement and turn this into a benchmark of the terminal
+    logger.enabled = False
+    clock = Clock(int(time.time()) if start is None else start)
+    names = [f'fake{i}' for i in range(interfaces)]
+
+    server = broker.Broker()
+    await server.start()
+    directory = tempfile.TemporaryDirectory()
+    processor.settings = settings = make_settings(config_file, directory.name, server.port, names, delay, engine)
+    database.enable()
+    stats.enable()
+    forecast.enable()
+    metrics.enable()
+    mqtt.enable()
+    while not mqtt.client.is_connected():
+        await asyncio.sleep(0.01)
+    interface.reader = FakeCounters(names, clock)
+
+    # The same start as measure_loop, but on the simulated clock
+    await database.rollover(clock.time())
+    processor.set_totals(database.get_last_values(names))
+    processor.last, processor.last_time = interface.reader.read(), clock.monotonic()
+
+    # The durations are kept in arrays so the benchmark itself barely adds to the memory it measures
+    ticks, maintains, rollovers, growth = array('d'), array('d'), [], []
+    next_maintain = clock.time() + settings.database.data_move_interval
+    busy = False
+    written_start = written()
+    started = time.perf_counter()
+    for tick in range(int(days * 86400 / delay)):
+        clock.advance(delay)
+        month_end = database.month_end
+
+        begin = time.perf_counter()
+        await processor.measure(interface.reader.read(), clock.monotonic(), clock.time())
+        duration = time.perf_counter() - begin
+        ticks.append(duration)
+        if database.month_end != month_end and month_end:
+            rollovers.append(duration)
+
+        # Compaction runs in the background in the program, it is timed on its own here
+        if busy or clock.time() >= next_maintain:
+            begin = time.perf_counter()
+            busy = await database.run(database.maintain, clock.time())
+            maintains.append(time.perf_counter() - begin)
+            next_maintain = clock.time() + settings.database.data_move_interval
+
+        # Give the broker room to receive the messages
+        await asyncio.sleep(0)
+        if tick % int(86400 / delay) == 0:
+            growth.append((tick * delay / 86400, rss(), file_size(settings.database.file)))
+
+    wall = time.perf_counter() - started
+    await database.run(database.flush)
+    growth.append((days, rss(), file_size(settings.database.file)))
+    written_bytes = written() - written_start
+
+    # Wait a moment for the last messages to arrive at the broker
+    for _ in range(100):
+        if server.received >= mqtt.client.published:
+            break
+        await asyncio.sleep(0.01)
+    results = summarize(ticks, maintains, rollovers, growth, wall, len(names), days)
+    results['engine'] = engine
+    results['written_per_row'] = written_bytes / (len(ticks) * len(names)) if ticks else 0
+    results['published'] = mqtt.client.published
+    results['received_by_broker'] = server.received
+
+    mqtt.close()
+    await server.close()
+    database.close()
+    directory.cleanup()
+    return results
+
+
+def summarize(ticks, maintains, rollovers, growth, wall, interfaces, days):
+    # Turn the timings into the results, durations are in milliseconds
+    rows = len(ticks) * interfaces
+    ticks, maintains = sorted(ticks), sorted(maintains)
+    return {
+        'days': days,
+        'measurements': len(ticks),
+        'simulated_days_per_second': days / wall,
+        'tick_p50': percentile(ticks, 0.5) * 1000,
+        'tick_p99': percentile(ticks, 0.99) * 1000,
+        'tick_max': (ticks[-1] if ticks else 0) * 1000,
+        'maintain_p99': percentile(maintains, 0.99) * 1000,
+        'rollover_max': max(rollovers, default=0) * 1000,
+        'rows_per_second': metrics.flush.count and rows / metrics.flush.sum,
+        'flush_per_row': metrics.flush.sum / rows * 1000 if rows else 0,
+        'bytes_per_row': growth[-1][2] / rows if rows else 0,
+        'growth': growth,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Find the results that are worse than the baseline.
+
+    Returns:
+        List with a description of every regression.
+    """
+    regressions = []
+    for key in LOWER_IS_BETTER:
+        old, new = baseline.get(key), results.get(key)
+        if old and new > old * (1 + tolerance):
+            regressions.append(f'{key} went from {old:.4g} to {new:.4g}')
+    return regressions
+
+
+def report(results):
+    print(f'{results["measurements"]} measurements in {results["days"]:g} simulated days, '
+          f'{results["simulated_days_per_second"]:.1f} days/s')
+    print(f'Measurement: p50 {results["tick_p50"]:.3f} ms, p99 {results["tick_p99"]:.3f} ms, '
+          f'max {results["tick_max"]:.3f} ms')
+    print(f'Month rollover: slowest measurement {results["rollover_max"]:.3f} ms')
+    print(f'Compaction step: p99 {results["maintain_p99"]:.3f} ms')
+    print(f'Database ({results["engine"]}): {results["rows_per_second"]:.0f} rows/s while flushing, '
+          f'{results["bytes_per_row"]:.1f} bytes/row on disk, {results["written_per_row"]:.1f} bytes/row written')
+    print(f'MQTT: {results["published"]} published, {results["received_by_broker"]} received by the broker')
+    print('Day      RSS (MB)  Database (MB)')
+    for day, memory, size in results['growth']:
+        print(f'{day:<8g} {memory / 1e6:<9.1f} {size / 1e6:.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=30, help='simulated days')
+    parser.add_argument('--delay', type=float, default=300, help='simulated seconds between measurements')
+    parser.add_argument('--interfaces', type=int, default=2, help='amount of fake interfaces')
+    parser.add_argument('--config', default=processor.CONFIG_FILE, help='config file with the other settings')
+    parser.add_argument('--engine', choices=['sqlite', 'segments'], default='sqlite', help='storage of the raw rows')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    args = parser.parse_args()
+
+    results = asyncio.run(soak(args.days, args.delay, args.interfaces, config_file=args.config, engine=args.engine))
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        sys.exit(1 if regressions else 0)
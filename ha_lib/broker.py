@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A small MQTT 3.1.1 broker to test and benchmark the transports without a real server
+
+It only supports what the transports use: connecting, publishing with QoS 0, 1 and 2,
+subscribing on exact topics or topics ending with # and keepalives.
+Run this module to measure the publish throughput of the MQTT transport against it.
+"""
+
+import sys
+import time
+import struct
+import asyncio
+from . import transport, logger
+
+
+class Broker:
+    """MQTT broker that runs on the asyncio loop.
+
+    Attributes:
+        port: the port the broker listens on.
+        received: amount of publishes received from all clients.
+        messages: last payload received on each topic.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.received = 0
+        self.messages = {}
+        self.subscribers = []
+        self.clients = {}
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening, port 0 picks a free port"""
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        await asyncio.gather(*self.clients.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 127) * multiplier
+                    multiplier *= 128
+                    if byte < 128:
+                        break
+                body = await reader.readexactly(length)
+                kind, flags = header[0] >> 4, header[0] & 15
+
+                if kind == 1:  # CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    self.publish(writer, flags, body)
+                elif kind == 6:  # PUBREL
+                    writer.write(b'\x70\x02' + body[:2])
+                elif kind == 8:  # SUBSCRIBE
+                    self.subscribe(writer, body)
+                elif kind == 12:  # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.subscribers = [(topic, w) for topic, w in self.subscribers if w is not writer]
+        self.clients.pop(writer, None)
+        writer.close()
+
+    def publish(self, writer, flags, body):
+        qos = (flags >> 1) & 3
+        size = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + size].decode()
+        offset = 2 + size
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            writer.write((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+        payload = body[offset:]
+        self.received += 1
+        self.messages[topic] = payload
+
+        # Forward the message to the subscribers with QoS 0
+        for pattern, subscriber in self.subscribers:
+            if pattern == topic or (pattern.endswith('#') and topic.startswith(pattern[:-1])):
+                subscriber.write(encode(0x30, struct.pack('!H', size) + topic.encode() + payload))
+
+    def subscribe(self, writer, body):
+        packet_id, offset, granted = body[:2], 2, b''
+        while offset < len(body):
+            size = struct.unpack('!H', body[offset:offset + 2])[0]
+            self.subscribers.append((body[offset + 2:offset + 2 + size].decode(), writer))
+            offset += 3 + size
+            granted += b'\x00'
+        writer.write(encode(0x90, packet_id + granted))
+
+
+def encode(header, body):
+    """Put the fixed header in front of a packet"""
+    length, encoded = len(body), b''
+    while True:
+        byte, length = length % 128, length // 128
+        encoded += bytes([byte | (128 if length else 0)])
+        if not length:
+            return bytes([header]) + encoded + body
+
+
+async def measure(feeds=1000, rounds=10, qos=0):
+    """Publish rounds values on every feed through the MQTT transport and measure how fast that goes.
+
+    Returns:
+        Messages per second until the broker received all of them.
+        Seconds the publish calls took at most, which is what the measurement loop would notice.
+    """
+    broker = Broker()
+    await broker.start()
+    client = transport.MQTTTransport('127.0.0.1', broker.port, qos=qos, max_inflight=100)
+    client.connect()
+    while not client.is_connected():
+        await asyncio.sleep(0.01)
+
+    total = feeds * rounds
+    slowest = 0
+    start = time.monotonic()
+    for i in range(rounds):
+        tick = time.monotonic()
+        for feed in range(feeds):
+            client.publish(f'feed{feed}', i)
+        slowest = max(slowest, time.monotonic() - tick)
+        await asyncio.sleep(0)
+    while broker.received < total:
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - start
+
+    client.close()
+    await broker.close()
+    return total / elapsed, slowest
+
+
+if __name__ == '__main__':
+    # Keep the reconnect warnings of the transport out of the results
+    logger.enabled = False
+    feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rate, slowest = asyncio.run(measure(feeds))
+    print(f'{rate:.0f} messages/s, slowest round of {feeds} publishes took {slowest * 1000:.1f} ms')
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that keeps a small file with everything the measurements need to continue after a restart
+
+The file holds the counters of the kernel at the last measurement, the totals that belong to them,
+today's starting values, the end of the day and month and the boot id of the kernel.
+It is written every Interval seconds and when the program stops, in a thread so the measurements don't wait on the disk.
+A new file is written next to the old one and renamed over it, so after a crash it is always a whole file.
+
+At the start the boot id tells a restart of the program apart from a reboot.
+After a restart the counters of the kernel kept counting, so the bytes since the checkpoint are exactly
+the difference with the counters in the file and nothing is counted twice.
+After a reboot the counters started at zero, StartOnBoot decides whether they are added like before.
+Either way the cache of the database is filled from the file, so the tables don't have to be searched for the totals.
+
+A checkpoint that is older than the newest stored measurement, because writing it failed or it was disabled for a while,
+is forgotten and the totals are read from the tables like without a checkpoint.
+After a restart the whole counter still isn't added then, only the bytes since the last stored measurement are lost.
+"""
+
+import os
+import json
+import time
+import asyncio
+from . import logger, processor, database
+
+# Version of the file, a file of another version is ignored
+VERSION = 1
+
+# Everything a checkpoint has to have
+KEYS = {'boot_id', 'time', 'counters', 'totals', 'start_values', 'day_end', 'month_end'}
+
+# Where the kernel keeps the id that changes on every boot
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+# The checkpoint that was read at the start, None when there is none or it doesn't fit the interfaces
+state = None
+
+# Boot id of the running kernel, None when it can't be read
+boot_id = None
+
+# The checkpoint was written since the last boot, this stays set when the checkpoint is forgotten
+restarted = False
+
+# Monotonic time of the last checkpoint and the write that is still running
+last_save = 0
+writing = None
+
+
+def read_boot_id(path=BOOT_ID):
+    """Receive the id of this boot, None on systems that don't have one"""
+    try:
+        with open(path) as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def load(path):
+    """Read a checkpoint file
+
+    Returns:
+        Dictionary with the checkpoint or None when the file is missing, damaged or of another version.
+    """
+    try:
+        with open(path) as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != VERSION or not KEYS <= data.keys():
+        return None
+    return data
+
+
+def save(path, data):
+    """Write a checkpoint file atomically, this runs in a thread because fsync can take a while"""
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+    # The rename itself is only on the disk once the directory is
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def snapshot():
+    """Copy the state of the last measurement, this has to happen right after it so the counters match the totals"""
+    return {
+        'version': VERSION,
+        'boot_id': boot_id,
+        'time': time.time(),
+        'counters': dict(processor.last),
+        'totals': dict(processor.totals),
+        'start_values': dict(database.start_values),
+        'day_end': database.day_end,
+        'month_end': database.month_end,
+    }
+
+
+def enable():
+    # Read the checkpoint and fill the cache of the database with it, this runs before the database is opened
+    global state, boot_id, restarted
+    settings = processor.settings.checkpoint
+    if not settings.enabled:
+        return
+    boot_id = read_boot_id(BOOT_ID)
+    data = load(settings.file)
+    if data is None:
+        logger.debug('No checkpoint found')
+        return
+
+    # The counters only mean something for the same interfaces
+    names = processor.settings.network.names
+    if sorted(data['counters']) != sorted(names) or sorted(data['totals']) != sorted(names):
+        logger.debug('The checkpoint is of other interfaces, it is ignored')
+        return
+
+    restarted = boot_id is not None and data['boot_id'] == boot_id
+    database.totals.clear()
+    database.totals.update({name: tuple(values) for name, values in data['totals'].items()})
+    database.start_values.clear()
+    database.start_values.update({name: tuple(values) for name, values in data['start_values'].items()})
+    database.day_end, database.month_end = data['day_end'], data['month_end']
+    state = data
+    logger.debug(f'Checkpoint of {time.time() - data["time"]:.0f} seconds ago loaded')
+
+
+def fresh(newest):
+    """Check that the checkpoint isn't older than the stored measurements and forget it when it is.
+
+    After a restart the checkpoint may be up to Interval seconds older than the database,
+    the bytes since the checkpoint are added exactly so the totals still end up past the stored ones.
+
+    Args:
+        newest: timestamp of the newest stored measurement.
+    Returns:
+        Whether the cache that was filled from the checkpoint can be used.
+    """
+    global state
+    allowed = processor.settings.checkpoint.interval if restarted else 0
+    if newest <= state['time'] + allowed:
+        return True
+    logger.warn(f'The checkpoint is {newest - state["time"]:.0f} seconds older than the database, it is ignored')
+    state = None
+    return False
+
+
+def resume(current):
+    """Receive the counters of the checkpoint to continue from and how long ago they were read
+
+    A counter that went down while the program was gone longer than MeasureDelay isn't taken as a wrap,
+    the interface has been made again and its counter started from zero.
+
+    Args:
+        current: the received and send counter of each interface that were just read.
+    Returns:
+        Dictionary with the received and send bytes of each interface and the seconds since they were read,
+        None when the counters of the kernel started over since the checkpoint or there is no checkpoint.
+    """
+    if state is None or not restarted:
+        return None
+    ago = max(0.0, time.time() - state['time'])
+    counters = {}
+    for name, (rx, tx) in state['counters'].items():
+        new_rx, new_tx = current.get(name, (rx, tx))
+        if ago > processor.settings.network.measure_delay:
+            rx, tx = (0 if new_rx < rx else rx), (0 if new_tx < tx else tx)
+        counters[name] = rx, tx
+    return counters, ago
+
+
+def update(now):
+    """Write a checkpoint in the background when the last one is Interval seconds old
+
+    Args:
+        now: monotonic time of the measurement that just happened.
+    """
+    global last_save, writing
+    settings = processor.settings.checkpoint
+    if not settings.enabled or now - last_save < settings.interval:
+        return
+    if writing is not None and not writing.done():
+        return
+    last_save = now
+    writing = asyncio.get_running_loop().run_in_executor(None, write, settings.file, snapshot())
+
+
+def write(path, data):
+    # A checkpoint that can't be written is skipped, the next one tries again
+    try:
+        save(path, data)
+    except OSError as e:
+        logger.warn(f'Can\'t write the checkpoint {path}: {e}')
+
+
+async def close():
+    # Write the last checkpoint, so the next start continues from the last measurement
+    if not processor.settings.checkpoint.enabled or not processor.last:
+        return
+    if writing is not None:
+        await writing
+    write(processor.settings.checkpoint.file, snapshot())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that counts the bytes of each LAN host from the connection tracking table of the kernel
+
+The table is read line by line every Interval seconds, it is never loaded at once.
+Each connection holds the bytes send by the host that started it and the bytes it received in reply.
+Only the growth of a connection since the previous read is counted, so the last count of each open connection is kept.
+That state is a hash and two numbers per connection of a counted host, it only holds the connections of the last read.
+A connection the kernel dropped is gone at the next read, so the state is at most as large as the table of the kernel
+(net.netfilter.nf_conntrack_max), Capacity only limits the hosts that are counted.
+
+The hosts are counted with the space-saving algorithm in a fixed amount of counters.
+When a new host shows up and all counters are taken it replaces the smallest host and starts at its count,
+so a host that used a lot is never missed and its count is at most the error too high.
+The counts start over at the start of every month, like the totals.
+
+The table of the kernel only has bytes when accounting is enabled:
+    sysctl net.netfilter.nf_conntrack_acct=1
+"""
+
+import time
+import asyncio
+import ipaddress
+from . import logger, processor, database
+
+# The counted hosts of this month, None when conntrack is disabled
+counter = None
+
+# Bytes send and received by each connection of the previous read, the key is the hash of the connection
+# This is replaced on every read, so it is bounded by the table of the kernel and not by Capacity
+flows = {}
+
+# Amount of reads since the start, the MQTT module publishes when this changes
+scans = 0
+
+# End of the month the hosts are counted for
+month_end = 0
+
+
+class SpaceSaving:
+    """Approximate the hosts that used the most in a fixed amount of counters.
+
+    Args:
+        capacity: amount of hosts that are counted at once.
+
+    Attributes:
+        counters: dictionary with the bytes, received bytes, send bytes and error of each counted host.
+            The bytes include the error, the received and send bytes don't.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def offer(self, address, received, send):
+        """Add bytes of a host and replace the smallest host when it isn't counted yet and there is no room"""
+        counter = self.counters.get(address)
+        if counter is None:
+            error = 0
+            if len(self.counters) >= self.capacity:
+                smallest = min(self.counters, key=lambda key: self.counters[key][0])
+                error = self.counters.pop(smallest)[0]
+            counter = self.counters[address] = [error, 0, 0, error]
+        counter[0] += received + send
+        counter[1] += received
+        counter[2] += send
+
+    def top(self, amount):
+        """Receive the hosts that used the most
+
+        Returns:
+            List with the address, received bytes, send bytes and error of each host, the largest first.
+        """
+        largest = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:amount]
+        return [(address, received, send, error) for address, (_, received, send, error) in largest]
+
+    def clear(self):
+        self.counters.clear()
+
+
+def parse(lines):
+    """Read the connections from the lines of a conntrack table.
+
+    The first src, dst, sport and dport of a line are the direction of the host that started the connection,
+    the first bytes are what it send and the second bytes what it received.
+    Connections without bytes are skipped, a line the kernel wrote in another format can't stop the reads.
+
+    Args:
+        lines: lines of /proc/net/nf_conntrack or a file in the same format.
+    Yields:
+        The hash of the connection, the address that started it, the bytes it send and the bytes it received.
+    """
+    for line in lines:
+        fields = line.split()
+        source = destination = source_port = destination_port = None
+        counts = []
+        for field in fields:
+            if field.startswith('bytes=') and field[6:].isdecimal():
+                counts.append(int(field[6:]))
+            elif source is None and field.startswith('src='):
+                source = field[4:]
+            elif destination is None and field.startswith('dst='):
+                destination = field[4:]
+            elif source_port is None and field.startswith('sport='):
+                source_port = field[6:]
+            elif destination_port is None and field.startswith('dport='):
+                destination_port = field[6:]
+        if source is None or len(counts) < 2:
+            continue
+        key = hash((fields[2], source, destination, source_port, destination_port))
+        yield key, source, counts[0], counts[1]
+
+
+def read(lines, previous, networks=()):
+    """Count the bytes of each host since the previous read.
+
+    A connection that is new or has less bytes than before, because the kernel reused it, counts from 0.
+    Only the connections in this read are returned, the ones the kernel dropped since the previous read are forgotten.
+
+    Args:
+        lines: lines of a conntrack table.
+        previous: the counts of each connection of the previous read.
+        networks: only count hosts in these networks, all hosts when empty.
+    Returns:
+        Dictionary with the received and send bytes of each host
+        and a dictionary with the counts of each connection for the next read.
+    """
+    hosts, current, counted = {}, {}, {}
+    for key, address, send, received in parse(lines):
+        # Every address is only checked once, the connections of other hosts aren't kept at all
+        allowed = counted.get(address)
+        if allowed is None:
+            allowed = counted[address] = allow(address, networks)
+        if not allowed:
+            continue
+
+        current[key] = send, received
+        old_send, old_received = previous.get(key, (0, 0))
+        if send < old_send or received < old_received:
+            old_send, old_received = 0, 0
+        host_received, host_send = hosts.get(address, (0, 0))
+        hosts[address] = host_received + received - old_received, host_send + send - old_send
+    return hosts, current
+
+
+def allow(address, networks):
+    """Check if a host is counted, a line with an address that isn't valid is skipped"""
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return not networks or any(address in network for network in networks)
+
+
+def scan(path, previous, networks=()):
+    """Read the conntrack table at path, this runs in a thread because the table can be large"""
+    with open(path) as file:
+        return read(file, previous, networks)
+
+
+def enable():
+    global counter
+    settings = processor.settings.conntrack
+    if not settings.enabled:
+        return
+    counter = SpaceSaving(settings.capacity)
+
+    # Continue the counts of this month where the last run stopped
+    if database.enabled:
+        now = int(time.time())
+        for address, received, send, error in database.worker.submit(
+                database.read_talkers, database.floor_month(now)).result():
+            counter.counters[address] = [received + send + error, received, send, error]
+    logger.debug('Conntrack enabled')
+
+
+def update(hosts, timestamp):
+    """Add the bytes of each host, the counts are cleared at the start of a month
+
+    Args:
+        hosts: dictionary with the received and send bytes of each host.
+        timestamp: timestamp of the read.
+    """
+    global month_end, scans
+    if timestamp >= month_end:
+        if month_end:
+            counter.clear()
+        month_end = database.next_month(timestamp)
+    for address, (received, send) in hosts.items():
+        if received or send:
+            counter.offer(address, received, send)
+    scans += 1
+
+
+def top():
+    """Receive the hosts that used the most this month, an empty list when conntrack is disabled"""
+    if counter is None:
+        return []
+    return counter.top(processor.settings.conntrack.top)
+
+
+async def loop():
+    # Read the conntrack table at the interval and store the hosts that used the most
+    global flows
+    if counter is None:
+        return
+    async_loop = asyncio.get_running_loop()
+    first = True
+    while True:
+        settings = processor.settings.conntrack
+        try:
+            hosts, flows = await async_loop.run_in_executor(None, scan, settings.file, flows, settings.networks)
+        except (OSError, ValueError) as e:
+            # A table that isn't text is skipped as well, the next read tries again
+            logger.warn(f'Can\'t read {settings.file}: {e}')
+            hosts = {}
+
+        # The first read only learns the connections, their bytes from before the start are unknown
+        if not first:
+            timestamp = int(time.time())
+            update(hosts, timestamp)
+            await database.add_talkers(top(), timestamp)
+        first = False
+        await asyncio.sleep(settings.interval)
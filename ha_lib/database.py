@@ -1,13 +1,219 @@
 """Module to access the database """
 
 import time
+import queue
 import sqlite3
 import os.path
 import asyncio
+import threading
+from concurrent.futures import Future
 from datetime import datetime
-from . import logger, processor
+from . import logger, processor, metrics, segments, checkpoint
 
+# The connection is only used from the worker thread, the rest of the program talks to it through the worker
 DB = None
+worker = None
+enabled = False
+
+# The segment log that holds the raw measurements instead of RECORDS, None when the engine is sqlite
+log = None
+
+# Write-through cache of the database so measurements never have to query it
+# The cache is only changed from the event loop, except when it is loaded while enabling the module
+# totals holds the last total of each interface and start_values the total at the start of today
+# day_end and month_end are the timestamps where the current day and month end, 0 when unknown
+totals = {}
+start_values = {}
+day_end, month_end = 0, 0
+
+# Rows that are waiting to be written to the database and the monotonic time of the oldest one
+# These are only used from the worker thread
+buffer = []
+rate_buffer = []
+talker_buffer = []
+buffer_since = None
+flush_rows, flush_interval = 1, 0
+
+# Version of the database layout, stored in the user_version pragma
+SCHEMA_VERSION = 4
+
+TABLES = {
+    'RECORDS': 'CREATE TABLE RECORDS (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, SPECIAL INTEGER NOT NULL, \
+        PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'MINUTELOGS': 'CREATE TABLE MINUTELOGS (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'HOURLOGS': 'CREATE TABLE HOURLOGS (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'DAYLOGS': 'CREATE TABLE DAYLOGS (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'MONTHLOGS': 'CREATE TABLE MONTHLOGS (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'RATES': 'CREATE TABLE RATES (TIMESTAMP INTEGER NOT NULL, INTERFACE TEXT NOT NULL, \
+        RECEIVED_PEAK REAL NOT NULL, RECEIVED_MEAN REAL NOT NULL, RECEIVED_P95 REAL NOT NULL, \
+        SEND_PEAK REAL NOT NULL, SEND_MEAN REAL NOT NULL, SEND_P95 REAL NOT NULL, \
+        PRIMARY KEY (TIMESTAMP, INTERFACE));',
+    'TALKERS': 'CREATE TABLE TALKERS (TIMESTAMP INTEGER NOT NULL, ADDRESS TEXT NOT NULL, \
+        RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL, ERROR INTEGER NOT NULL, \
+        PRIMARY KEY (TIMESTAMP, ADDRESS));',
+}
+
+# Statements are kept as constants so sqlite can reuse the compiled versions from its statement cache
+INSERT_RECORD = 'INSERT OR REPLACE INTO RECORDS (TIMESTAMP, INTERFACE, RECEIVED, SEND, SPECIAL) \
+    VALUES(?, ?, ?, ?, ?);'
+INSERT_RATE = 'INSERT OR REPLACE INTO RATES (TIMESTAMP, INTERFACE, RECEIVED_PEAK, RECEIVED_MEAN, \
+    RECEIVED_P95, SEND_PEAK, SEND_MEAN, SEND_P95) VALUES(?, ?, ?, ?, ?, ?, ?, ?);'
+INSERT_TALKER = 'INSERT OR REPLACE INTO TALKERS (TIMESTAMP, ADDRESS, RECEIVED, SEND, ERROR) \
+    VALUES(?, ?, ?, ?, ?);'
+INSERT_TIER = 'INSERT OR REPLACE INTO {} (TIMESTAMP, INTERFACE, RECEIVED, SEND) VALUES(?, ?, ?, ?);'
+INSERT_MONTHLOG = 'INSERT OR REPLACE INTO MONTHLOGS (TIMESTAMP, INTERFACE, RECEIVED, SEND) \
+    VALUES(?, ?, ?, ?);'
+SELECT_LAST = 'SELECT INTERFACE, RECEIVED, SEND, MAX(TIMESTAMP) FROM {} GROUP BY INTERFACE;'
+SELECT_FIRST_TODAY = 'SELECT INTERFACE, RECEIVED, SEND, MIN(TIMESTAMP) FROM RECORDS \
+    WHERE TIMESTAMP >= ? GROUP BY INTERFACE;'
+SELECT_RANGE = 'SELECT TIMESTAMP, INTERFACE, RECEIVED, SEND FROM {} WHERE TIMESTAMP >= ? \
+    AND TIMESTAMP < ? ORDER BY TIMESTAMP;'
+SELECT_RATES = 'SELECT TIMESTAMP, INTERFACE, RECEIVED_PEAK, RECEIVED_MEAN, RECEIVED_P95, SEND_PEAK, \
+    SEND_MEAN, SEND_P95 FROM RATES WHERE TIMESTAMP >= ? AND TIMESTAMP < ? ORDER BY TIMESTAMP;'
+SELECT_TALKERS = 'SELECT ADDRESS, RECEIVED, SEND, ERROR FROM TALKERS \
+    WHERE TIMESTAMP = (SELECT MAX(TIMESTAMP) FROM TALKERS WHERE TIMESTAMP >= ?);'
+SELECT_NEXT = 'SELECT MIN(TIMESTAMP) FROM {} WHERE TIMESTAMP >= ?;'
+ROLLUP = 'INSERT OR REPLACE INTO {} (TIMESTAMP, INTERFACE, RECEIVED, SEND) SELECT BUCKET, \
+    INTERFACE, RECEIVED, SEND FROM (SELECT {} AS BUCKET, INTERFACE, RECEIVED, SEND, \
+    MAX(TIMESTAMP) FROM {} WHERE TIMESTAMP >= ? AND TIMESTAMP < ? GROUP BY BUCKET, INTERFACE);'
+EXPIRE = 'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE TIMESTAMP < ? LIMIT ?);'
+
+
+def floor_minute(timestamp):
+    """Start of the minute the timestamp is in"""
+    return timestamp - timestamp % 60
+
+
+def floor_hour(timestamp):
+    """Start of the hour the timestamp is in"""
+    return timestamp - timestamp % 3600
+
+
+def floor_day(timestamp):
+    """Start of the local day the timestamp is in"""
+    date = datetime.fromtimestamp(timestamp)
+    return int(datetime(date.year, date.month, date.day).timestamp())
+
+
+def floor_month(timestamp):
+    """Start of the local month the timestamp is in"""
+    date = datetime.fromtimestamp(timestamp)
+    return int(datetime(date.year, date.month, 1).timestamp())
+
+
+class Tier:
+    """A table that stores the totals of each interface at a lower resolution.
+
+    Each row holds the last totals of a bucket and the timestamp of the start of that bucket.
+    Buckets are filled from the finer source table once they are closed.
+
+    Args:
+        table: name of the table.
+        source: name of the table with a finer resolution this tier is made of.
+        size: length of a bucket in seconds, for days this is the usual length.
+        floor: function that returns the start of the bucket a timestamp is in.
+        bucket: sql expression that does the same as floor.
+        option: name of the setting with the retention of this tier.
+        retention: default retention in seconds, 0 keeps the rows forever.
+    """
+
+    def __init__(self, table, source, size, floor, bucket, option, retention):
+        self.table = table
+        self.source = source
+        self.size = size
+        self.floor = floor
+        self.bucket = bucket
+        self.option = option
+        self.retention = retention
+
+        # End of the last bucket that has been filled
+        self.watermark = 0
+
+    def next_bucket(self, timestamp):
+        """Start of the bucket after the one the timestamp is in"""
+        # Half a bucket extra so days that are shorter or longer because of DST still end up in the next bucket
+        return self.floor(self.floor(timestamp) + self.size + self.size // 2)
+
+
+# The raw measurements are kept in RECORDS, which is the source of the finest tier
+RAW = Tier('RECORDS', None, 1, int, 'TIMESTAMP', 'raw_retention', 2 * 86400)
+
+# The rates of the sampler are kept as long as the raw measurements, they aren't compacted
+RATES = Tier('RATES', None, 1, int, 'TIMESTAMP', 'raw_retention', 2 * 86400)
+
+# The same goes for the hosts that used the most, each row holds the count of a host since the start of the month
+TALKERS = Tier('TALKERS', None, 1, int, 'TIMESTAMP', 'raw_retention', 2 * 86400)
+TIERS = [
+    Tier('MINUTELOGS', 'RECORDS', 60, floor_minute, 'TIMESTAMP - TIMESTAMP % 60',
+         'minute_retention', 7 * 86400),
+    Tier('HOURLOGS', 'MINUTELOGS', 3600, floor_hour, 'TIMESTAMP - TIMESTAMP % 3600',
+         'hour_retention', 90 * 86400),
+    Tier('DAYLOGS', 'HOURLOGS', 86400, floor_day, 'CAST(strftime(\'%s\', TIMESTAMP, \'unixepoch\', \
+         \'localtime\', \'start of day\', \'utc\') AS INTEGER)', 'day_retention', 0),
+]
+
+# Amount of buckets or rows a single compaction step may process
+compact_batch = 500
+
+
+class Worker(threading.Thread):
+    """Thread that owns the database connection and runs all work on it one by one.
+
+    Work is handed over through a queue, the result is returned with a future.
+    While it waits for work it also writes the buffered rows once they are FlushInterval seconds old.
+    """
+
+    def __init__(self):
+        super().__init__(name='database', daemon=True)
+        self.requests = queue.Queue()
+
+    def submit(self, function, *args):
+        """Run a function in the worker thread.
+
+        Returns:
+            A future with the result of the function.
+        """
+        future = Future()
+        self.requests.put((function, args, future))
+        return future
+
+    def stop(self):
+        """Write the buffered rows, close the connection and wait until the thread stopped"""
+        self.requests.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            timeout = None
+            if buffer:
+                timeout = max(0, buffer_since + flush_interval - time.monotonic())
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                flush()
+                continue
+
+            if request is None:
+                disconnect()
+                return
+
+            function, args, future = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+async def run(function, *args):
+    """Run a function in the database thread without blocking the event loop"""
+    return await asyncio.wrap_future(worker.submit(function, *args))
 
 
 def enable():
@@ -15,174 +221,575 @@ def enable():
     This is where the database will initialize.
     After that we run some basic checks to confirm that everything is running like it should.
     """
-    global DB
-    if not processor.config.getboolean('DATABASE', 'enabled'):
+    global worker, enabled, flush_rows, flush_interval, compact_batch
+    settings = processor.settings.database
+    if not settings.enabled:
         return
 
-    file = processor.config.get('DATABASE', 'file')
+    flush_rows = settings.flush_rows
+    flush_interval = settings.flush_interval
+    compact_batch = settings.compact_batch
+    for tier in [RAW, RATES, TALKERS] + TIERS:
+        tier.retention = getattr(settings, tier.option)
+
+    # Open the database in its own thread because the connection may only be used there
+    worker = Worker()
+    worker.start()
     try:
-        if os.path.isfile(file):
-            logger.debug('Database loaded')
-            DB = sqlite3.connect(file)
-            return
-        logger.debug('Creating new database file')
-        DB = sqlite3.connect(file)
-        DB.executescript('''CREATE TABLE RECORDS(TIMESTAMP INTEGER NOT NULL PRIMARY KEY, RECEIVED\
-            INTEGER NOT NULL, SEND INTEGER NOT NULL, SPECIAL INTEGER NOT NULL); CREATE TABLE \
-            DAYLOGS (TIMESTAMP INTEGER NOT NULL PRIMARY KEY, RECEIVED INTEGER NOT NULL, SEND \
-            INTEGER NOT NULL); CREATE TABLE MONTHLOGS (TIMESTAMP INTEGER NOT NULL PRIMARY \
-            KEY, RECEIVED INTEGER NOT NULL, SEND INTEGER NOT NULL);
-        ''')
-        DB.commit()
+        worker.submit(open_database, settings.file).result()
+        enabled = True
         logger.debug('Database loaded')
 
-    except sqlite3.Error:
-        processor.config.set('DATABASE', 'enabled', 'False')
+    except (sqlite3.Error, OSError, ValueError):
+        worker.stop()
+        worker = None
         logger.err(
             'Can\'t open the database. Check if this user has permissions to write')
 
 
-def get_last_value(received_bytes=0, send_bytes=0):
-    """Receive total amount of network usage from the database.
+def open_database(file):
+    """Open the database file, create or update its tables and fill the cache"""
+    global DB
+    if os.path.isfile(file):
+        DB = connect(file)
+        migrate()
+    else:
+        logger.debug('Creating new database file')
+        DB = connect(file)
+        with DB:
+            for sql in TABLES.values():
+                DB.execute(sql)
+            DB.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    open_log(file)
+
+    # The checkpoint already filled the cache, then only the compaction progress is read
+    # A checkpoint that is older than the stored measurements would move the totals back, then the tables are read
+    if checkpoint.state is None or not checkpoint.fresh(newest()):
+        load_cache()
+    load_watermarks()
+
+
+def open_log(file):
+    """Open the segment log when it is the engine and move the raw measurements to the engine that is set"""
+    global log
+    settings = processor.settings.database
+    directory = file + segments.SUFFIX
+    if settings.engine != 'segments':
+        if os.path.isdir(directory):
+            moved = segments.convert(file, to_segments=False)
+            logger.log(f'Moved {moved} raw measurements from the segment log to the database')
+        return
+
+    log = segments.SegmentLog(directory, settings.segment_size, settings.synchronous in ('FULL', 'EXTRA'),
+                              TIERS[-1].next_bucket)
+    log.open()
+    moved = segments.import_records(DB, log)
+    if moved:
+        logger.log(f'Moved {moved} raw measurements from the database to the segment log')
+
+
+def connect(file):
+    """Open the database file in WAL mode.
+
+    With WAL a commit only appends to the log instead of rewriting pages in place.
+    How often the log is synced to the disk is set by the Synchronous option,
+    NORMAL only syncs when the log is copied into the database which is safe in WAL mode.
+    """
+    connection = sqlite3.connect(file)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute(f'PRAGMA synchronous = {processor.settings.database.synchronous}')
+    return connection
+
+
+def migrate():
+    """Update a database created by an older version to the current layout.
+
+    Databases without a version only stored a single interface.
+    Their rows are moved to the first interface in the config file.
+    Version 1 didn't have the minute and hour tables and sorted the rows by interface.
+    Version 2 didn't have the rates table and version 3 didn't have the talkers table,
+    their other tables already have the current layout.
+    """
+    version = DB.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    logger.log('Updating the database to a newer version')
+    name = processor.settings.network.names[0]
+    existing = {row[0] for row in DB.execute('SELECT name FROM sqlite_master WHERE type = \'table\';')}
+    with DB:
+        for table, sql in TABLES.items():
+            if table not in existing:
+                DB.execute(sql)
+                continue
+            if version >= 2:
+                continue
+
+            # Rebuild the table and copy the rows in the new layout
+            DB.execute(f'ALTER TABLE {table} RENAME TO OLD_{table}')
+            DB.execute(sql)
+            columns = [row[1] for row in DB.execute(f'PRAGMA table_info(OLD_{table})')]
+            source = 'INTERFACE' if 'INTERFACE' in columns else '?'
+            special = ', SPECIAL' if 'SPECIAL' in columns else ''
+            DB.execute(f'INSERT INTO {table} (TIMESTAMP, INTERFACE, RECEIVED, SEND{special}) SELECT \
+                TIMESTAMP, {source}, RECEIVED, SEND{special} FROM OLD_{table}',
+                       () if source == 'INTERFACE' else (name,))
+            DB.execute(f'DROP TABLE OLD_{table}')
+        DB.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def load_cache():
+    """Fill the cache with the last totals and today's starting values.
+
+    The totals come from the newest row of each interface in any of the tables.
+    """
+    global day_end, month_end
+    totals.clear()
+    start_values.clear()
+    newest = {}
+    last_rows = [row for tier in reversed(TIERS) for row in DB.execute(SELECT_LAST.format(tier.table))]
+    if log is None:
+        last_rows += DB.execute(SELECT_LAST.format('RECORDS')).fetchall()
+    else:
+        last_rows += [(name, received, send, timestamp) for name, (timestamp, received, send) in log.last().items()]
+    for name, received, send, timestamp in last_rows:
+        if timestamp >= newest.get(name, 0):
+            newest[name] = timestamp
+            totals[name] = received, send
+
+    # The day and month of the newest row, rollover takes care of it when they are already over
+    if newest:
+        last = max(newest.values())
+        day_end = TIERS[-1].next_bucket(last)
+        month_end = next_month(last)
+
+    today = floor_day(time.time())
+    if log is None:
+        for name, received, send, _ in DB.execute(SELECT_FIRST_TODAY, (today,)):
+            start_values[name] = received, send
+    else:
+        start_values.update(log.first(today))
 
-    Will access RECORDS table in the database to receive data about the total usage.
-    It will do the same for DAYLOGS when there is no data in the RECORDS table.
+
+def newest():
+    """Timestamp of the newest stored measurement, 0 when nothing is stored
+
+    Every table has an index on the timestamp, so this doesn't search the tables.
+    """
+    tables = [tier.table for tier in TIERS] + (['RECORDS'] if log is None else [])
+    times = [DB.execute(f'SELECT MAX(TIMESTAMP) FROM {table};').fetchone()[0] for table in tables]
+    if log is not None:
+        times.append(log.newest())
+    return max((timestamp for timestamp in times if timestamp is not None), default=0)
+
+
+def load_watermarks():
+    # Every tier continues compacting after its newest row
+    for tier in TIERS:
+        row = DB.execute(f'SELECT MAX(TIMESTAMP) FROM {tier.table};').fetchone()
+        tier.watermark = 0 if row[0] is None else tier.next_bucket(row[0])
+
+
+def next_month(timestamp):
+    """Start of the local month after the one the timestamp is in"""
+    return floor_month(floor_month(timestamp) + 45 * 86400)
+
+
+def get_last_values(names):
+    """Receive total amount of network usage from the cache.
+
+    Totals start at zero for interfaces that aren't known yet or when a new month has started.
+    This only reads memory so it doesn't have to be awaited.
 
     Args:
-        received_bytes: total amount of bytes received today.
-        send_bytes: total amount of bytes send today.
+        names: names of the interfaces.
     Return:
-        Total received bytes according to the database.
-        Total send bytes according to the database
+        Dictionary with the total received and send bytes of each interface.
     """
+    return {name: totals.get(name, (0, 0)) for name in names}
+
+
+def get_start_values():
+    """Receive today's starting values from the cache
+    Returns:
+        Dictionary with the received and send bytes of each interface.
+    """
+    return start_values
+
+
+async def rollover(timestamp):
+    """Start a new day or month when the timestamp is past the end of the current one.
+
+    A new day stores the current totals as today's starting values.
+    A new month stores the totals of each interface in MONTHLOGS and starts counting from zero.
+    This only compares two numbers when nothing changes so it can be called on every measurement.
+
+    Args:
+        timestamp: timestamp of the next measurement.
+    """
+    global day_end, month_end
+    if timestamp < day_end:
+        return
+
+    if month_end and timestamp >= month_end:
+        if enabled:
+            rows = [(floor_month(month_end - 1), name, received, send)
+                    for name, (received, send) in totals.items()]
+            await run(write_month, rows)
+
+        # A new month starts counting from zero
+        for name in totals:
+            totals[name] = 0, 0
+        logger.debug('New month! The totals of last month have been stored')
 
-    if not processor.config.getboolean('DATABASE', 'enabled'):
-        return received_bytes, send_bytes
-    sql = 'SELECT RECEIVED, SEND FROM RECORDS WHERE TIMESTAMP =\
-         (SELECT MAX(TIMESTAMP) FROM RECORDS);'
-    output = DB.execute(sql).fetchone()
+    if day_end:
+        start_values.clear()
+        start_values.update(totals)
+        logger.debug('New day!')
 
-    if output is None:  # Access daylogs when there is nothing found in records
-        sql = 'SELECT RECEIVED, SEND FROM DAYLOGS WHERE TIMESTAMP =\
-             (SELECT MAX(TIMESTAMP) FROM DAYLOGS);'
-        output = DB.execute(sql).fetchone()
-        if output is None:
-            return 0, 0
-        return received_bytes, send_bytes
-    return received_bytes, send_bytes
+    day_end = TIERS[-1].next_bucket(timestamp)
+    month_end = next_month(timestamp)
 
 
-def get_start_value():
-    """Receive today's starting value
+def write_month(rows):
+    """Write the totals of a month that is over to MONTHLOGS"""
+    flush()
+    try:
+        with DB:
+            DB.executemany(INSERT_MONTHLOG, rows)
+    except sqlite3.Error:
+        logger.warn('Couldn\'t write to the database')
+
+
+async def query(start, end, resolution=1, name=None):
+    """Receive the totals in a time range.
+
+    The coarsest tier that still has the requested resolution is used.
+    The part of the range that hasn't been compacted into that tier yet
+    is read from the finer tiers and at last from the raw measurements.
+    The part that the finer tiers already deleted after their retention is read from the coarser tiers,
+    those rows are further apart than the resolution but it's all that is left of that period.
+
+    Args:
+        start: timestamp where the range starts.
+        end: timestamp where the range ends, this one isn't included.
+        resolution: largest amount of seconds allowed between two rows.
+        name: name of the interface, None to receive all interfaces.
     Returns:
-        Received bytes
-        Send bytes
+        List with the timestamp, interface, received and send bytes of each row.
     """
-    if not processor.config.getboolean('DATABASE', 'enabled'):
-        return 0, 0, 0
-    sql = 'SELECT RECEIVED,SEND FROM RECORDS WHERE TIMESTAMP =\
-         (SELECT MIN(TIMESTAMP) FROM RECORDS);'
-    output = DB.execute(sql).fetchone()
-    if output is None:
-        return 0, 0
-    return output[0], output[1]
+    if not enabled:
+        return []
+    return await run(read_range, start, end, resolution, name)
+
+
+def read_range(start, end, resolution, name):
+    """Read a time range from the tiers, see query"""
+    flush()
+    tiers = [RAW] + TIERS
+    oldest = [first_timestamp(tier) for tier in tiers]
+    rows = []
+    for i in reversed(range(len(tiers))):
+        tier = tiers[i]
+        if start >= end:
+            break
+        until = end if tier is RAW else min(end, tier.watermark)
+
+        # A tier that is too coarse only fills in what none of the finer tiers have anymore
+        if tier.size > resolution:
+            until = min([until] + [timestamp for timestamp in oldest[:i] if timestamp is not None])
+        if until <= start:
+            continue
+        rows.extend(read_tier(tier, start, until))
+        start = until
+    if name is not None:
+        rows = [row for row in rows if row[1] == name]
+    return rows
 
 
-def get_timestamps():
-    """Receive daily timestamp and record's timestamp
+def read_tier(tier, start, end):
+    # The rows of a tier in a time range, the raw measurements may be in the segment log
+    if tier is RAW and log is not None:
+        return log.read(start, end)
+    return DB.execute(SELECT_RANGE.format(tier.table), (start, end)).fetchall()
+
+
+def first_timestamp(tier):
+    """Timestamp of the oldest row of a tier, None when it is empty"""
+    if tier is RAW and log is not None:
+        return log.oldest()
+    return DB.execute(f'SELECT MIN(TIMESTAMP) FROM {tier.table};').fetchone()[0]
+
+
+def read_days():
+    """Receive the usage of each day in DAYLOGS, this runs in the database thread.
+
+    The rows hold the totals of the month at the end of each day, so the usage of a day
+    is the difference with the day before it or the total itself on the first day of a month.
+
     Returns:
-        today: timestamp of the first records in today logs
-        daily: timestamp of the first record in the daily logs
-    """
-    today, daily = 0, 0
-    if not processor.config.getboolean('DATABASE', 'enabled'):
-        return today, daily
-
-    # Receive the first timestamp of today.
-    sql = 'SELECT TIMESTAMP FROM RECORDS WHERE TIMESTAMP =\
-         (SELECT MIN(TIMESTAMP)  FROM RECORDS);'
-    output = DB.execute(sql).fetchone()
-    if output is not None:
-        today = output[0]
-    # Receive the first row in the daily logs
-    sql = 'SELECT TIMESTAMP FROM RECORDS WHERE TIMESTAMP =\
-         (SELECT MIN(TIMESTAMP)  FROM DAYLOGS);'
-    output = DB.execute(sql).fetchone()
-    if output is not None:
-        daily = output[0]
-    return today, daily
-
-
-def add_row(received, send, timestamp=None, special=0):
-    """Adds new information to the database
+        List with the start of each day and a dictionary with the bytes each interface used that day.
+    """
+    flush()
+    days, last = {}, {}
+    for timestamp, name, received, send in DB.execute(SELECT_RANGE.format('DAYLOGS'), (0, 2 ** 62)):
+        previous_day, previous = last.get(name, (None, 0))
+        if previous_day is None or floor_month(previous_day) != floor_month(timestamp):
+            previous = 0
+        last[name] = timestamp, received + send
+        days.setdefault(timestamp, {})[name] = max(0, received + send - previous)
+    return sorted(days.items())
+
+
+def read_rates(start, end, name=None):
+    """Read the rates of the sampler in a time range, this runs in the database thread.
 
     Args:
-        received: amount of bytes received.
-        send: amount of bytes send.
+        start: timestamp where the range starts.
+        end: timestamp where the range ends, this one isn't included.
+        name: name of the interface, None to receive all interfaces.
+    Returns:
+        List with the timestamp, interface and the peak, mean and 95th percentile
+        of the received and send rate of each row.
+    """
+    flush()
+    rows = DB.execute(SELECT_RATES, (start, end)).fetchall()
+    if name is not None:
+        rows = [row for row in rows if row[1] == name]
+    return rows
+
+
+async def add_rows(new_totals, timestamp=None, special=0, rates=None):
+    """Adds new information to the cache and the database
+
+    The rows are buffered in the database thread and written together by flush.
+    This happens when FlushRows rows are waiting or when the oldest waiting row
+    is FlushInterval seconds old, so a crash never loses more than FlushInterval seconds.
+
+    Args:
+        new_totals: dictionary with the received and send bytes of each interface.
         timestamp: timestamp when this is information is captured.
         special:
             0 = nothing special.
             1 = captured on startup.
+        rates: dictionary with the peak, mean and 95th percentile rate of
+            received and send bytes of each interface from the sampler.
     """
-    if not processor.config.getboolean('DATABASE', 'enabled'):
+    if timestamp is None:
+        timestamp = int(time.time())
+
+    # Update the cache first so it is always up to date, even when the database is disabled
+    totals.update(new_totals)
+    for name, values in new_totals.items():
+        start_values.setdefault(name, values)
+
+    if not enabled:
         return
 
+    rows = [(timestamp, name, received, send, special)
+            for name, (received, send) in new_totals.items()]
+    rates = [(timestamp, name, *received, *send) for name, (received, send) in (rates or {}).items()]
+    await run(buffer_rows, rows, len(new_totals), rates)
+
+
+def read_talkers(start):
+    """Read the last stored hosts that used the most since start, this runs in the database thread.
+
+    Returns:
+        List with the address, received, send bytes and error of each host.
+    """
+    flush()
+    return DB.execute(SELECT_TALKERS, (start,)).fetchall()
+
+
+async def add_talkers(talkers, timestamp=None):
+    """Store the hosts that used the most, they are written together with the next measurement
+
+    Args:
+        talkers: list with the address, received, send bytes and error of each host.
+        timestamp: timestamp when the hosts were counted.
+    """
+    if not enabled:
+        return
     if timestamp is None:
         timestamp = int(time.time())
+    await run(talker_buffer.extend, [(timestamp, *talker) for talker in talkers])
+
+
+def buffer_rows(rows, interfaces, rates=()):
+    """Add rows to the buffer and write them when there are enough of them"""
+    global buffer_since
+    if not buffer:
+        buffer_since = time.monotonic()
+    buffer.extend(rows)
+    rate_buffer.extend(rates)
+
+    if len(buffer) >= flush_rows * interfaces or time.monotonic() - buffer_since >= flush_interval:
+        flush()
+
+
+def flush():
+    """Write all buffered rows to the database in a single transaction"""
+    if not (buffer or talker_buffer) or DB is None:
+        return
 
-    sql = 'INSERT INTO RECORDS (TIMESTAMP, RECEIVED, SEND, SPECIAL) ' \
-        f'VALUES({timestamp}, {received}, {send},{special});'
     try:
-        DB.execute(sql)
-        DB.commit()
-    except sqlite3.Error:
+        start = time.monotonic()
+
+        # The raw measurements are appended to the segment log, only the other rows go to sqlite
+        if log is not None and buffer:
+            log.append(buffer)
+            buffer.clear()
+        with DB:
+            DB.executemany(INSERT_RECORD, buffer)
+            DB.executemany(INSERT_RATE, rate_buffer)
+            DB.executemany(INSERT_TALKER, talker_buffer)
+        metrics.flush.observe(time.monotonic() - start)
+        buffer.clear()
+        rate_buffer.clear()
+        talker_buffer.clear()
+    except (sqlite3.Error, OSError):
+        # Keep the rows so we can try again next time
         logger.warn('Couldn\'t write to the database')
 
+
+def close():
+    """Write the remaining rows, close the database and stop its thread"""
+    global worker, enabled
+    if worker is None:
+        return
+    worker.stop()
+    worker = None
+    enabled = False
+
+
+def disconnect():
+    """Write the remaining rows and close the connection"""
+    global DB, log
+    if DB is None:
+        return
+    flush()
+    DB.close()
+    DB = None
+    if log is not None:
+        log.close()
+        log = None
+
+
+def compact(tier, now):
+    """Fill the closed buckets of a tier from its source table.
+
+    At most compact_batch buckets are filled so a single step never blocks for long.
+
+    Args:
+        tier: the tier to fill.
+        now: current timestamp.
+    Returns:
+        True when there are more closed buckets waiting.
+    """
+    # Only buckets that are complete in the source table can be filled
+    source = RAW if tier.source == 'RECORDS' else next(t for t in TIERS if t.table == tier.source)
+    closed = tier.floor(now if source is RAW else source.watermark)
+
+    # Skip the periods without any measurements
+    if source is RAW and log is not None:
+        first = log.next_timestamp(tier.watermark)
+    else:
+        first = DB.execute(SELECT_NEXT.format(source.table), (tier.watermark,)).fetchone()[0]
+    if first is None or first >= closed:
+        return False
+    start = tier.floor(first)
+    end = min(closed, tier.floor(start + compact_batch * tier.size + tier.size // 2))
+    end = max(end, tier.next_bucket(start))
+
+    if source is RAW and log is not None:
+        DB.executemany(INSERT_TIER.format(tier.table), rollup(log.read(start, end), tier.floor))
+    else:
+        DB.execute(ROLLUP.format(tier.table, tier.bucket, source.table), (start, end))
+    tier.watermark = end
+    return end < closed
+
+
+def rollup(rows, floor):
+    # The same as ROLLUP for rows that aren't in sqlite, the last row of each interface in every bucket
+    last = {}
+    for timestamp, name, received, send in rows:
+        bucket = floor(timestamp)
+        last[bucket, name] = bucket, name, received, send
+    return list(last.values())
+
+
+def expire(tier, coarser, now):
+    """Delete at most compact_batch rows of a tier that are older than its retention.
+
+    Rows are only deleted when they have been compacted into the coarser tier.
+
+    Args:
+        tier: the tier to delete rows from.
+        coarser: the tier that is filled from this tier, None when there is none.
+        now: current timestamp.
+    Returns:
+        True when there may be more rows to delete.
+    """
+    if tier.retention <= 0:
+        return False
+    cutoff = now - tier.retention
+    if coarser is not None:
+        cutoff = min(cutoff, coarser.watermark)
+
+    # The segment log deletes whole segments, that is always a single quick step
+    if tier is RAW and log is not None:
+        log.expire(cutoff)
+        return False
+    deleted = DB.execute(EXPIRE.format(tier.table), (cutoff, compact_batch)).rowcount
+    return deleted >= compact_batch
+
+
+def maintain(now=None):
+    """Do a single bounded step of compaction and retention on every tier.
+
+    Args:
+        now: current timestamp.
+    Returns:
+        True when there is more work waiting.
+    """
+    if now is None:
+        now = int(time.time())
+
+    # Make sure all rows are in the database before we move them
+    flush()
+    busy = False
+    tiers = [RAW] + TIERS
+    try:
+        for i, tier in enumerate(tiers):
+            with DB:
+                if i > 0:
+                    busy |= compact(tier, now)
+                busy |= expire(tier, tiers[i + 1] if i + 1 < len(tiers) else None, now)
+        with DB:
+            busy |= expire(RATES, None, now)
+            busy |= expire(TALKERS, None, now)
+
+        # Compress a segment of the raw measurements that has been closed
+        if log is not None:
+            busy |= log.seal()
+    except (sqlite3.Error, OSError):
+        logger.warn('Couldn\'t compact the database')
+        return False
+    return busy
+
+
 async def loop():
     """Asynchronous infinite loop to update the database.
-    This means that i'll delete old information."""
+    Old measurements are compacted into tables with a lower resolution and deleted after their retention."""
 
-    if not processor.config.getboolean('DATABASE', 'enabled'):
+    if not enabled:
         return
-    interval = processor.config.getint('DATABASE', 'datamoveinterval')
+    interval = processor.settings.database.data_move_interval
     if interval < 6:
-        return      
+        return
+    busy = False
     while True:
-        await asyncio.sleep(interval)
-        today_timestamp, daily_timestamp = get_timestamps()
-        if today_timestamp == 0:
-            continue
-        today_date = datetime.fromtimestamp(today_timestamp)
-        daily_date = datetime.fromtimestamp(daily_timestamp)
-        received, send = get_last_value(0, 0)
-        new_date = datetime.now()
-        timestamp = int(datetime.timestamp(new_date))
-        if new_date.month != daily_date.month and daily_timestamp != 0:
-            sql = 'INSERT INTO MONTHLOGS (TIMESTAMP, RECEIVED, SEND) ' \
-                f'VALUES({timestamp}, {received}, {send});'
-            DB.execute(sql)
-            DB.execute('DELETE FROM RECORDS')
-            DB.execute('DELETE FROM DAYLOGS')
-            try:
-                DB.commit()
-                logger.debug(
-                    'New month! old information has been purged and stored in a more compact way')
-                processor.restart_system()
-            except sqlite3.Error:
-                logger.warn('Couldn\'t write to the database')
-            continue
-
-        # Check if we are in a new day.
-        if abs(new_date - today_date).days < 1:
-            continue
-
-        sql = 'INSERT INTO DAYLOGS (TIMESTAMP, RECEIVED, SEND) ' \
-            f'VALUES({timestamp}, {received}, {send});'
-        DB.execute(sql)
-        DB.execute('DELETE FROM RECORDS')
-        try:
-            DB.commit()
-            logger.debug(
-                'New day! old information has been purged and stored in a more compact way')
-        except sqlite3.Error:
-            logger.warn('Couldn\'t write to the database')
+        # Continue right away when there is a backlog, but give the other tasks some room
+        await asyncio.sleep(1 if busy else interval)
+        busy = await run(maintain)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module to execute the commands from the config file without blocking the program
+
+Commands are split like a shell would do, but they aren't run by a shell.
+Use sh -c '...' in the config file when a command needs pipes or redirects.
+"""
+
+import shlex
+import asyncio
+from asyncio.subprocess import PIPE, STDOUT
+from . import logger, processor
+
+# The event loop the commands are executed on, used to hand over commands from other threads
+loop = None
+
+# Limits the amount of commands that run at the same time
+semaphore = None
+
+# Default amount of seconds a command may run before it is killed
+timeout = 60
+
+# Commands that are running or waiting to run, with the task that executes them
+running = {}
+
+
+def enable(event_loop):
+    """Prepare the executor to run commands on the event loop
+
+    Args:
+        event_loop: the asyncio loop the program runs on.
+    """
+    global loop, semaphore, timeout
+    loop = event_loop
+    semaphore = asyncio.Semaphore(processor.settings.commands.max_concurrent)
+    timeout = processor.settings.commands.timeout
+    logger.debug('Executor loaded')
+
+
+def submit(command, command_timeout=None):
+    """Start a command in the background.
+
+    A command that is already running or waiting to run isn't started a second time.
+    This must be called from the event loop, use submit_threadsafe from other threads.
+
+    Args:
+        command: the command to execute.
+        command_timeout: seconds before the command is killed, None uses the default.
+    Returns:
+        The task that executes the command, its result is the exit code or None when it failed.
+    """
+    if command in running:
+        logger.debug(f'"{command}" is already running')
+        return running[command]
+
+    task = loop.create_task(execute(command, command_timeout or timeout))
+    running[command] = task
+    task.add_done_callback(lambda _: running.pop(command, None))
+    return task
+
+
+def submit_threadsafe(command, command_timeout=None):
+    """Start a command from another thread, for example an MQTT callback"""
+    loop.call_soon_threadsafe(submit, command, command_timeout)
+
+
+async def run(command, command_timeout=None):
+    """Execute a command and wait until it is done
+
+    Returns:
+        The exit code of the command or None when it couldn't run or timed out.
+    """
+    return await asyncio.shield(submit(command, command_timeout))
+
+
+async def execute(command, command_timeout):
+    """Execute a command and log its output
+
+    Args:
+        command: the command to execute.
+        command_timeout: seconds before the command is killed.
+    Returns:
+        The exit code of the command or None when it couldn't run or timed out.
+    """
+    async with semaphore:
+        try:
+            args = shlex.split(command)
+            if not args:
+                raise ValueError('the command is empty')
+            process = await asyncio.create_subprocess_exec(*args, stdout=PIPE, stderr=STDOUT)
+        except (OSError, ValueError) as e:
+            logger.err(f'Couldn\'t execute "{command}": {e}')
+            return None
+
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), command_timeout)
+        except asyncio.TimeoutError:
+            # Kill the command and wait for it so it doesn't stay behind as zombie
+            process.kill()
+            await process.wait()
+            logger.warn(f'"{command}" took longer than {command_timeout} seconds and has been killed')
+            return None
+
+    for line in output.decode(errors='replace').splitlines():
+        logger.debug(f'{args[0]}: {line}')
+    if process.returncode != 0:
+        logger.warn(f'"{command}" exited with code {process.returncode}')
+    return process.returncode
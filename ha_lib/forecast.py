@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that projects the usage at the end of the month from the usage of each day
+
+The usage of each day is modelled as a level, a trend and an offset for each day of the week (Holt-Winters).
+The model is updated once when a day is over, that takes a few multiplications no matter how much history there is.
+At the start the model is fed the days in DAYLOGS one by one, after that only the days that close.
+The projection is the usage so far plus the expected usage of the rest of the month,
+the band around it grows with the days that are left and how much an error of one day carries over to the next.
+"""
+
+import math
+import time
+from datetime import datetime
+from collections import namedtuple
+from . import logger, processor, database
+
+# Models of each interface, None holds the sum of all interfaces
+models = {}
+
+# Days that have to be seen before there is a projection, one of each day of the week
+MIN_DAYS = 7
+
+# Expected usage at the end of the month in bytes and the lower and upper bound of the confidence band
+Projection = namedtuple('Projection', ['expected', 'low', 'high'])
+
+
+class Model:
+    """Weekday aware trend of the usage of each day, updated one day at a time.
+
+    The trend is damped, so a few busy days don't add up to a huge month.
+
+    Args:
+        alpha: how fast the level follows new days.
+        beta: how fast the trend follows changes of the level.
+        gamma: how fast the offset of a day of the week follows new days.
+        phi: how much of the trend is left for each day further ahead.
+    """
+
+    def __init__(self, alpha=0.3, beta=0.05, gamma=0.2, phi=0.9):
+        self.alpha, self.beta, self.gamma, self.phi = alpha, beta, gamma, phi
+        self.level = None
+        self.trend = 0.0
+        self.season = [0.0] * 7
+        self.variance = 0.0
+        self.days = 0
+
+        # Expected usage of today and of the days after today until the end of the month
+        # spread is the variance of the total of those days divided by the variance of a single day
+        self.today = 0.0
+        self.rest = 0.0
+        self.rest_days = 0
+        self.spread = 1.0
+
+    def predict(self, weekday, ahead=1):
+        """Expected usage of a day, ahead is the amount of days after the last closed day"""
+        if self.level is None:
+            return 0.0
+        damping = sum(self.phi ** day for day in range(1, ahead + 1))
+        return max(0.0, self.level + damping * self.trend + self.season[weekday])
+
+    def update(self, weekday, usage):
+        """Add the usage of a day that is over"""
+        self.days += 1
+        if self.level is None:
+            self.level = usage
+            return
+
+        # The variance of the errors of one day ahead gives the width of the band
+        error = usage - self.predict(weekday)
+        self.variance += self.alpha * (error * error - self.variance) if self.days > 2 else error * error
+
+        level = self.level
+        self.level = self.alpha * (usage - self.season[weekday]) + (1 - self.alpha) * (level + self.phi * self.trend)
+        self.trend = self.beta * (self.level - level) + (1 - self.beta) * self.phi * self.trend
+        self.season[weekday] = self.gamma * (usage - self.level) + (1 - self.gamma) * self.season[weekday]
+
+    def plan(self, day):
+        """Calculate the expected usage of the day that starts at day and of the rest of its month"""
+        month_end = database.next_month(day)
+        self.today = self.predict(weekday(day))
+        self.rest, self.rest_days = 0.0, 0
+        next_day = database.TIERS[-1].next_bucket(day)
+        while next_day < month_end:
+            self.rest_days += 1
+            self.rest += self.predict(weekday(next_day), self.rest_days + 1)
+            next_day = database.TIERS[-1].next_bucket(next_day)
+
+        # An error of a day also moves the level and trend, so it is repeated in every day after it
+        self.spread = 0.0
+        for after in range(self.rest_days + 1):
+            self.spread += (1 + self.alpha * after + self.alpha * self.beta * after * (after + 1) / 2) ** 2
+
+
+def weekday(timestamp):
+    return datetime.fromtimestamp(timestamp).weekday()
+
+
+def enable():
+    # Make a model for every interface and feed it the days that are stored in the database
+    settings = processor.settings.forecast
+    if not settings.enabled:
+        return
+    for name in processor.settings.network.names + [None]:
+        models[name] = Model(settings.alpha, settings.beta, settings.gamma)
+
+    if database.enabled:
+        days = database.worker.submit(database.read_days).result()
+        for day, usage in days:
+            learn(day, usage)
+        logger.debug(f'Forecast learned from {len(days)} day(s)')
+    plan(database.floor_day(int(time.time())))
+
+
+def learn(day, usage):
+    # Update the models with the usage of a day
+    day_of_week = weekday(day)
+    for name, model in models.items():
+        if name is None:
+            model.update(day_of_week, sum(usage.values()))
+        elif name in usage:
+            model.update(day_of_week, usage[name])
+
+
+def plan(day):
+    # Calculate the expected usage of the rest of the month for every model
+    for model in models.values():
+        model.plan(day)
+
+
+def close_day(day_end):
+    """Add the usage of the day that ends at day_end, this has to happen before the totals are reset
+
+    Args:
+        day_end: timestamp of the end of the day that is over.
+    """
+    if not models:
+        return
+    start_values = database.get_start_values()
+    usage = {}
+    for name, (received, send) in processor.totals.items():
+        start_rx, start_tx = start_values.get(name, (received, send))
+        usage[name] = received + send - start_rx - start_tx
+    learn(database.floor_day(day_end - 1), usage)
+    plan(day_end)
+
+
+def get(name=None):
+    """Receive the projection of the total at the end of this month
+
+    Args:
+        name: name of the interface, None for the sum of all interfaces.
+    Returns:
+        The projection or None when there aren't enough days to make one.
+    """
+    model = models.get(name)
+    if model is None or model.days < MIN_DAYS:
+        return None
+
+    if name is None:
+        used = processor.total_rx + processor.total_tx
+        start = sum(rx + tx for rx, tx in database.get_start_values().values())
+    else:
+        rx, tx = processor.totals.get(name, (0, 0))
+        used = rx + tx
+        start = sum(database.get_start_values().get(name, (rx, tx)))
+
+    # What is left of today is the expected usage of today minus what has been used already
+    expected = used + max(0.0, model.today - (used - start)) + model.rest
+    margin = processor.settings.forecast.z * math.sqrt(model.variance * model.spread)
+    return Projection(expected, max(used, expected - margin), expected + margin)
@@ -1,64 +1,236 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Author: Arjan de Haan (Vepnar)
+import os
 import re
 import sys
 from . import processor, logger
 from subprocess import Popen, PIPE
 from datetime import datetime
 
-def enable():
-    # Recieve config settings and format the command
-    interface = processor.config.get('NETWORK','interface')
-    command = f'ifconfig {interface}'
-
-    # Execute the command and recieve the output
-    pipe = Popen(command, shell=True, stdout=PIPE)
-    command_output = pipe.communicate()[0].decode("ascii")
-    
-    # Check if there are any errors found the the terminal output
-    if ' error ' in command_output:
-        logger.err("Interface is not found")
-        sys.exit(1)
-        
-    logger.debug('Interface loaded')
+# Paths relative to the root of the filesystem where the kernel exposes the interface counters
+SYSFS_PATH = 'sys/class/net/{}/statistics/{}_bytes'
+PROCFS_PATH = 'proc/net/dev'
 
-def receive_values():
-    interface = processor.config.get('NETWORK','interface')   
-    command = f'ifconfig {interface}'
+# Counters on 32 bit kernels wrap around at this value
+COUNTER_WRAP = 2 ** 32
+
+# The counter reader for the configured interfaces
+reader = None
+
+
+class CounterReader:
+    """Read the byte counters of network interfaces without spawning any processes.
+
+    All interfaces are read with a single pass over /proc/net/dev.
+    The sysfs counter files of each interface are used when /proc isn't mounted.
+    Those files are opened once and re-read with pread on every measurement.
+    Parsing the output of ifconfig is only used when neither of them exists.
+
+    Args:
+        interfaces: names of the interfaces to read.
+        root: root of the filesystem, point this to a directory with fixture files for testing.
+    """
+
+    def __init__(self, interfaces, root='/'):
+        self.interfaces = list(interfaces)
+        self.root = root
+        self.fds = {}
+        self.source = None
+        self.last = {name: (0, 0) for name in self.interfaces}
+
+        # Try /proc/net/dev first because it lists every interface in one file
+        try:
+            self.fds[None] = os.open(os.path.join(root, PROCFS_PATH), os.O_RDONLY)
+            self.source = 'procfs'
+            self.read(strict=True)
+            return
+        except (OSError, ValueError):
+            self.close()
+
+        # Look for the sysfs files of each interface
+        try:
+            for name in self.interfaces:
+                self.fds[name] = self.open_sysfs(name)
+            self.source = 'sysfs'
+            return
+        except OSError:
+            self.close()
+
+        # Use ifconfig as last resort
+        self.source = 'ifconfig'
+        self.read(strict=True)
+
+    def open_sysfs(self, name):
+        """Open the received and send counter files of an interface in sysfs"""
+        fds = []
+        try:
+            for direction in ('rx', 'tx'):
+                path = os.path.join(self.root, SYSFS_PATH.format(name, direction))
+                fds.append(os.open(path, os.O_RDONLY))
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return fds
+
+    def read(self, strict=False):
+        """Read the current values of the counters.
+
+        Interfaces that can't be read keep their last known values,
+        so a modem that is unplugged for a moment doesn't stop the other interfaces.
+
+        Args:
+            strict: raise an error instead when an interface can't be read.
+        Returns:
+            Dictionary with the total received and send bytes of each interface.
+        Raises:
+            OSError: when the counters can't be read.
+            ValueError: when the counters can't be parsed.
+        """
+        if self.source == 'procfs':
+            values = parse_procfs(read_fd(self.fds[None]), self.interfaces)
+        elif self.source == 'sysfs':
+            values = {}
+            for name in self.interfaces:
+                try:
+                    values[name] = self.read_sysfs(name)
+                except (OSError, ValueError):
+                    if strict:
+                        raise
+        else:
+            values = {}
+            for name in self.interfaces:
+                try:
+                    values[name] = parse_ifconfig(name)
+                except (OSError, ValueError):
+                    if strict:
+                        raise
+
+        if strict and len(values) != len(self.interfaces):
+            missing = ', '.join(name for name in self.interfaces if name not in values)
+            raise ValueError(f'Interface {missing} not found')
+
+        self.last.update(values)
+        return dict(self.last)
+
+    def read_sysfs(self, name):
+        """Read the counters of one interface and reopen the files when the interface was re-added"""
+        fds = self.fds.get(name)
+        try:
+            if fds is None:
+                raise OSError
+            return int(os.pread(fds[0], 32, 0)), int(os.pread(fds[1], 32, 0))
+        except OSError:
+            if fds is not None:
+                for fd in self.fds.pop(name):
+                    os.close(fd)
+            self.fds[name] = fds = self.open_sysfs(name)
+            return int(os.pread(fds[0], 32, 0)), int(os.pread(fds[1], 32, 0))
+
+    def close(self):
+        """Close all open file descriptors"""
+        for fds in self.fds.values():
+            for fd in fds if isinstance(fds, list) else [fds]:
+                os.close(fd)
+        self.fds = {}
+
+
+def read_fd(fd):
+    """Read a whole file from an already opened file descriptor"""
+    chunks = []
+    offset = 0
+    while True:
+        chunk = os.pread(fd, 65536, offset)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+        offset += len(chunk)
 
+
+def parse_procfs(content, interfaces):
+    """Find the received and send bytes of the interfaces in the contents of /proc/net/dev
+
+    Args:
+        content: contents of /proc/net/dev.
+        interfaces: names of the interfaces to look for.
+    Returns:
+        Dictionary with the received and send bytes of each interface that was found.
+    """
+    wanted = {name.encode(): name for name in interfaces}
+    values = {}
+    for line in content.splitlines()[2:]:
+        name, _, fields = line.partition(b':')
+        name = wanted.get(name.strip())
+        if name is None:
+            continue
+        fields = fields.split()
+        values[name] = int(fields[0]), int(fields[8])
+    return values
+
+
+def parse_ifconfig(interface):
+    """Receive the received and send bytes of an interface by parsing the output of ifconfig"""
     # Open subprocess and parse output
-    pipe = Popen(command, shell=True, stdout=PIPE)
-    command_output = pipe.communicate()[0].decode("ascii")
+    try:
+        pipe = Popen(['ifconfig', interface], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        raise OSError('ifconfig is not available')
+    command_output = pipe.communicate()[0].decode('ascii', 'replace')
 
     # Find byte values with regex
-    parser_regex = r'bytes ([0-9]*)'
+    parser_regex = r'bytes[: ]([0-9]+)'
     values = re.findall(parser_regex, command_output)
+    if len(values) < 2:
+        raise ValueError(f'Interface {interface} not found')
+    return int(values[0]), int(values[1])
+
+
+def counter_delta(last, new):
+    """Calculate how much a counter increased since the last measurement.
+
+    Detects when a 32 bit counter wrapped around and when the counter has been reset,
+    for example when the interface is removed and added again.
+
+    Args:
+        last: previous value of the counter.
+        new: current value of the counter.
+    Returns:
+        The amount of bytes since the last measurement.
+    """
+    if new >= last:
+        return new - last
+
+    # A 32 bit counter that was in its upper half and wrapped around
+    wrapped = new + COUNTER_WRAP - last
+    if last < COUNTER_WRAP and wrapped < COUNTER_WRAP // 2:
+        return wrapped
+
+    # The counter has been reset so everything it counted is new
+    return new
 
+
+def enable():
+    global reader
+    # Recieve config settings and open the counters of the interfaces
+    interfaces = processor.settings.network.names
+
+    # Check if the interfaces can be found
     try:
-        # Convert to int
-        return int(values[0]), int(values[1])
-    except:
-        # Logger potential error to he console and return 0,0
-        logger.err('Couldn\'t recieve data on the interface')
-        return 0, 0
-
-def check_disabletrigger(total):
-    # Only execute when this function is enabled
-    if not processor.config.getboolean('NETWORK', 'disabletrigger'):
-        return
-
-    # Recieve threshhold and command from the config file
-    threshold = processor.config.getint('NETWORK', 'disablethreshold')
-    command = processor.config.get('NETWORK','disablecommand')
-
-    # Check if the threshold total values is higher than the threshold
-    if total > threshold:
-        logger.log('The interface passed the second threshold and the command is executed')
-
-        # Execute command insert into the config file
-        pipe = Popen(command, shell=True, stdout=PIPE)
-        processor.config.set('NETWORK','disabletrigger','False')
+        reader = CounterReader(interfaces)
+    except (OSError, ValueError) as e:
+        logger.err(f"Interface is not found: {e}")
+        sys.exit(1)
+
+    logger.debug(f'{len(interfaces)} interface(s) loaded using {reader.source}')
+
+def receive_values():
+    try:
+        return reader.read()
+    except (OSError, ValueError):
+        # Logger potential error to he console and return the last known values
+        logger.err('Couldn\'t recieve data on the interfaces')
+        return dict(reader.last)
 
 # Make the large numbers more readable
 def byte_formatter(value):
@@ -72,7 +244,7 @@ def byte_formatter(value):
             return reduced, byte_units[i]
     return value, byte_units[0]
 
-def print_usage(rx, tx):
+def print_usage(rx, tx, name=None, projection=None):
     # Calculate and process values
     rx_int, rx_unit = byte_formatter(rx)
     tx_int, tx_unit = byte_formatter(tx)
@@ -80,5 +252,14 @@ def print_usage(rx, tx):
 
     # format the information and print it to the console
     message = f'Recieved: {rx_int:6.2F}{rx_unit} | Send: {tx_int:6.2F}{tx_unit} | Total: {tt_int:6.2F}{tt_unit}'
-    logger.log(message)
 
+    # Add the expected total at the end of the month with its upper bound
+    if projection is not None:
+        fc_int, fc_unit = byte_formatter(projection.expected)
+        high_int, high_unit = byte_formatter(projection.high)
+        message += f' | Month: {fc_int:6.2F}{fc_unit} (max {high_int:.2F}{high_unit.strip()})'
+
+    # Show which interface it is about when there are multiple
+    if name is not None:
+        message = f'{name:<8} {message}'
+    logger.log(message)
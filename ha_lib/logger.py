@@ -4,37 +4,201 @@
 
 from colorama import Fore, Style
 from datetime import datetime
-from . import processor
+import threading
+import atexit
+import queue
+import time
+import sys
+import os
 
-def default(msg, level, icon):
+# Highest level that is logged and if logging is enabled at all
+# These are set from the settings, everything is logged until then
+level = 4
+enabled = True
 
-    # Recieve time and format it
-    now = datetime.now()
-    time = now.strftime('%H:%M:%S')
-    date = now.strftime('%d %B %Y %H:%M:%S')
+# Log file and when it is rotated, no file is written when the path is empty
+file = ''
+max_bytes = 1000000
+backup_count = 3
 
-    # Log in the terminal when it is allowed
-    if processor.config.getint('LOGGING', 'level') >= level and processor.config.getboolean('LOGGING','enabled'):
-        message = f'{time} {Style.BRIGHT}{icon}{Style.RESET_ALL}: {msg}'
-        print(message)
+# The thread that writes the messages, messages are written right away when it isn't running
+writer = None
 
-    #TODO add file logging
+# Messages waiting for the writer, new messages are dropped and counted when it is full
+# The counts are changed by the thread that logs and the writer, so they are guarded by the lock
+records = queue.Queue(1000)
+dropped = 0
+dropped_total = 0
+lock = threading.Lock()
+
+# Colour and name of each level
+LEVELS = {
+    4: (Fore.BLUE, 'Debug'),
+    3: (Fore.GREEN, 'Info '),
+    2: (Fore.YELLOW, 'Warn '),
+    1: (Fore.RED, 'Error'),
+}
+
+
+class Writer(threading.Thread):
+    """Thread that writes the messages to the terminal and the log file.
+
+    All waiting messages are written at once, so a slow terminal is only flushed once per batch.
+    """
+
+    def __init__(self):
+        super().__init__(name='logger', daemon=True)
+        self.path = None
+        self.output = None
+        self.size = 0
+
+    def stop(self):
+        """Write the waiting messages and wait until the thread stopped"""
+        records.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = [records.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            self.write(batch)
+            if stopping:
+                if self.output is not None:
+                    self.output.close()
+                return
+
+    def write(self, batch):
+        # Tell how many messages didn't fit in the queue
+        global dropped
+        with lock:
+            count, dropped = dropped, 0
+        if count:
+            batch.append((time.time(), 2, f'{count} messages dropped because logging is too slow'))
+
+        console, lines = format_batch(batch)
+        sys.stdout.write(console)
+        sys.stdout.flush()
+        if file:
+            self.write_file(lines)
+
+    def write_file(self, lines):
+        # Open the log file again when the path changed after reloading the config
+        try:
+            if self.path != file:
+                if self.output is not None:
+                    self.output.close()
+                self.output = open(file, 'a')
+                self.path = file
+                self.size = self.output.tell()
+            self.output.write(lines)
+            self.output.flush()
+            self.size += len(lines)
+            if max_bytes > 0 and self.size >= max_bytes:
+                self.rotate()
+        except OSError as e:
+            sys.stdout.write(f'Can\'t write to log file "{file}": {e}\n')
+
+    def rotate(self):
+        # Move log to log.1, log.1 to log.2 and so on, the oldest is removed
+        self.output.close()
+        self.output = None
+        self.path = None
+        for i in reversed(range(1, backup_count)):
+            if os.path.exists(f'{file}.{i}'):
+                os.replace(f'{file}.{i}', f'{file}.{i + 1}')
+        if backup_count > 0:
+            os.replace(file, f'{file}.1')
+        else:
+            os.remove(file)
+
+
+def format_batch(batch):
+    """Format messages for the terminal and the log file
+
+    Args:
+        batch: list with the time, level and text of each message.
+    Returns:
+        The text for the terminal and the text for the log file.
+    """
+    console, lines = [], []
+    for timestamp, msg_level, msg in batch:
+        colour, name = LEVELS[msg_level]
+        now = datetime.fromtimestamp(timestamp)
+        console.append(f'{now:%H:%M:%S} {Style.BRIGHT}{colour}{name}{Style.RESET_ALL}: {msg}\n')
+        lines.append(f'{now:%Y-%m-%d %H:%M:%S} {name}: {msg}\n')
+    return ''.join(console), ''.join(lines)
+
+
+def configure(settings):
+    # Use the logging settings of a new settings snapshot
+    global level, enabled, file, max_bytes, backup_count
+    level, enabled = settings.level, settings.enabled
+    file, max_bytes, backup_count = settings.file, settings.max_bytes, settings.backup_count
+
+
+def start(queue_size=1000):
+    # Write the messages from a thread from now on
+    global writer, records
+    records = queue.Queue(queue_size)
+    writer = Writer()
+    writer.start()
+
+    # Also write the waiting messages when the program exits early, for example with sys.exit
+    atexit.register(stop)
+
+
+def stop():
+    # Write the waiting messages and go back to writing them right away
+    global writer
+    if writer is not None:
+        writer.stop()
+        writer = None
+
+
+def default(msg, msg_level):
+    # Skip everything else when the message isn't logged
+    global dropped, dropped_total
+    if level < msg_level or not enabled:
+        return
+
+    record = (time.time(), msg_level, msg)
+    if writer is None:
+        console, _ = format_batch([record])
+        sys.stdout.write(console)
+        return
+
+    # Hand the message over to the writer, this is usually the event loop so it never waits for room
+    # The writer tells how many messages were lost when it can't keep up
+    try:
+        records.put_nowait(record)
+    except queue.Full:
+        with lock:
+            dropped += 1
+            dropped_total += 1
 
 # Log level 4 (debug)
 def debug(msg):
-    default(msg, 4, Fore.BLUE + 'Debug')
+    default(msg, 4)
 
 # Log leven 3 (Info)
 def log(msg):
-    default(msg, 3, Fore.GREEN +'Info ')
+    default(msg, 3)
 
 # Log level 2 (Warning)
 def warn(msg):
-    default(msg, 2, Fore.YELLOW + 'Warn ')
+    default(msg, 2)
 
 # Log level 1 (Error)
 def err(msg):
-    default(msg, 1, Fore.RED + 'Error')
+    default(msg, 1)
 
 if __name__ == '__main__':
     debug('Test debug')
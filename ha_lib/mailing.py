@@ -1,27 +1,158 @@
 import smtplib
 import json
 import os
+import re
+import queue
+import string
+import threading
+from concurrent.futures import Future
 from datetime import datetime
-from . import processor, logger, interface
+from . import processor, logger, interface, forecast
 import asyncio
 
+# The thread that sends all E-Mails
+mailer = None
+
+# If mailing works, the thresholds are rules in the rules module
+enabled = False
+
+# The E-Mail template and the modification time of the file it was read from
+# The file is only read again when it has been changed
+template = None
+template_mtime = None
+
+# Names that can be used in the E-Mail template
+FIELDS = {'user', 'rx_int', 'rx_unit', 'tx_int', 'tx_unit', 'tt_int', 'tt_unit', 'time', 'date', 'forecast'}
+
+# The body of a template that is a whole HTML document, E-Mails that are send together share the rest of it
+BODY = re.compile(r'(<body[^>]*>)(.*)(</body>)', re.IGNORECASE | re.DOTALL)
+
+
+class Mailer(threading.Thread):
+    """Thread that sends the E-Mails so the event loop never waits for the smtp server.
+
+    The smtp session is kept open between E-Mails and closed after it has been idle for a while.
+    E-Mails that are queued shortly after each other are send together as one E-Mail.
+    The template is read and filled in here as well, so the event loop never waits for the disk.
+
+    Args:
+        idle_timeout: seconds an unused session is kept open.
+        batch_delay: seconds to wait for more E-Mails before sending.
+    """
+
+    def __init__(self, idle_timeout=60, batch_delay=5):
+        super().__init__(name='mailer', daemon=True)
+        self.idle_timeout = idle_timeout
+        self.batch_delay = batch_delay
+        self.requests = queue.Queue()
+        self.server = None
+
+    def submit(self, values):
+        """Queue an E-Mail to be send.
+
+        Args:
+            values: the names of the template and their values.
+        Returns:
+            A future that is True when the E-Mail has been send.
+        """
+        future = Future()
+        self.requests.put((values, future))
+        return future
+
+    def stop(self):
+        """Send the queued E-Mails, close the session and wait until the thread stopped"""
+        self.requests.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            # Close the session when nothing has to be send for a while
+            try:
+                request = self.requests.get(timeout=self.idle_timeout if self.server else None)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            if request is None:
+                self.disconnect()
+                return
+
+            # Collect the E-Mails that are queued during the batch delay
+            batch = [request]
+            stopping = False
+            while True:
+                try:
+                    request = self.requests.get(timeout=self.batch_delay)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            # E-Mails whose sender stopped waiting are left out, the others can't be cancelled anymore
+            batch = [(values, future) for values, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                sent = self.render_and_send([values for values, _ in batch])
+                for _, future in batch:
+                    future.set_result(sent)
+            if stopping:
+                self.disconnect()
+                return
+
+    def render_and_send(self, batch):
+        # Fill in the template for every E-Mail and send them as one
+        try:
+            message = merge([format_email(values) for values in batch])
+        except (OSError, KeyError, ValueError) as e:
+            logger.err(f'Can\'t fill in the E-Mail template: {e}')
+            return False
+        return self.send(message)
+
+    def send(self, message):
+        # Send an E-Mail with the open session and reconnect once when the server closed it
+        for attempt in range(2):
+            if self.server is None:
+                self.server = connect_to_smtp()
+                if not login_to_smtp(self.server):
+                    self.disconnect()
+                    return False
+            try:
+                send_email(self.server, message)
+                return True
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+            except (smtplib.SMTPException, OSError):
+                self.disconnect()
+                return False
+        return False
+
+    def disconnect(self):
+        # Close the smtp session when there is one
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+
 def enable():
     # TODO add better documentation
     # Check if module is enabled
-    if not processor.config.getboolean('EMAIL', 'enabled'):
+    global enabled
+    if not processor.settings.email.enabled:
         return
 
-    file = processor.config.get('EMAIL', 'file')
+    file = processor.settings.email.file
 
     # Check if email file exists
     if not os.path.isfile(file):
-        processor.config.set('EMAIL', 'enabled', 'False')
         logger.err(f'Email template "{file}" doesnt exist')
         return
 
     # Check read access on file
     if not os.access(file, os.R_OK):
-        processor.config.set('EMAIL', 'enabled', 'False')
         logger.err(f'No read access on "{file}"')
         return
 
@@ -30,39 +161,58 @@ def enable():
     try:
         format_email()
     except Exception as e:
-        processor.config.set('EMAIL', 'enabled', 'False')
-        print(e)
-        logger.err('E-Mail formatter crashes')
+        logger.err(f'E-Mail formatter crashes: {e}')
+        return
 
     # Connect to the SMTP server
     server = connect_to_smtp(enable_run=True)
     if server is None:
         return
 
-    # Don't login when login is disabled
-    if not processor.config.getboolean('EMAIL', 'login'):
+    # Login in the mailing server when login is enabled
+    if not login_to_smtp(server, enable_run=True):
         server.quit()
-        logger.debug('Mailing loaded')
         return
-
-    # Login in the mailing server
-    login_to_smtp(server, enable_run=True)
     server.quit()
 
-    threshold = processor.config.get('EMAIL', 'NotificationThreshold')
-    processor.config.set('EMAIL', 'OGNotificationThreshold', threshold)
+    enabled = True
 
+    start_mailer()
     logger.debug('Mailing loaded')
 
 
+def start_mailer():
+    # Start the thread that sends the E-Mails
+    global mailer
+    mailer = Mailer(processor.settings.email.idle_timeout, processor.settings.email.batch_delay)
+    mailer.start()
+
+
+def close():
+    # Send the queued E-Mails and stop the mailer thread
+    global mailer
+    if mailer is not None:
+        mailer.stop()
+        mailer = None
+
+
+async def notify(values):
+    """Send an E-Mail in the mailer thread
+
+    Args:
+        values: the names of the template and their values, from collect_values.
+    Returns:
+        True when the E-Mail has been send.
+    """
+    return await asyncio.wrap_future(mailer.submit(values))
+
+
 def connect_to_smtp(enable_run=False):
     # Here we try to connect to the smtp server based on the settings set in the config file
 
     # First we start by receiving connection information from the config file
-    host = processor.config.get('EMAIL', 'host')
-    port = processor.config.get('EMAIL', 'port')
-    ssl = processor.config.getboolean('EMAIL', 'ssl')
-    timeout = processor.config.getint('EMAIL', 'timeout')
+    settings = processor.settings.email
+    host, port, ssl, timeout = settings.host, settings.port, settings.ssl, settings.timeout
 
     # Then we enter a safe environment to catch any unexpected errors
     try:
@@ -73,12 +223,11 @@ def connect_to_smtp(enable_run=False):
         # Looks like SSL is not enabled so we connect to the smtp server without it
         return smtplib.SMTP(host, port, timeout=timeout)
 
-    except:
+    except (smtplib.SMTPException, OSError):
         # Now we need to process any unexpected errors
         # First we check if this run was an enable run because we need to shutdown the module when there are any errors in the enable run
         if enable_run:
             logger.err('Can\'t connect to the smtp server')
-            processor.config.set('EMAIL', 'enabled', 'False')
         else:
             # Looks like it isn't an enable run so we just print a warn message
             logger.warn('Couldn\'t connect to the smtp server')
@@ -92,13 +241,13 @@ def login_to_smtp(server, enable_run=False):
         return False
 
     # Now we check if logging is in enabled and return true when it is not enabled
-    if not processor.config.getboolean('EMAIL', 'login'):
+    if not processor.settings.email.login:
         return True
 
     # Looks like we need to login into the smtp server
     # So we need to get gather our credential information from the config file
-    username = processor.config.get('EMAIL', 'username')
-    password = processor.config.get('EMAIL', 'password')
+    username = processor.settings.email.username
+    password = processor.settings.email.password
 
     # Enter the safe environment once again because logging in could fail
     try:
@@ -106,12 +255,11 @@ def login_to_smtp(server, enable_run=False):
         # Looks like logging in is successful so we need to return our great news
         return True
 
-    except:
+    except (smtplib.SMTPException, OSError):
         # An error occurred so we need to handle it
         # We first check if this is an enable run because we need to shutdown the module when there are any errors
         if enable_run:
             logger.err('Can\'t login in the smtp server')
-            processor.config.set('EMAIL', 'enabled', 'False')
             return False
         else:
 
@@ -120,8 +268,9 @@ def login_to_smtp(server, enable_run=False):
             return False
 
 
-def format_email():
-    # This the function where we format all our information in the E-mail HTML file
+def collect_values():
+    # This is the function where we collect all the information we want to show in the E-Mail
+    # It reads the totals of the processor, so it runs in the event loop right when the threshold is passed
 
     # First we get our network usage from the processor
     rx = processor.total_rx
@@ -135,23 +284,9 @@ def format_email():
     # We capture our timestamp for later formatting
     now = datetime.now()
 
-    # Now we are at the part where we actually read the file
-    # We start by receiving the path of the file
-    path = processor.config.get('EMAIL', 'file')
-
-    # Now we open the file in read only mode
-    f = open(path, 'r')
-
-    # After opening it we want to read all lines in the E-Mail file and convert all the lines in 1 big piece of text
-    content = f.readlines()
-    content = '\n'.join(x.strip() for x in content)
-
-    # Now we don't need the file anymore so we close it
-    f.close()
-
     # This is where we set all our information we want to format into the E-Mail
-    values = {
-        'user': processor.config.get('EMAIL', 'clientname'),
+    return {
+        'user': processor.settings.email.client_name,
         'rx_int': rx_int,
         'rx_unit': rx_unit,
         'tx_int': tx_int,
@@ -159,101 +294,112 @@ def format_email():
         'tt_int': tt_int,
         'tt_unit': tt_unit,
         'time': now.strftime('%H:%M:%S'),
-        'date': now.strftime('%d %B %Y')
+        'date': now.strftime('%d %B %Y'),
+        'forecast': format_projection(forecast.get())
     }
 
-    # At last we format all the information into the E-Mail and return it for later use
-    return content.format(**values)
+
+def format_email(values=None):
+    """Fill in the E-Mail template, the template is only read when the file changed since the last time
+
+    Args:
+        values: the names of the template and their values, the current ones when None.
+    Returns:
+        The HTML of the E-Mail.
+    """
+    content = load_template(processor.settings.email.file)
+    return content.format(**(values or collect_values()))
+
+
+def merge(messages):
+    """Turn E-Mails that are send together into one HTML document
+
+    A template that is a whole document keeps the rest of the newest E-Mail with the body of each E-Mail in it,
+    the other templates are a part of a body by themselves.
+
+    Args:
+        messages: the HTML of each E-Mail, oldest first.
+    Returns:
+        The HTML of the E-Mail that is send.
+    """
+    if len(messages) == 1:
+        return messages[0]
+    matches = [BODY.search(message) for message in messages]
+    sections = '<hr>'.join(f'<div>{message if match is None else match.group(2)}</div>'
+                           for message, match in zip(messages, matches))
+    if matches[-1] is None:
+        return sections
+    return messages[-1][:matches[-1].start(2)] + sections + messages[-1][matches[-1].end(2):]
+
+
+def format_projection(projection):
+    # The expected usage at the end of the month with its confidence band
+    if projection is None:
+        return 'Not enough days yet'
+    values = [interface.byte_formatter(value) for value in projection]
+    (fc_int, fc_unit), (low_int, low_unit), (high_int, high_unit) = values
+    return f'{fc_int:.2F}{fc_unit.strip()} ({low_int:.2F}{low_unit.strip()} - {high_int:.2F}{high_unit.strip()})'
+
+
+def load_template(path):
+    """Receive the E-Mail template and read it again only when the file has been changed
+
+    Args:
+        path: path of the template file.
+    Returns:
+        The template with the lines stripped and joined.
+    Raises:
+        KeyError: the template uses a name that can't be formatted.
+    """
+    global template, template_mtime
+    mtime = os.stat(path).st_mtime_ns
+    if template is not None and mtime == template_mtime:
+        return template
+
+    # Read all lines in the E-Mail file and convert all the lines in 1 big piece of text
+    with open(path, 'r') as f:
+        content = '\n'.join(x.strip() for x in f)
+
+    # Check the names once here instead of finding out while sending
+    for _, name, _, _ in string.Formatter().parse(content):
+        if name is not None and name not in FIELDS:
+            raise KeyError(f'Unknown name "{name}" in the E-Mail template')
+
+    template, template_mtime = content, mtime
+    return template
 
 
 def send_email(server, message):
     # This is the function who will add headers to the email and send the email
 
     # Get information for the headers from the config file
-    sender = processor.config.get('EMAIL', 'username')
-    receiver = processor.config.get('EMAIL', 'emailreceiver')
-    subject = processor.config.get('EMAIL', 'subject')
+    settings = processor.settings.email
+    sender, receiver, subject = settings.username, settings.receiver, settings.subject
 
-    try:
-        # Now we format our just gathered information + the message into one big message
-        email = f'From: {sender}\nTo: {receiver}\nMIME-Version:1.0\nContent-type:text/html\nSubject: {subject}\n{message}'
+    # Now we format our just gathered information + the message into one big message
+    email = f'From: {sender}\nTo: {receiver}\nMIME-Version:1.0\nContent-type:text/html\nSubject: {subject}\n{message}'
 
-        # The last thing we have to do is send the E-Mail to the person who should receive it and return our sucess
-        server.sendmail(sender, receiver, email)
-        return True
+    # The last thing we have to do is send the E-Mail to the person who should receive it
+    # Errors are raised so the mailer can reconnect when the server closed the session
+    server.sendmail(sender, receiver, email)
 
-    except:
-        # Even just sending an E-Mail could go wrong
-        return False
+async def send_notification():
+    # Send the E-Mail with the current usage, the rules call this when a notification threshold is passed
 
-async def loop():
-    # This is the function who will handle automated emails.
+    # Now we start by preparing the E-Mail.
+    # We collect the information now, the mailer thread formats it into the template.
+    values = collect_values()
 
-    # We first start by checking if this module is enabled.
-    if not processor.config.getboolean('EMAIL', 'enabled'):
-        return
+    # Message the user about the current status
+    logger.debug('Sending threshold E-Mail..')
 
-    # Receive the interval at what we should check if we reached the treshold.
-    interval = processor.config.getint('EMAIL', 'checkinterval')
+    # Now we try to send the E-Mail and check if it is working
+    # The mailer thread connects and logs in when there is no open session
+    if not await notify(values):
 
-    # Don't do any checks if the number is below 5 because that will be too many checks and it could overflow the system.
-    if interval < 6:
+        # Looks like we can't send an E-Mail we should let the user know that we can't do that
+        logger.warn('Couldn\'t send the threshold E-Mail')
         return
 
-    while True:
-
-        # Wait for a couple of seconds because we don't want to check too fast because that is unnecessary.
-        await asyncio.sleep(interval)
-
-        # Receive the threshold value from the config file -1 one means that the threshold is disabled.
-        threshold = processor.config.getint('EMAIL', 'NotificationThreshold')
-        if threshold > 0:
-            continue
-
-        # Receive the amount of received and send bytes and and them together.
-        total = processor.total_rx + processor.total_tx
-
-        # Check if the total amount of network usage is more than the threshold.
-        # Don't execute any other processing when it doesn't reach the threshold.
-        if total < threshold:
-            continue
-
-        # Try to connect to the smtp server with the information stored in the config file.
-        server = connect_to_smtp()
-
-        # Now we try to login in the smtp server.
-        # And print an warning message when it doesn't can't login into the smtp server.
-        if not login_to_smtp(server):
-            logger.warn(
-                'There is an error with the mailing system. please run diagnostics')
-            continue
-
-        # Now we start by preparing the E-Mail.
-        # We first start by formatting all information into the email and store that as a variable.
-        email = format_email()
-
-        # Message the user about the current status
-        logger.debug('Sending threshold E-Mail..')
-
-        # Now we try to send the E-Mail and check if it is working
-        if not send_email(server, email):
-
-            # Looks like we can't send an E-Mail we should let the user know that we can't do that
-            logger.warn('Couldn\'t send the threshold E-Mail')
-            continue
-
-        # Looks like our email send! Now we need to let need to let our user in the console now
-        logger.log('Threshold E-Mail send!')
-
-        # Update settings when the email is send.
-        if processor.config.getboolean('EMAIL', 'resetaftertrigger'):
-            
-            # Double the threshold and message the user about the update
-            processor.config.set('EMAIL', 'NotificationThreshold', threshold*2)
-            logger.debug('E-Mail notification threshold has been resetted')
-            return
-
-        # Disable any future notification E-Mails and log it to the user
-        logger.debug('Disabled any further E-Mail notifications')
-        processor.config.set('EMAIL', 'NotificationThreshold', -1)
-
+    # Looks like our email send! Now we need to let need to let our user in the console now
+    logger.log('Threshold E-Mail send!')
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that exposes the state of the program in the Prometheus text format
+
+The metrics are read from memory, a scrape never queries the database.
+The text is made of fixed parts that are built once, only the values are filled in on each scrape.
+"""
+
+import math
+from . import processor, database, mqtt, stats, logger, rules, forecast
+
+class Summary:
+    """Duration of a repeating piece of work, exposed as Prometheus summary without quantiles"""
+
+    def __init__(self):
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+
+    def observe(self, seconds):
+        self.sum += seconds
+        self.count += 1
+        self.last = seconds
+
+
+class Exposition:
+    """Text of the metrics where each value has its own place in a preallocated list of parts.
+
+    Rendering only replaces the values and joins the parts, so a scrape doesn't build any other text.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.values = []
+
+    def family(self, name, kind, description):
+        """Start a metric family with its help and type lines"""
+        self.parts.append(f'# HELP {name} {description}\n# TYPE {name} {kind}\n')
+
+    def sample(self, name, value, **labels):
+        """Add a sample of the current family.
+
+        Args:
+            name: name of the sample.
+            value: function that returns the current value.
+            labels: labels of the sample.
+        """
+        label_text = ','.join(f'{key}="{escape(text)}"' for key, text in labels.items())
+        self.parts.append(f'{name}{{{label_text}}} ' if labels else f'{name} ')
+        self.values.append((len(self.parts), value))
+        self.parts.append('')
+        self.parts.append('\n')
+
+    def render(self):
+        """Fill in the current values and return the text"""
+        parts = self.parts
+        for index, value in self.values:
+            parts[index] = number(value())
+        return ''.join(parts)
+
+
+# Durations of the work that is timed
+tick = Summary()
+flush = Summary()
+
+# Bytes received and send by each interface since the program started, this never resets
+received, send = {}, {}
+
+# Amount of measurements that were skipped because a measurement took too long
+skipped = 0
+
+# Seconds from the start of the program until the counters were read for the first time
+first_sample = None
+
+# The text of the metrics, made when it is scraped the first time, and the rules it was made with
+exposition = None
+exposition_rules = None
+
+
+def escape(text):
+    # Escape a label value like the text format requires
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    # Format a value, unknown values are NaN
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def enable():
+    # Start counting the bytes of every interface
+    for name in processor.settings.network.names:
+        received[name] = send[name] = 0
+
+
+def update(sample):
+    # Count the bytes of a measurement
+    for name, (rx, tx) in sample.deltas.items():
+        received[name] += rx
+        send[name] += tx
+
+
+def build():
+    """Make the exposition of all metrics of the interfaces that are monitored"""
+    names = processor.settings.network.names
+    text = Exposition()
+
+    text.family('gateway_received_bytes_total', 'counter', 'Bytes received since the program started.')
+    for name in names:
+        text.sample('gateway_received_bytes_total', lambda name=name: received[name], interface=name)
+    text.family('gateway_send_bytes_total', 'counter', 'Bytes send since the program started.')
+    for name in names:
+        text.sample('gateway_send_bytes_total', lambda name=name: send[name], interface=name)
+
+    # The monthly totals start at zero every month, Prometheus handles that as a counter reset
+    text.family('gateway_month_received_bytes_total', 'counter', 'Bytes received this month.')
+    for name in names:
+        text.sample('gateway_month_received_bytes_total',
+                    lambda name=name: processor.totals.get(name, (0, 0))[0], interface=name)
+    text.sample('gateway_month_received_bytes_total', lambda: processor.total_rx, interface='all')
+    text.family('gateway_month_send_bytes_total', 'counter', 'Bytes send this month.')
+    for name in names:
+        text.sample('gateway_month_send_bytes_total',
+                    lambda name=name: processor.totals.get(name, (0, 0))[1], interface=name)
+    text.sample('gateway_month_send_bytes_total', lambda: processor.total_tx, interface='all')
+
+    # All samples of a family must be together, so the rates are walked through twice
+    rates = [('all' if name is None else name, direction, stats.get(name)[index])
+             for name in names + [None] for direction, index in (('received', 0), ('send', 1))]
+    text.family('gateway_rate_bytes_per_second', 'gauge', 'Bytes per second of the last measurement.')
+    for label, direction, rate in rates:
+        text.sample('gateway_rate_bytes_per_second', lambda rate=rate: rate.rate,
+                    interface=label, direction=direction)
+    text.family('gateway_average_rate_bytes_per_second', 'gauge',
+                'Exponentially weighted average of bytes per second.')
+    for label, direction, rate in rates:
+        for i, horizon in enumerate(rate.horizons):
+            text.sample('gateway_average_rate_bytes_per_second', lambda rate=rate, i=i: rate.averages[i],
+                        interface=label, direction=direction, horizon=f'{horizon:g}')
+
+    text.family('gateway_forecast_bytes', 'gauge', 'Expected total at the end of the month and its confidence band.')
+    for name in names + [None]:
+        for bound in forecast.Projection._fields:
+            text.sample('gateway_forecast_bytes', lambda name=name, bound=bound: projection(name, bound),
+                        interface='all' if name is None else name, bound=bound)
+
+    # The exposition is made again when the rules change, see render
+    text.family('gateway_rule_threshold', 'gauge', 'Value at which a rule fires.')
+    for rule in processor.settings.rules:
+        text.sample('gateway_rule_threshold', lambda rule=rule: rule.threshold, rule=rule.name, metric=rule.metric,
+                    interface=rule.interface, action=rule.action)
+    text.family('gateway_rule_armed', 'gauge', '1 when a rule fires once its threshold is passed.')
+    for rule in processor.settings.rules:
+        text.sample('gateway_rule_armed', lambda name=rule.name: rule_state(name, 'armed'), rule=rule.name)
+    text.family('gateway_rule_fired_total', 'counter', 'Times the action of a rule ran.')
+    for rule in processor.settings.rules:
+        text.sample('gateway_rule_fired_total', lambda name=rule.name: rule_state(name, 'count'), rule=rule.name)
+
+    text.family('gateway_tick_duration_seconds', 'summary', 'Time a measurement took.')
+    text.sample('gateway_tick_duration_seconds_sum', lambda: tick.sum)
+    text.sample('gateway_tick_duration_seconds_count', lambda: tick.count)
+    text.family('gateway_first_sample_seconds', 'gauge', 'Seconds from the start until the first reading.')
+    text.sample('gateway_first_sample_seconds', lambda: first_sample)
+    text.family('gateway_skipped_ticks_total', 'counter', 'Measurements skipped because the previous took too long.')
+    text.sample('gateway_skipped_ticks_total', lambda: skipped)
+    text.family('gateway_database_flush_seconds', 'summary', 'Time writing the buffered rows to the database took.')
+    text.sample('gateway_database_flush_seconds_sum', lambda: flush.sum)
+    text.sample('gateway_database_flush_seconds_count', lambda: flush.count)
+    text.family('gateway_database_buffered_rows', 'gauge', 'Rows waiting to be written to the database.')
+    text.sample('gateway_database_buffered_rows', lambda: len(database.buffer))
+
+    text.family('gateway_mqtt_connected', 'gauge', '1 when the MQTT server is connected.')
+    text.sample('gateway_mqtt_connected', lambda: mqtt.client is not None and mqtt.client.is_connected())
+    text.family('gateway_mqtt_published_total', 'counter', 'Messages handed over to the MQTT server.')
+    text.sample('gateway_mqtt_published_total', lambda: mqtt.client.published if mqtt.client else 0)
+    text.family('gateway_mqtt_failures_total', 'counter', 'Messages the MQTT client couldn\'t publish.')
+    text.sample('gateway_mqtt_failures_total', lambda: mqtt.client.failed if mqtt.client else 0)
+    text.family('gateway_mqtt_dropped_total', 'counter', 'Queued values dropped because the queue was full.')
+    text.sample('gateway_mqtt_dropped_total', lambda: mqtt.dropped)
+    text.family('gateway_mqtt_queue_depth', 'gauge', 'Values waiting for the MQTT connection to come back.')
+    text.sample('gateway_mqtt_queue_depth', lambda: len(mqtt.offline))
+    text.family('gateway_mqtt_in_flight', 'gauge', 'Published messages the server hasn\'t confirmed yet.')
+    text.sample('gateway_mqtt_in_flight', lambda: mqtt.client.in_flight() if mqtt.client else 0)
+
+    text.family('gateway_log_queue_depth', 'gauge', 'Log messages waiting to be written.')
+    text.sample('gateway_log_queue_depth', lambda: logger.records.qsize())
+    text.family('gateway_log_dropped_total', 'counter', 'Messages dropped because logging was too slow.')
+    text.sample('gateway_log_dropped_total', lambda: logger.dropped_total)
+    return text
+
+
+def projection(name, bound):
+    # A bound of the projection of this month, unknown until there are enough days
+    result = forecast.get(name)
+    return None if result is None else getattr(result, bound)
+
+
+def rule_state(name, attribute):
+    # The state of a rule, the rules are only made after the first measurement
+    rule = rules.get(name)
+    if rule is None:
+        return attribute == 'armed'
+    return getattr(rule, attribute)
+
+
+def render():
+    """Receive the text of all metrics"""
+    global exposition, exposition_rules
+    if exposition is None or exposition_rules is not processor.settings.rules:
+        exposition = build()
+        exposition_rules = processor.settings.rules
+    return exposition.render()
@@ -1,109 +1,292 @@
-from Adafruit_IO import MQTTClient as mqtt
-from subprocess import Popen, PIPE
-from . import logger, processor, database
-import sqlite3
-import os.path
-import struct
+from collections import OrderedDict
+from . import logger, processor, database, executor, transport, stats, forecast, conntrack
+import asyncio
+import json
 import time
-import sys
 
+# The transport that sends our values to the MQTT server, None when MQTT is disabled
 client = None
 
+# State of every feed that has been published, the key is the path of the feed
+feeds = {}
+
+# Feeds that have a value waiting because they were published too recently
+pending = set()
+
+# Latest value of each feed that couldn't be send because the connection was down
+# The oldest feed is dropped when the queue is full
+offline = OrderedDict()
+dropped = 0
+
+# Read of the conntrack table whose hosts have been published
+talkers_scan = 0
+
+
+class Feed:
+    """Decide when a new value of a feed should be published.
+
+    A value is only published when it differs more than the dead-band from the last published value,
+    or when the last publish is max_interval seconds ago.
+    Values are never published faster than min_interval, in that case only the latest value is kept.
+
+    Args:
+        path: path of the feed.
+        settings: the dead-band, min_interval and max_interval of the feed.
+            A max_interval of 0 only publishes changes.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.value = None
+        self.published_at = None
+        self.pending = None
+
+    def offer(self, value, now):
+        """Offer a new value of the feed.
+
+        Args:
+            value: the new value.
+            now: the current monotonic time.
+        Returns:
+            The value when it should be published right away, otherwise None.
+        """
+        if self.published_at is not None:
+            age = now - self.published_at
+            settings = self.settings
+            unchanged = abs(value - self.value) <= settings.deadband
+            if unchanged and (settings.max_interval <= 0 or age < settings.max_interval):
+                self.pending = None
+                return None
+            if age < settings.min_interval:
+                self.pending = value
+                return None
+
+        self.pending = None
+        return value
+
+    def due(self, now):
+        """Receive the waiting value when it may be published now, otherwise None"""
+        if self.pending is None or now - self.published_at < self.settings.min_interval:
+            return None
+        value, self.pending = self.pending, None
+        return value
+
+    def published(self, value, now):
+        """Remember the value that has been published"""
+        self.value = value
+        self.published_at = now
+
+
 def enable():
     global client
     # Check if MQTT is enabled
-    config = processor.config
-    if not config.getboolean('MQTT', 'enabled'):
+    settings = processor.settings
+    if not settings.mqtt.enabled:
         return
 
-    # Create client and set username and key
-    client = mqtt(config.get('MQTT', 'username'), config.get('MQTT', 'key'))
-
-    # Connect to the server
-    try:
-        keepalive = config.getint('MQTT', 'keepalive')
-        client.connect(keepalive=keepalive)
-    except:
-        config.set('MQTT', 'enabled', 'False')
-        logger.err('Can\'t login into MQTT server')
-        sys.exit(0)
-    logger.debug('MQTT enabled')
+    # Create the transport set in the config file
+    client = transport.from_settings(settings.mqtt)
 
     # Enable mqtt numpad
-    if config.getboolean('MQTTNUMPAD', 'enabled'):
+    if settings.numpad.enabled:
         # Set handlers for mqtt numpad
-        client.on_connect = on_connect
         client.on_message = on_message
-        client.on_disconnect = on_disconnect
-        client.loop_background()
+        client.subscribe(settings.numpad.subscribe_path)
+        logger.debug('MSQTTNumpad loaded')
+
+    # Connect in the background, values are queued until the connection is there
+    # The transport reconnects by itself when the connection drops
+    client.connect()
+    logger.debug('MQTT enabled')
+
+
+def close():
+    # Disconnect from the MQTT server
+    if client is not None:
+        client.close()
 
 
-def update_data(rx, tx, tt):
+def update_data(sample):
     # Check if MQTT is enabled
-    cfg = processor.config
-    if not cfg.getboolean('MQTT', 'enabled'):
+    if client is None:
         return
+    deltas, totals = sample.deltas, sample.totals
+
+    # Receive today's starting values from the database cache
+    start_values = database.get_start_values()
+
+    # Send the values of each interface to their own feeds when there are multiple interfaces
+    if len(totals) > 1:
+        for name in totals:
+            publish_usage(deltas[name], totals[name], start_values.get(name), sample.elapsed,
+                          stats.get(name), forecast.get(name), sample.monotonic, f'-{name}')
+
+    # Send the sum of all interfaces to the main feeds
+    delta = tuple(map(sum, zip(*deltas.values())))
+    total = tuple(map(sum, zip(*totals.values())))
+    start = None
+    if len(start_values) == len(totals):
+        start = tuple(map(sum, zip(*start_values.values())))
+    publish_usage(delta, total, start, sample.elapsed, stats.get(), forecast.get(), sample.monotonic)
+
+    # Send the hosts that used the most after every read of the conntrack table
+    publish_talkers(sample.monotonic)
+
+    # Send values that were held back because they changed too fast
+    publish_pending(sample.monotonic)
+
 
-    # Convert values to mbits/s
-    delay = cfg.getint('NETWORK', 'MeasureDelay')
-    rx = rx / 125000.0 / delay
-    tx = tx / 125000.0 / delay
-    tt = tt / 1000000.0
+def publish_usage(delta, total, start, elapsed, rates, projection, now, suffix=''):
+    """Publish the usage of an interface
+
+    Args:
+        delta: received and send bytes since the last measurement.
+        total: total received and send bytes.
+        start: received and send bytes at the start of today, None when unknown.
+        elapsed: seconds since the last measurement.
+        rates: statistics of the received and send rate.
+        projection: the expected total at the end of the month, None when there is none yet.
+        now: monotonic time of the measurement.
+        suffix: text added after the name of each feed.
+    """
+    # Convert values to mbits/s using the time that actually passed between the measurements
+    # There is no rate yet when no time passed, the negative value isn't published
+    rx = delta[0] / 125000.0 / elapsed if elapsed > 0 else -1
+    tx = delta[1] / 125000.0 / elapsed if elapsed > 0 else -1
+    tt = (total[0] + total[1]) / 1000000.0
     tt_today = -1
 
     # Calculate today's usage based on values in the database
-    # This function doesnt work when the database option is disabled
-    start_values = database.get_start_value()
-    if start_values[0] != 0:
-        tt_today =  tt-((start_values[0]+ start_values[1]) / 1000000.0)
+    if start is not None:
+        tt_today = tt-((start[0] + start[1]) / 1000000.0)
 
     # Send values
-    try_update_data('recievepath',rx)
-    try_update_data('sendpath',tx)
-    try_update_data('recieveplussendpath',rx+tx)
-    try_update_data('totalnetworkusagepath',tt)
-    try_update_data('todaynetworkusagepath', tt_today)
+    try_update_data('recievepath', rx, suffix, now)
+    try_update_data('sendpath', tx, suffix, now)
+    try_update_data('recieveplussendpath', rx + tx if elapsed > 0 else -1, suffix, now)
+    try_update_data('totalnetworkusagepath', tt, suffix, now)
+    try_update_data('todaynetworkusagepath', tt_today, suffix, now)
 
-def try_update_data(nick, data):
-    global client
+    # Send the average of the shortest horizon, which is calmer than the rate of a single measurement
+    # The averages are None until the statistics have seen a measurement
+    rx_stats, tx_stats = rates
+    if rx_stats.averages[0] is not None:
+        try_update_data('recieveaveragepath', rx_stats.averages[0] / 125000.0, suffix, now)
+    if tx_stats.averages[0] is not None:
+        try_update_data('sendaveragepath', tx_stats.averages[0] / 125000.0, suffix, now)
 
-    # Recieve path from config file
-    path = processor.config.get('MQTT', nick.lower())
+    # The projection of the month in MB like the total
+    if projection is not None:
+        try_update_data('forecastpath', projection.expected / 1000000.0, suffix, now)
+        try_update_data('forecasthighpath', projection.high / 1000000.0, suffix, now)
 
-    # Cancel execution when there is no path found
-    if path is None:
+def try_update_data(nick, data, suffix='', now=None):
+    # Cancel execution when there is no path found in the config file
+    settings = processor.settings.mqtt.feeds.get(nick)
+    if settings is None:
         return
 
     # Don't publish anything when the data is negative
     if 0 > data:
         return
 
-    # Publish data on specified path
+    # Find the feed or create it when it is published for the first time
+    # The feed keeps its last value when the config file is reloaded, only its settings change
+    path = settings.path + suffix
+    feed = feeds.get(path)
+    if feed is None:
+        feed = feeds[path] = Feed(path, settings)
+    feed.settings = settings
+
     # Round values to 2 digits
-    client.publish(path,round(data,2))
+    if now is None:
+        now = time.monotonic()
+    value = feed.offer(round(data, 2), now)
+    if value is None:
+        if feed.pending is not None:
+            pending.add(feed)
+        return
+    pending.discard(feed)
+    publish(feed, value, now)
 
-# Some nice disconnect message
-def on_disconnect(client):
-    logger.warn('MQTT disconnected!')
+def publish_talkers(now):
+    # The hosts are send as a JSON list with the address, received and send MB and error of each host
+    # This doesn't go through the dead-band because it isn't a single number
+    global talkers_scan
+    settings = processor.settings.mqtt.feeds.get('toptalkerspath')
+    if settings is None or talkers_scan == conntrack.scans:
+        return
+    talkers_scan = conntrack.scans
+    feed = feeds.get(settings.path)
+    if feed is None:
+        feed = feeds[settings.path] = Feed(settings.path, settings)
+    talkers = [{'address': address, 'received': round(received / 1000000.0, 2), 'send': round(send / 1000000.0, 2),
+                'error': round(error / 1000000.0, 2)} for address, received, send, error in conntrack.top()]
+    publish(feed, json.dumps(talkers), now)
+
+def publish_pending(now):
+    # Publish the waiting values of feeds that may be published again
+    for feed in list(pending):
+        value = feed.due(now)
+        if value is not None:
+            pending.discard(feed)
+            publish(feed, value, now)
+        elif feed.pending is None:
+            pending.discard(feed)
 
+def publish(feed, value, now):
+    # Publish data on specified path or keep it for later when the connection is down
+    global dropped
+    feed.published(value, now)
+    if not send(feed.path, value):
+        offline[feed.path] = value
+        offline.move_to_end(feed.path)
+        if len(offline) > processor.settings.mqtt.queue_size:
+            offline.popitem(last=False)
+            dropped += 1
 
-def on_connect(client):
-    # Subscribe on the numpad
-    client.subscribe(processor.config.get('MQTTNUMPAD', 'subcribepath'))
-    logger.debug('MSQTTNumpad loaded')
+def send(path, value):
+    # Hand a value over to the transport and return if it worked
+    # This never waits for the server
+    if not client.is_connected():
+        return False
+    return client.publish(path, value)
+
+async def loop():
+    # Send the values that were kept while the connection was down
+    # A few values are send at a time and the delay doubles when sending fails so a bad connection doesn't take over
+    if client is None:
+        return
+    delay = processor.settings.mqtt.drain_delay
+    while True:
+        await asyncio.sleep(delay)
+        if not offline or not client.is_connected():
+            continue
 
+        settings = processor.settings.mqtt
+        for _ in range(min(settings.drain_batch, len(offline))):
+            path, value = offline.popitem(last=False)
+            if not send(path, value):
+                # Put it back in front and try again later
+                offline[path] = value
+                offline.move_to_end(path, last=False)
+                delay = min(delay * 2, 60)
+                break
+        else:
+            delay = settings.drain_delay
 
 # Recieve packets from the MQTT server
-def on_message(client, feed_id, payload):
-    
+def on_message(feed_id, payload):
 
     # Check is command is added in the config file
-    if not f'command{payload}' in processor.config['MQTTNUMPAD']:
+    command = processor.settings.numpad.commands.get(payload.lower())
+    if command is None:
         logger.warn(f'Numpad {payload} is pressed but there is no command')
         return
 
     # Execute command when found
+    # This runs in the thread of the MQTT client so the command is handed over to the event loop
     # TODO add more functionality within the application
-    Popen(processor.config.get('MQTTNUMPAD',
-                               f'command{payload}'), shell=True, stdout=PIPE)
+    executor.submit_threadsafe(command)
     logger.debug(f'Numpad {payload} is executed')
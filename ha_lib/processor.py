@@ -1,129 +1,350 @@
 # Author: Arjan de Haan (Vepnar)
 
-from . import logger, database, interface, mailing, mqtt
-from subprocess import Popen, PIPE
+from . import logger, database, interface, mailing, mqtt, scheduler, executor, sampler, stats, api, metrics, rules, forecast, conntrack, checkpoint, settings as settings_module
+from collections import namedtuple
+from concurrent.futures import Future
 from contextlib import suppress
-import configparser
+import threading
 import asyncio
+import signal
+import sys
 import time
 
-# Here we store a global config file. all modules can access this file
-config = None
+# Here we store the settings read from the config file. all modules can access them
+# This is a frozen snapshot, reloading the config file replaces it with a new one
+settings = None
+
+# Path of the config file
+CONFIG_FILE = 'config.cfg'
 
 # Create variables to store the total amount of network usage so the other modules can access it easily
+# The totals of each interface are stored in totals, total_rx and total_tx hold the sum of all interfaces
+totals = {}
 total_rx, total_tx = 0, 0
 
+# The counters of the previous measurement and the monotonic time they were read
+last, last_time = {}, 0
+
+# Monotonic time the program started, the time to the first reading is measured from here
+started = time.monotonic()
+
+# A single measurement of all interfaces
+# monotonic is the time of the measurement on the monotonic clock and elapsed the seconds since the previous measurement
+# Rates should always be calculated with elapsed because the time between two measurements isn't always the same
+# rates holds the peak, mean and 95th percentile rate of each interface when sampling is enabled
+Sample = namedtuple('Sample', ['timestamp', 'monotonic', 'elapsed', 'deltas', 'totals', 'rates'])
+
+def set_totals(new_totals):
+    # Store the totals of each interface and update the sum of all interfaces
+    global totals, total_rx, total_tx
+    totals = new_totals
+    total_rx = sum(rx for rx, _ in totals.values())
+    total_tx = sum(tx for _, tx in totals.values())
+
 async def measure_loop():
-    global total_rx, total_tx
     # This is the actual loop where this program loops trough all its gatherd data and processes it
     # We first start by settings up starting values
+    global last, last_time
 
     # We start by moving our old data to another table.
-    # And receive the total receive and send numbers.
+    # And receive the total receive and send numbers of each interface.
     # Receive and send will be 0 when we are in a month, because we measure network usage per month.
-    total_rx, total_tx = database.get_last_value(0, 0)
+    await database.rollover(int(time.time()))
+    set_totals(database.get_last_values(settings.network.names))
 
-    # Here we receive the amount of data received and send by the interface.
-    # This data is parsed for the ifconfig command and only works on 1 interface.
-    # You can set this up in the config file.
-    last_rx, last_tx = interface.receive_values()
+    # The rules that the restored totals already passed fired before the restart, they don't fire again
+    rules.enable()
+
+    # Here we receive the amount of data received and send by the interfaces.
+    # The counters of all interfaces are read straight from the kernel in one go.
+    # You can set the interfaces up in the config file.
+    last = interface.receive_values()
+    last_time = time.monotonic()
+    metrics.first_sample = last_time - started
+    logger.debug(f'First reading after {metrics.first_sample:.2f} seconds')
 
     # Here we get the delay between each measurement this delay is stored in the config.
-    delay = config.getint('NETWORK', 'measuredelay')
+    # The ticker makes sure we measure at this exact rate no matter how long a measurement takes.
+    ticker = scheduler.Ticker(settings.network.measure_delay)
+
+    # When the program restarted without a reboot the counters of the kernel kept counting while it was gone.
+    # We continue from the counters of the checkpoint so the first measurement adds exactly the bytes we missed.
+    # The whole counter isn't added in that case, that would count everything since the boot twice.
+    resumed = checkpoint.resume(last)
+    if resumed is not None:
+        last, ago = resumed
+        last_time -= ago
+        logger.debug(f'Continuing from the checkpoint of {ago:.0f} seconds ago')
+
+    # A checkpoint that was too old to use still tells this is a restart, the counters since the boot were counted before
+    elif checkpoint.restarted:
+        logger.warn('Restarted without a usable checkpoint, the bytes since the last stored measurement are lost')
 
     # Startonboot is the option that you should enable when this application starts at boot.
     # This application isn't the quickest on the the planet so it could've missed some bytes.
     # That's why this part of the function exists. it adds the missed bytes to the database
-    if config.getboolean('NETWORK', 'startonboot'):
+    elif settings.network.start_on_boot:
 
         # Here we add all potential missed bytes to our total amount of bytes
-        total_rx, total_tx = total_rx + last_rx, total_tx + last_tx
+        set_totals({name: (rx + last[name][0], tx + last[name][1])
+                    for name, (rx, tx) in totals.items()})
 
         # We add our missed information to the database and send a "special=1" value to let the database know that we just booted
         # This could be usefull later on when we are inspecting our data
-        database.add_row(total_rx, total_tx, special=1)
+        await database.add_rows(totals, special=1)
 
         # Here we will print our usage to the user in the terminal
-        interface.print_usage(total_rx, total_tx)
+        print_usage()
 
         # And now we wait for our set delay
-        await asyncio.sleep(delay)
+        await ticker.wait()
 
     # This is the infinite loop were we all waited for
     while(True):
 
-        # First we start by capturing new data from our dear interface
-        new_rx, new_tx = interface.receive_values()
+        # First we start by capturing new data from our dear interfaces
+        # We also store when we captured it so we know how much time there was between the measurements
+        now = time.monotonic()
+        await measure(interface.receive_values(), now, int(time.time()))
+
+        # Write the counters and totals to the checkpoint once in a while, this happens in the background
+        checkpoint.update(now)
+
+        # And now the last thing!!! We wait until it is time for the next measurement
+        # The delay is read again because it can change when the config file is reloaded
+        metrics.tick.observe(time.monotonic() - now)
+        ticker.interval = settings.network.measure_delay
+        metrics.skipped += await ticker.wait()
 
-        # Now we calculate the difference between our new values and our old values
-        calc_rx, calc_tx = new_rx - last_rx, new_tx - last_tx
+async def measure(new, now, timestamp):
+    """Process a single reading of the counters of all interfaces
 
-        # Set our calculated values on zero when they're negative because negative numbers ain't welcome in our database
-        calc_tx = calc_tx if calc_tx > 0 else 0
-        calc_rx = calc_rx if calc_rx > 0 else 0
+    The clocks are passed in so the benchmark can run the measurements on a simulated clock.
 
-        # After that we add our calculated values and add them to our total network usage.
-        # We send the sum of those values to the database wo checks if there is a new month and check if our counters should be resetted
-        total_rx, total_tx = database.get_last_value(
-            received_bytes=total_rx+calc_rx, send_bytes=total_tx+calc_tx)
-        # Set our new measurements as our old measurements
-        last_rx, last_tx = new_rx, new_tx
-        
+    Args:
+        new: total received and send bytes of each interface.
+        now: monotonic time of the reading.
+        timestamp: unix timestamp of the reading.
+    Returns:
+        The sample of this measurement.
+    """
+    global last, last_time
+    elapsed, last_time = now - last_time, now
 
-        # Add our new total network usage to our database
-        database.add_row(total_rx, total_tx)
+    # Now we calculate the difference between our new values and our old values
+    # This also takes care of counters that wrapped around or have been reset
+    deltas = {}
+    for name, (new_rx, new_tx) in new.items():
+        last_rx, last_tx = last[name]
+        deltas[name] = interface.counter_delta(last_rx, new_rx), interface.counter_delta(last_tx, new_tx)
 
-        # Send our total data and our calculated data to the MQTT module
-        # This will send the data to adafruit so you can see the status of this program from another device
-        mqtt.update_data(calc_rx, calc_tx, total_tx+total_rx)
+    # When a day is over its usage is added to the forecast, before a new month resets the totals
+    if database.day_end and timestamp >= database.day_end:
+        forecast.close_day(database.day_end)
 
-        # There is also an option to disable an interface when we hit an certain threshold
-        interface.check_disabletrigger(total_rx+total_tx)
+    # After that we add our calculated values to our total network usage.
+    # We get the totals from the database cache because it resets them when there is a new month
+    await database.rollover(timestamp)
+    set_totals({name: (rx + deltas[name][0], tx + deltas[name][1])
+                for name, (rx, tx) in database.get_last_values(settings.network.names).items()})
+    # Set our new measurements as our old measurements
+    last = new
 
-        # And almost the last thing we have to do! We print the data to the terminal with some pretty colours
-        interface.print_usage(total_rx, total_tx)
+    # The samples taken since the last measurement show the bursts that happened in between
+    sample = Sample(timestamp, now, elapsed, deltas, totals, sampler.window())
 
-        # And now the last thing!!! We wait a set amount of time before we start this loop again
-        await asyncio.sleep(delay)
+    # Update the running statistics so the other modules can read them right away
+    stats.update(sample)
+    metrics.update(sample)
+
+    # Add our new total network usage to our database
+    await database.add_rows(totals, sample.timestamp, rates=sample.rates)
+
+    # Send our total data and our calculated data to the MQTT module
+    # This will send the data to adafruit so you can see the status of this program from another device
+    mqtt.update_data(sample)
+
+    # Run the actions of the rules whose threshold we just passed, like disabling an interface
+    rules.update(sample)
+
+    # And almost the last thing we have to do! We print the data to the terminal with some pretty colours
+    print_usage()
+    return sample
+
+def print_usage():
+    # Print the usage of each interface and name them when there are multiple
+    # The projection of this month is shown as well once there are enough days to make one
+    if len(totals) == 1:
+        interface.print_usage(total_rx, total_tx, projection=forecast.get())
+        return
+    for name, (rx, tx) in totals.items():
+        interface.print_usage(rx, tx, name, forecast.get(name))
 
 def restart_system():
     # Temponary fix until version 2 is released
     command = 'shutdown -r now'
-    pipe = Popen(command, shell=True, stdout=PIPE)
+    executor.submit(command)
+
+def in_thread(function):
+    """Run a function in a thread of its own and receive its result in the event loop.
+
+    The thread is a daemon, so a step that hangs on the network doesn't keep the program from stopping.
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return asyncio.wrap_future(future)
+
+
+async def enable_step(name, function, loop=None):
+    # Enable a module in a thread and report it when it takes longer than SlowStartWarning
+    # The step isn't given up on, a database that starts without its totals would store lower totals
+    # The loop of the module is started once it is enabled, it stops right away when the module is disabled
+    # A module that fails to enable is logged right away, its loop isn't started
+    step = in_thread(function)
+    timeout = settings.network.slow_start_warning
+    try:
+        try:
+            await asyncio.wait_for(asyncio.shield(step), timeout)
+        except asyncio.TimeoutError:
+            logger.warn(f'Enabling {name} takes longer than {timeout:g} seconds')
+            await step
+    except Exception as e:
+        logger.err(f'Enabling {name} failed: {e}')
+        return
+    if loop is not None:
+        await loop()
+
+
+def enable_storage():
+    # The checkpoint fills the cache before the database opens, so the database doesn't have to search its tables
+    # The forecast and conntrack continue from what is stored, so they wait for the database
+    checkpoint.enable()
+    database.enable()
+    forecast.enable()
+    conntrack.enable()
+
+
+async def run(tasks):
+    """Enable the modules that wait on the disk or the network at the same time and start measuring.
+
+    The database is needed for the totals, so the measurements wait for it.
+    Mailing and MQTT keep getting ready in the background while the measurements run.
+
+    Args:
+        tasks: list the tasks that are started are added to, they are cancelled when the program stops.
+    """
+    # Mailing checks the smtp server and MQTT sends the values that were queued while the connection was down
+    tasks.append(asyncio.ensure_future(enable_step('mailing', mailing.enable)))
+    tasks.append(asyncio.ensure_future(enable_step('MQTT', mqtt.enable, mqtt.loop)))
+    await enable_step('the database', enable_storage)
+
+    # Add our automatic asynchronous data migrator to the asynchronous loop
+    tasks.append(asyncio.ensure_future(database.loop()))
+
+    # Add the task that counts the bytes of each LAN host
+    tasks.append(asyncio.ensure_future(conntrack.loop()))
+
+    # Start the most important part of the loop
+    await measure_loop()
+
+
+def reload():
+    # Read the config file again and swap in the new settings without stopping the measurements
+    # The old settings stay when the new config file is invalid
+    global settings
+    try:
+        new = settings_module.load(CONFIG_FILE)
+    except ValueError as e:
+        logger.err(f'Config not reloaded: {e}')
+        return
+
+    # These settings are only used when the modules start, the others are read when they are needed
+    if new.network.names != settings.network.names or new.database != settings.database:
+        logger.warn('Changes to the interfaces and the database are used after a restart')
+    if (new.conntrack.enabled, new.conntrack.capacity) != (settings.conntrack.enabled, settings.conntrack.capacity):
+        logger.warn('Enabling conntrack and changing its Capacity are used after a restart')
+
+    settings = new
+    logger.configure(settings.logging)
+    logger.log('Config reloaded')
 
 def start():
     # This is where it all starts
-    global config
+    global settings
 
     # First we need to start by making an asynchronous loop
     async_loop = asyncio.get_event_loop()
 
     # After that we need to parse the config file.
     # The file that we will be parsing is "config.cfg" we print a nice debug message after we are done parsing the file.
-    config = configparser.ConfigParser()
-    config.read('config.cfg')
+    try:
+        settings = settings_module.load(CONFIG_FILE)
+    except ValueError as e:
+        logger.err(f'Invalid config: {e}')
+        sys.exit(1)
+    logger.configure(settings.logging)
+    logger.start(settings.logging.queue_size)
     logger.debug('Config loaded')
 
-    # Now we start each module one by one
+    # Read the config file again when we receive SIGHUP
+    async_loop.add_signal_handler(signal.SIGHUP, reload)
+
+    # Now we start the modules that only need this machine one by one
     # This will only initialize the modules and not actually loop them
     # Each module can be disabled in the config. The module will check if it is disabled by itself in the enable function
-    database.enable()
+    # The database, mailing and MQTT are enabled in threads at the same time by run
+    executor.enable(async_loop)
     interface.enable()
-    mailing.enable()
-    mqtt.enable()
+    sampler.enable()
+    stats.enable()
+    metrics.enable()
 
     # After all modules are initialized we will display a message to the user
     logger.log('Measuring started')
 
     # This is where we start the actual asynchronous loop starts
     # suppress is a better way to ignore a exceptions for example a keyboardinterrupt
-    with suppress(KeyboardInterrupt):
-        # Add our automatic asynchronous data migrator to the asynchronous loop
-        asyncio.ensure_future(database.loop(), loop=async_loop)
+    tasks = []
+    try:
+        with suppress(KeyboardInterrupt, asyncio.CancelledError):
+            # Add the HTTP server to read the usage from other devices
+            tasks.append(asyncio.ensure_future(api.loop(), loop=async_loop))
+
+            # Add the task that reads the counters between the measurements, this starts right away
+            tasks.append(asyncio.ensure_future(sampler.loop(), loop=async_loop))
+
+            # Enable the other modules and start measuring
+            main = asyncio.ensure_future(run(tasks), loop=async_loop)
+            tasks.append(main)
+
+            # systemd stops the service with SIGTERM, that stops the measurements like Ctrl+C does
+            # so the buffered rows are still written below
+            async_loop.add_signal_handler(signal.SIGTERM, main.cancel)
+            async_loop.run_until_complete(main)
+    finally:
+        # Stop the tasks so none of them is destroyed while it is still running
+        for task in tasks:
+            task.cancel()
+        with suppress(KeyboardInterrupt):
+            async_loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        # Write the last counters so the next start continues from here, after SIGTERM as well
+        # This isn't skipped when a second Ctrl+C interrupted stopping the tasks
+        with suppress(KeyboardInterrupt):
+            async_loop.run_until_complete(checkpoint.close())
 
-        # Start the most important part of the loop
-        async_loop.run_until_complete(measure_loop())
+        # Write the buffered measurements to the database and stop its thread, even when something crashed
+        database.close()
 
     # Close the actual asynchronous to clean everything up and message to the user about the status of the program
+    mqtt.close()
+    mailing.close()
     async_loop.close()
     logger.log('Shutting down...')
+    logger.stop()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replay stored usage to see when rules would have fired without waiting a month for each one
+
+The readings are read once from the database or from a log of kernel counters into arrays.
+After that they are run through processor.measure on their own timestamps,
+so the rules, the notification E-Mails and the MQTT feeds see exactly what they would have seen in the program.
+Nothing is executed, send or published: the rules hand their actions to rules.sink and MQTT publishes to a recorder.
+The rules on a value are searched with a binary search, so hundreds of thresholds are swept in the same single pass.
+
+Run this module with thresholds in bytes, k, M and G can be used:
+    python -m ha_lib.replay --database data.sqlite --disable 5G 10G 20G --notify 500M 1G --double
+Without thresholds the disable triggers and the notification threshold of the config file are used.
+The [RULE:<name>] sections of the config file are always replayed as well.
+A counter log has a line with the timestamp, interface, received and send counter for each reading:
+    1700000000,wlan0,123456,7890
+"""
+
+import os
+import sys
+import json
+import asyncio
+import sqlite3
+import argparse
+import dataclasses
+from array import array
+from datetime import datetime
+from . import processor, database, interface, segments, logger, rules, mqtt, stats, metrics, forecast, \
+    settings as settings_module
+
+# Name of the sum of all interfaces in the results
+ALL = 'all'
+
+
+class Replay:
+    """The counters of every interface at each reading in arrays sorted by time, collected in a single pass.
+
+    Rows must be added in the order of their timestamps, an interface without a row at a reading keeps its counters.
+    The totals of a database start at zero every month. They are turned into counters that never go down,
+    so the measurements see the same usage and do the rollover themselves.
+
+    Args:
+        totals: the rows hold the totals of this month instead of the counters of the kernel.
+
+    Attributes:
+        times: timestamp of each reading.
+        counters: dictionary with an array of the received and an array of the send counter of each interface.
+    """
+
+    def __init__(self, totals=False):
+        self.totals = totals
+        self.times = array('q')
+        self.counters = {}
+        self.previous = {}
+
+    def add(self, timestamp, name, received, send):
+        """Add the totals or counters of an interface at a moment"""
+        arrays = self.counters.get(name)
+        if self.totals:
+            # A total that went down started over at a new month, all of it is new usage
+            old_rx, old_tx = self.previous.get(name, (0, 0))
+            self.previous[name] = received, send
+            counter_rx, counter_tx = (arrays[0][-1], arrays[1][-1]) if arrays else (0, 0)
+            received = counter_rx + (received - old_rx if received >= old_rx else received)
+            send = counter_tx + (send - old_tx if send >= old_tx else send)
+
+        if not self.times or self.times[-1] != timestamp:
+            self.times.append(timestamp)
+            for rx, tx in self.counters.values():
+                rx.append(rx[-1])
+                tx.append(tx[-1])
+
+        # Before its first row an interface didn't use anything
+        if arrays is None:
+            before_rx, before_tx = (0, 0) if self.totals else (received, send)
+            arrays = self.counters[name] = (array('q', [before_rx]) * len(self.times),
+                                            array('q', [before_tx]) * len(self.times))
+        arrays[0][-1], arrays[1][-1] = received, send
+
+    def reading(self, index):
+        """The counters of all interfaces at a reading"""
+        return {name: (rx[index], tx[index]) for name, (rx, tx) in self.counters.items()}
+
+    def start(self):
+        """The counters before the first reading, the totals of a database start from zero"""
+        if self.totals:
+            return dict.fromkeys(self.counters, (0, 0))
+        return self.reading(0)
+
+    def interfaces(self):
+        """Names of all interfaces that were seen"""
+        return sorted(self.counters)
+
+
+class Recorder:
+    """Takes the place of the MQTT transport and counts the values each feed would have published each month"""
+
+    def __init__(self):
+        self.month = None
+        self.published = {}
+
+    def is_connected(self):
+        return True
+
+    def publish(self, path, value):
+        counts = self.published.setdefault(self.month, {})
+        counts[path] = counts.get(path, 0) + 1
+        return True
+
+
+def sweep_rules(settings, names, disable=None, notify=None, double=False):
+    """Make the rules that are replayed.
+
+    The [RULE:<name>] sections are always replayed. The disable triggers and notification E-Mails
+    of the config file are replaced by the thresholds that are given, every threshold is a rule of its own.
+
+    Args:
+        settings: the settings of the config file.
+        names: names of the interfaces in the replay.
+        disable: disable thresholds to try on every interface, the disable triggers of the config file when None.
+        notify: notification thresholds to try, the one of the config file when None.
+        double: double the notification threshold after each E-Mail like ResetAfterTrigger.
+    Returns:
+        Tuple with the rules, a dictionary with the interface and threshold of each disable rule
+        and a dictionary with the list of rules of each notification threshold.
+    """
+    email = settings.email
+    generated = {rule.name for rule in settings_module.notification_rules(
+        email.notification_threshold, email.reset_after_trigger)}
+    generated.update(settings_module.disable_rule(name, 0).name for name in settings.network.names)
+    replayed = [rule for rule in settings.rules if rule.name not in generated]
+
+    if disable is None:
+        pairs = [(trigger.name, trigger.disable_threshold) for trigger in settings.network.interfaces
+                 if trigger.disable_trigger and trigger.name in names]
+    else:
+        pairs = [(name, threshold) for name in names for threshold in disable]
+    disable_rules = {}
+    for name, threshold in pairs:
+        rule = settings_module.disable_rule(name, threshold, name=f'disable-{name}-{threshold}')
+        disable_rules[rule.name] = name, threshold
+        replayed.append(rule)
+
+    if notify is None:
+        notify = [email.notification_threshold] if email.enabled else []
+        double = double or email.reset_after_trigger
+    notification = {}
+    for threshold in notify:
+        notification[threshold] = settings_module.notification_rules(threshold, double, f'notification-{threshold}')
+        replayed += notification[threshold]
+    return tuple(replayed), disable_rules, notification
+
+
+def simulate(replay, settings):
+    """Run the readings through the measurements of the program on their own timestamps.
+
+    Args:
+        replay: the collected readings.
+        settings: settings of the program with the rules that are replayed.
+    Returns:
+        List with the timestamp, name and value of every rule that fired,
+        dictionary with the totals of each interface at the end of each month
+        and dictionary with the amount of values published on each feed of each month.
+    """
+    return asyncio.run(run(replay, settings))
+
+
+async def run(replay, settings):
+    # The same start as the program, but with an empty cache and without a database
+    logger.enabled = False
+    processor.settings = settings
+    stats.enable()
+    metrics.enable()
+    forecast.enable()
+    database.totals.clear()
+    database.start_values.clear()
+    database.day_end = database.month_end = 0
+    rules.signals.clear()
+    rules.source = None
+    recorder = Recorder()
+    mqtt.client = recorder if settings.mqtt.enabled else None
+
+    fired, months = [], {}
+    clock = month_end = 0
+    rules.sink = lambda rule, value: fired.append((clock, rule.settings.name, value))
+    processor.last = replay.start()
+    processor.last_time = replay.times[0] - settings.network.measure_delay
+    try:
+        for index, clock in enumerate(replay.times):
+            if clock >= month_end:
+                recorder.month = database.floor_month(clock)
+                month_end = database.next_month(clock)
+            await processor.measure(replay.reading(index), clock, clock)
+            months[recorder.month] = processor.totals
+    finally:
+        rules.sink = None
+        mqtt.client = None
+    return fired, months, recorder.published
+
+
+def summarize(fired, months, published, disable_rules, notification):
+    """Turn the rules that fired into the results of each month.
+
+    Returns:
+        Dictionary with a list of the disable triggers, the notification E-Mails,
+        the other rules and the published values of each month.
+    """
+    # The moments and values each rule fired at in each month
+    history = {}
+    for timestamp, name, value in fired:
+        history.setdefault((database.floor_month(timestamp), name), []).append((timestamp, value))
+    other = sorted({name for _, name, _ in fired} - set(disable_rules)
+                   - {rule.name for chain in notification.values() for rule in chain})
+
+    results = {'disable': [], 'notification': [], 'rules': [], 'published': []}
+    for month, totals in months.items():
+        for name, (interface_name, threshold) in disable_rules.items():
+            if interface_name not in totals:
+                continue
+            first = history.get((month, name), [(None, sum(totals[interface_name]))])[0]
+            results['disable'].append({'month': month, 'interface': interface_name, 'threshold': threshold,
+                                       'fired': first[0], 'used': first[1]})
+        used = sum(rx + tx for rx, tx in totals.values())
+        for threshold, chain in notification.items():
+            sent = sorted(timestamp for rule in chain for timestamp, _ in history.get((month, rule.name), []))
+            results['notification'].append({'month': month, 'threshold': threshold, 'sent': sent, 'used': used})
+        for name in other:
+            if (month, name) in history:
+                results['rules'].append({'month': month, 'rule': name,
+                                         'fired': [timestamp for timestamp, _ in history[(month, name)]]})
+        for path, count in sorted(published.get(month, {}).items()):
+            results['published'].append({'month': month, 'path': path, 'count': count})
+    return results
+
+
+def read_database(path):
+    """Receive the stored totals from a database file in order of time.
+
+    Each period is read from the finest tier that still has it.
+    The rows of a tier hold the totals at the end of their bucket, so they get the last second of the bucket.
+    The raw measurements are read from the segment log when the database has one.
+
+    Args:
+        path: path of the database file.
+    Yields:
+        The timestamp, interface, received and send bytes of each row.
+    """
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    log = None
+    if os.path.isdir(path + segments.SUFFIX):
+        log = segments.SegmentLog(path + segments.SUFFIX)
+        log.open(writable=False)
+    try:
+        tiers = list(reversed(database.TIERS)) + [database.RAW]
+        firsts = [connection.execute(f'SELECT MIN(TIMESTAMP) FROM {tier.table};').fetchone()[0] for tier in tiers]
+        if log is not None:
+            firsts[-1] = log.next_timestamp(0)
+        start = 0
+        for i, tier in enumerate(tiers):
+            end = min((first for first in firsts[i + 1:] if first is not None), default=2 ** 62)
+            if firsts[i] is None or start >= end:
+                continue
+            if tier is database.RAW and log is not None:
+                rows = log.read(start, end)
+            else:
+                rows = connection.execute(database.SELECT_RANGE.format(tier.table), (start, end))
+            for timestamp, name, received, send in rows:
+                if tier is not database.RAW:
+                    timestamp = tier.next_bucket(timestamp) - 1
+                yield timestamp, name, received, send
+            start = end
+    finally:
+        connection.close()
+
+
+def read_counter_log(lines):
+    """Read a log of kernel counters.
+
+    The counters may wrap around or reset, the measurements take care of that like in the program.
+
+    Args:
+        lines: lines with the timestamp, interface, received and send counter separated by commas.
+    Yields:
+        The timestamp, interface, received and send counter of each line.
+    Raises:
+        ValueError: a line can't be parsed.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            timestamp, name, rx, tx = (field.strip() for field in line.split(','))
+            yield int(float(timestamp)), name, int(rx), int(tx)
+        except ValueError:
+            raise ValueError(f'Line {number} of the counter log can\'t be read: {line}')
+
+
+def parse_size(text):
+    """Turn a size like 500M or 20G into bytes"""
+    return int(settings_module.parse_size(text))
+
+
+def format_size(value):
+    number, unit = interface.byte_formatter(value)
+    return f'{number:.2f}{unit.strip()}'
+
+
+def format_time(timestamp):
+    return '-' if timestamp is None else datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def report(results):
+    if results['disable']:
+        print('Month    Interface  Threshold  Fired             Used')
+    for row in results['disable']:
+        print(f'{datetime.fromtimestamp(row["month"]):%Y-%m}  {row["interface"]:<10} '
+              f'{format_size(row["threshold"]):<10} {format_time(row["fired"]):<17} {format_size(row["used"])}')
+    if results['notification']:
+        print('Month    Threshold  Used       E-Mails')
+    for row in results['notification']:
+        sent = ', '.join(format_time(timestamp) for timestamp in row['sent']) or '-'
+        print(f'{datetime.fromtimestamp(row["month"]):%Y-%m}  {format_size(row["threshold"]):<10} '
+              f'{format_size(row["used"]):<10} {sent}')
+    if results['rules']:
+        print('Month    Rule                 Fired')
+    for row in results['rules']:
+        fired = ', '.join(format_time(timestamp) for timestamp in row['fired'])
+        print(f'{datetime.fromtimestamp(row["month"]):%Y-%m}  {row["rule"]:<20} {fired}')
+    if results['published']:
+        print('Month    Feed                 Published')
+    for row in results['published']:
+        print(f'{datetime.fromtimestamp(row["month"]):%Y-%m}  {row["path"]:<20} {row["count"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--database', help='database file to replay, the one in the config file by default')
+    source.add_argument('--log', help='counter log to replay, - reads it from stdin')
+    parser.add_argument('--config', default=processor.CONFIG_FILE, help='config file with the rules and feeds')
+    parser.add_argument('--disable', nargs='*', type=parse_size, help='disable thresholds to try')
+    parser.add_argument('--notify', nargs='*', type=parse_size, help='notification thresholds to try')
+    parser.add_argument('--double', action='store_true', help='double the notification threshold after each E-Mail')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    try:
+        config = settings_module.load(args.config)
+    except ValueError as e:
+        sys.exit(f'Invalid config: {e}')
+
+    replay = Replay(totals=args.log is None)
+    try:
+        if args.log == '-':
+            rows = read_counter_log(sys.stdin)
+        elif args.log:
+            rows = read_counter_log(open(args.log))
+        else:
+            rows = read_database(args.database or config.database.file)
+        for row in rows:
+            replay.add(*row)
+    except (OSError, sqlite3.Error, ValueError) as e:
+        sys.exit(f'Can\'t replay: {e}')
+    if not replay.times:
+        sys.exit('There is nothing to replay')
+
+    # The interfaces are the ones in the data, the database of the program is left alone
+    try:
+        config = settings_module.load(args.config, {'NETWORK': {'interface': ', '.join(replay.interfaces())},
+                                                    'DATABASE': {'enabled': 'False'}})
+    except ValueError as e:
+        sys.exit(f'Invalid config: {e}')
+    replayed, disable_rules, notification = sweep_rules(config, replay.interfaces(), args.disable, args.notify,
+                                                        args.double)
+    fired, months, published = simulate(replay, dataclasses.replace(config, rules=replayed))
+    results = summarize(fired, months, published, disable_rules, notification)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        report(results)
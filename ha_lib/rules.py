@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that runs an action when a value passes the threshold of a rule
+
+Rules come from the [RULE:<name>] sections, the disable trigger of each interface and the notification threshold.
+The rules on the same value are kept sorted by threshold together with the position of the last value between them.
+A measurement moves that position with a binary search and only looks at the rules it moved past,
+so hundreds of quotas cost about the same as a single one.
+
+A rule fires when the value is larger than its threshold and it is armed.
+After that it is armed again when the value drops Hysteresis below the threshold, for totals that is the next month.
+Cooldown is the least amount of seconds between two actions of the same rule.
+
+The state of the rules isn't stored, at the start it follows from the restored totals instead.
+A rule on a value that is already past its threshold starts disarmed, so a restart doesn't run its action again.
+"""
+
+import asyncio
+from bisect import bisect_left
+from . import logger, processor, database, executor, interface, mailing, mqtt, stats, forecast
+
+# The rules on each value, the key is the metric and the interface, None is the sum of all interfaces
+signals = {}
+
+# The rule settings the signals were made of, they are made again when the config file has been reloaded
+source = None
+
+# Every rule by its name
+by_name = {}
+
+# E-Mails that are being sent, a reference is kept so they aren't garbage collected before they are done
+sending = set()
+
+# Function that receives the rules that fire with their value instead of running their actions, used by the replay
+sink = None
+
+# Metrics whose value is the same after a restart, their rules start disarmed when they are past their threshold
+RESTORED = ('total', 'received', 'send', 'today', 'forecast')
+
+# Command that takes an interface down
+DOWN_COMMAND = 'ip link set dev {} down'
+
+
+class Rule:
+    """A rule and its state, the state is kept when the config file is reloaded.
+
+    Attributes:
+        settings: the settings of the rule.
+        armed: the rule fires when the value passes its threshold.
+        fired: monotonic time of the last action, None when it never fired.
+        count: amount of actions since the program started.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.armed = True
+        self.fired = None
+        self.count = 0
+
+
+class Signal:
+    """All rules on a single value sorted by threshold.
+
+    Args:
+        rules: the rules on this value.
+
+    Attributes:
+        position: amount of rules with a threshold below the last value.
+        waiting: rules that passed their threshold but are still in their cooldown.
+        disarmed: rules below their threshold that wait for the value to drop far enough to be armed again.
+    """
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: rule.settings.threshold)
+        self.thresholds = [rule.settings.threshold for rule in self.rules]
+        self.position = 0
+        self.waiting = set()
+        self.disarmed = set()
+
+    def seed(self, value):
+        """Start at a value without firing, the rules it is past already fired before the restart"""
+        self.position = bisect_left(self.thresholds, value)
+        for rule in self.rules[:self.position]:
+            rule.armed = False
+
+    def update(self, value, now):
+        """Move to a new value.
+
+        Args:
+            value: the new value.
+            now: the current monotonic time.
+        Returns:
+            List with the rules that fire.
+        """
+        position = bisect_left(self.thresholds, value)
+        if position > self.position:
+            self.waiting.update(rule for rule in self.rules[self.position:position] if rule.armed)
+        elif position < self.position:
+            for rule in self.rules[position:self.position]:
+                self.waiting.discard(rule)
+                if not rule.armed and rule.settings.rearm == 'below':
+                    self.disarmed.add(rule)
+        self.position = position
+
+        for rule in list(self.disarmed):
+            if value <= rule.settings.threshold - rule.settings.hysteresis:
+                rule.armed = True
+                self.disarmed.discard(rule)
+
+        fired = []
+        for rule in list(self.waiting):
+            if rule.fired is None or now - rule.fired >= rule.settings.cooldown:
+                rule.armed = False
+                rule.fired = now
+                rule.count += 1
+                self.waiting.discard(rule)
+                fired.append(rule)
+        return fired
+
+
+def build(settings):
+    # Sort the rules by the value they watch and keep the state of the rules that already existed
+    global source
+    old = {rule.settings.name: rule for signal in signals.values() for rule in signal.rules}
+    grouped = {}
+    for rule_settings in settings:
+        rule = old.get(rule_settings.name) or Rule(rule_settings)
+        rule.settings = rule_settings
+        name = None if rule_settings.interface == 'all' else rule_settings.interface
+        grouped.setdefault((rule_settings.metric, name), []).append(rule)
+
+    signals.clear()
+    signals.update((key, Signal(rules)) for key, rules in grouped.items())
+    by_name.clear()
+    by_name.update((rule.settings.name, rule) for rules in grouped.values() for rule in rules)
+    source = settings
+
+
+def enable():
+    # Make the rules from the restored totals, this has to happen before the first measurement
+    build(processor.settings.rules)
+    for (metric, name), signal in signals.items():
+        if metric in RESTORED:
+            signal.seed(METRICS[metric](name))
+
+
+def total(name):
+    # Received and send bytes of this month of an interface or of all interfaces
+    if name is None:
+        return processor.total_rx, processor.total_tx
+    return processor.totals.get(name, (0, 0))
+
+
+def today(name):
+    # Bytes used today, the start values are in the database cache
+    start_values = database.get_start_values()
+    names = processor.totals if name is None else [name]
+    return sum(sum(total(n)) - sum(start_values.get(n, total(n))) for n in names)
+
+
+def rate(name):
+    # Average received plus send bytes per second over the shortest horizon
+    rx_stats, tx_stats = stats.get(name)
+    if rx_stats.averages[0] is None:
+        return 0
+    return rx_stats.averages[0] + tx_stats.averages[0]
+
+
+def projection(name):
+    # Expected total at the end of the month, 0 until there are enough days
+    result = forecast.get(name)
+    return 0 if result is None else result.expected
+
+
+# Functions that receive the value of each metric
+METRICS = {
+    'total': lambda name: sum(total(name)),
+    'received': lambda name: total(name)[0],
+    'send': lambda name: total(name)[1],
+    'today': today,
+    'rate': rate,
+    'forecast': projection,
+}
+
+
+def update(sample):
+    # Check the rules after a measurement
+    if processor.settings.rules is not source:
+        build(processor.settings.rules)
+    for (metric, name), signal in signals.items():
+        value = METRICS[metric](name)
+        for rule in signal.update(value, sample.monotonic):
+            fire(rule, value)
+
+
+def fire(rule, value):
+    # Run the action of a rule
+    if sink is not None:
+        sink(rule, value)
+        return
+    settings = rule.settings
+    number, unit = interface.byte_formatter(settings.threshold)
+    logger.log(f'{settings.interface} passed {number:.2f}{unit.strip()} of rule {settings.name}')
+
+    if settings.action == 'command':
+        executor.submit(settings.command)
+    elif settings.action == 'down':
+        names = processor.settings.network.names if settings.interface == 'all' else [settings.interface]
+        for name in names:
+            executor.submit(DOWN_COMMAND.format(name))
+    elif settings.action == 'mqtt':
+        if mqtt.client is None or not mqtt.send(settings.path, round(value, 2)):
+            logger.warn(f'Couldn\'t publish rule {settings.name}')
+    elif settings.action == 'email':
+        if mailing.enabled:
+            task = asyncio.ensure_future(mailing.send_notification())
+            sending.add(task)
+            task.add_done_callback(sent)
+        else:
+            logger.warn(f'Rule {settings.name} wants to send an E-Mail but mailing is disabled')
+
+
+def sent(task):
+    # Forget an E-Mail that is done and report it when it failed
+    sending.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.err(f'Couldn\'t send the notification: {task.exception()}')
+
+
+def get(name):
+    """Receive a rule by its name, None when there is no such rule"""
+    return by_name.get(name)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that samples the interface counters many times between two measurements
+
+Short bursts that fill the link disappear in the average of a whole measurement.
+The counters are read every SampleInterval seconds and the amount of bytes of each sample is kept in a ring buffer.
+The ring buffer has a fixed size, so the memory stays the same no matter how long the program runs.
+At every measurement the samples since the previous one are summarized into the peak, mean and 95th percentile rate.
+"""
+
+import math
+import time
+import asyncio
+from array import array
+from . import logger, processor, interface, scheduler
+
+# The samples of all interfaces, None when sampling is disabled
+buffer = None
+
+# Amount of samples that had been written when the last window was summarized
+position = 0
+
+
+class RingBuffer:
+    """Preallocated buffer that keeps the newest samples and overwrites the oldest.
+
+    Each sample has the nanoseconds it took and a row of width counters.
+
+    Args:
+        capacity: amount of samples that are kept.
+        width: amount of counters in each sample.
+    """
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.elapsed = array('Q', bytes(8 * capacity))
+        self.values = array('Q', bytes(8 * capacity * width))
+
+        # Amount of samples appended since the start, the newest one is at (written - 1) % capacity
+        self.written = 0
+
+    def append(self, elapsed, values):
+        """Add a sample and overwrite the oldest when the buffer is full
+
+        Args:
+            elapsed: nanoseconds since the previous sample.
+            values: the counters of this sample.
+        """
+        index = self.written % self.capacity
+        self.elapsed[index] = elapsed
+        offset = index * self.width
+        for i, value in enumerate(values):
+            self.values[offset + i] = value
+        self.written += 1
+
+    def indexes(self, start):
+        """Indexes of the samples appended since start that haven't been overwritten yet"""
+        start = max(start, self.written - self.capacity)
+        return [i % self.capacity for i in range(start, self.written)]
+
+    def summarize(self, indexes, column):
+        """Calculate the rate statistics of a counter.
+
+        Args:
+            indexes: the samples to use.
+            column: the counter in each sample.
+        Returns:
+            Peak, mean and 95th percentile rate in bytes per second or None when there are no samples.
+        """
+        if not indexes:
+            return None
+        values, elapsed, width = self.values, self.elapsed, self.width
+        total_bytes, total_elapsed = 0, 0
+        rates = []
+        for index in indexes:
+            amount, duration = values[index * width + column], elapsed[index] or 1
+            total_bytes += amount
+            total_elapsed += duration
+            rates.append(amount * 1e9 / duration)
+
+        rates.sort()
+        p95 = rates[math.ceil(0.95 * len(rates)) - 1]
+        return rates[-1], total_bytes * 1e9 / total_elapsed, p95
+
+
+def enable():
+    global buffer
+    # Sampling is disabled when there is no sample interval
+    settings = processor.settings.network
+    if settings.sample_interval <= 0:
+        return
+    if settings.sample_interval >= settings.measure_delay:
+        logger.warn('SampleInterval must be shorter than MeasureDelay, sampling is disabled')
+        return
+
+    # Keep twice the samples of a measurement so a late measurement doesn't lose any
+    capacity = 2 * math.ceil(settings.measure_delay / settings.sample_interval)
+    buffer = RingBuffer(capacity, 2 * len(settings.interfaces))
+    logger.debug(f'Sampling every {settings.sample_interval} seconds')
+
+
+def window():
+    """Summarize the samples since the previous call
+
+    Returns:
+        Dictionary with the peak, mean and 95th percentile rate of received and send bytes of each interface.
+        Interfaces without samples are left out, the dictionary is empty when sampling is disabled.
+    """
+    global position
+    if buffer is None:
+        return {}
+    indexes = buffer.indexes(position)
+    position = buffer.written
+    if not indexes:
+        return {}
+    return {name: (buffer.summarize(indexes, 2 * i), buffer.summarize(indexes, 2 * i + 1))
+            for i, name in enumerate(processor.settings.network.names)}
+
+
+async def loop():
+    # Read the counters at the sample interval and keep the bytes of each sample
+    if buffer is None:
+        return
+    names = processor.settings.network.names
+    last = interface.receive_values()
+    last_time = time.monotonic_ns()
+
+    # Skipped samples aren't worth a warning, the next sample covers their time as well
+    ticker = scheduler.Ticker(processor.settings.network.sample_interval, warn=False)
+    values = [0] * buffer.width
+    while True:
+        await ticker.wait()
+        new = interface.receive_values()
+        now = time.monotonic_ns()
+        for i, name in enumerate(names):
+            (last_rx, last_tx), (new_rx, new_tx) = last[name], new[name]
+            values[2 * i] = interface.counter_delta(last_rx, new_rx)
+            values[2 * i + 1] = interface.counter_delta(last_tx, new_tx)
+        buffer.append(now - last_time, values)
+        last, last_time = new, now
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module to run work at a fixed rate without drifting"""
+
+import time
+import asyncio
+from . import logger
+
+
+class Ticker:
+    """Wait for deadlines that are a fixed interval apart on the monotonic clock.
+
+    The deadlines don't depend on how long the work between two ticks took,
+    so the period stays the same when the database or MQTT is slow.
+    Deadlines that have already passed are skipped instead of running them all at once.
+
+    Args:
+        interval: seconds between two ticks.
+        clock: function that returns the monotonic time in seconds.
+        warn: log a warning when deadlines are skipped.
+    """
+
+    def __init__(self, interval, clock=time.monotonic, warn=True):
+        self.interval = interval
+        self.clock = clock
+        self.warn = warn
+        self.deadline = clock()
+        self.missed = 0
+
+    async def wait(self):
+        """Wait until the next deadline.
+
+        Returns:
+            Amount of deadlines that were skipped because the previous tick took too long.
+        """
+        self.deadline += self.interval
+        now = self.clock()
+
+        # Coalesce all deadlines that passed while we were busy into this tick
+        skipped = 0
+        if now > self.deadline:
+            skipped = int((now - self.deadline) // self.interval)
+            self.deadline += skipped * self.interval
+            if skipped:
+                self.missed += skipped
+                if self.warn:
+                    logger.warn(f'Skipped {skipped} measurement(s) because the system is too slow')
+
+        await asyncio.sleep(max(0, self.deadline - now))
+        return skipped
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Append-only log of the raw measurements, an alternative to the RECORDS table for flash storage
+
+Every row of RECORDS becomes a fixed-width record of RECORD.size bytes that is appended to a segment file.
+A record holds the seconds since the start of its segment and how much the totals of its interface
+changed since the previous record of that interface in the same segment.
+The first record of an interface in a segment holds its totals, so every segment can be read on its own.
+
+Appending a row writes only its record, where SQLite rewrites whole pages and writes them to its log as well.
+Segments that aren't sealed yet are memory-mapped when they are read.
+A new segment is started when the active one reaches SegmentSize bytes or at the end of the day.
+The closed segment is sealed in the background by the compaction of the database, that compresses it.
+The small changes compress very well.
+index.json holds the interfaces and the first and last timestamp of every sealed segment,
+so a time range only opens the segments it overlaps.
+
+Within a segment a time is found with a binary search on the seconds of the records.
+The totals before every MARK records are kept in memory, so a read only decodes from the last one before its range.
+Compaction reads the newest records every step, it doesn't decode the whole segment of the day for that.
+
+The log is a directory next to the database file and only holds the raw measurements of RECORDS.
+The minute, hour, day and month tables stay in SQLite, they get a row per interface each minute, hour, day or month
+so they write little to the flash compared to the raw measurements.
+Convert a database between both engines with:
+    python -m ha_lib.segments --database data.sqlite --to-segments
+    python -m ha_lib.segments --database data.sqlite --to-sqlite
+The program does the same by itself when Engine in [DATABASE] has been changed.
+"""
+
+import os
+import sys
+import mmap
+import json
+import zlib
+import struct
+import shutil
+import sqlite3
+import argparse
+from . import database
+
+# Magic and timestamp where the offsets of the records start, at the start of every segment
+MAGIC = b'HAS1'
+HEADER = struct.Struct('<4sq')
+
+# Seconds after the start of the segment, interface, special and the change of the received and send bytes
+RECORD = struct.Struct('<IBBqq')
+
+# Only the seconds of a record, the records are sorted by them so a time is found with a binary search
+OFFSET = struct.Struct('<I')
+
+# Records between two totals that are kept in memory, a read starts decoding at the last one before its range
+MARK = 1024
+
+# The directory of the log is the database file with this behind it
+SUFFIX = '.segments'
+
+INDEX = 'index.json'
+
+
+class Segment:
+    """A single segment file and the time range of its records.
+
+    Args:
+        path: path of the file, sealed segments end with .segz.
+        base: timestamp the offsets of the records start at.
+
+    Attributes:
+        first, last: timestamps of the first and last record, None when it is empty.
+        count: amount of records.
+        sealed: the segment is compressed.
+        previous: the totals of the last record of each interface, used to encode the next record.
+        seal_at: timestamp from which new records go to the next segment.
+        marks: the totals of each interface before every MARK records, filled in when the segment is read.
+    """
+
+    def __init__(self, path, base, first=None, last=None, count=0, sealed=False):
+        self.path = path
+        self.base = base
+        self.first = first
+        self.last = last
+        self.count = count
+        self.sealed = sealed
+        self.previous = {}
+        self.seal_at = None
+        self.file = None
+        self.marks = [{}]
+
+    @property
+    def size(self):
+        return HEADER.size + self.count * RECORD.size
+
+    def decode(self, data, start=0):
+        """Turn the records in data back into totals.
+
+        Args:
+            data: the records of the segment.
+            start: number of the first record that is decoded, the totals before it come from the marks.
+        Yields:
+            The timestamp, interface, special, received and send bytes of each record.
+        """
+        totals = self.totals(data, start)
+        for offset, index, special, received, send in RECORD.iter_unpack(data[start * RECORD.size:]):
+            last_rx, last_tx = totals.get(index, (0, 0))
+            received, send = last_rx + received, last_tx + send
+            totals[index] = received, send
+            yield self.base + offset, index, special, received, send
+
+    def position(self, data, timestamp):
+        """Number of the first record at or after timestamp, the records before it aren't decoded"""
+        low, high = 0, len(data) // RECORD.size
+        offset = timestamp - self.base
+        while low < high:
+            middle = (low + high) // 2
+            if OFFSET.unpack_from(data, middle * RECORD.size)[0] < offset:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def totals(self, data, start):
+        """The totals of each interface before a record, only the records since the last mark are added up
+
+        Records are only appended, so the marks stay right while the segment grows and after it is sealed.
+        """
+        while len(self.marks) <= start // MARK:
+            totals = dict(self.marks[-1])
+            begin = (len(self.marks) - 1) * MARK
+            add_changes(totals, data[begin * RECORD.size:(begin + MARK) * RECORD.size])
+            self.marks.append(totals)
+        totals = dict(self.marks[start // MARK])
+        add_changes(totals, data[start // MARK * MARK * RECORD.size:start * RECORD.size])
+        return totals
+
+
+def add_changes(totals, data):
+    # Add the changes of the records in data to the totals of their interfaces
+    for _, index, _, received, send in RECORD.iter_unpack(data):
+        last_rx, last_tx = totals.get(index, (0, 0))
+        totals[index] = last_rx + received, last_tx + send
+
+
+class SegmentLog:
+    """The segments in a directory, read and written from a single thread.
+
+    Args:
+        directory: directory of the segments, it is made when it doesn't exist.
+        segment_size: most bytes of a segment before the next one starts, best the erase block size of the flash.
+        sync: make sure every append is on the disk before returning.
+        boundary: function that receives the first timestamp of a segment and returns when the next one starts.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, sync=False, boundary=None):
+        self.directory = directory
+        self.segment_size = max(segment_size, HEADER.size + RECORD.size)
+        self.sync = sync
+        self.boundary = boundary
+        self.names = []
+        self.active = None
+
+        # The segments before the active one, oldest first, the ones that aren't sealed yet are still plain files
+        self.closed = []
+
+        # The last sealed segment that has been decompressed, ranges usually read the same one again
+        self.cache = None, None
+
+    def open(self, writable=True):
+        """Read the index and recover the active segment after a crash
+
+        Args:
+            writable: the log is appended to, otherwise nothing in the directory is changed.
+        """
+        if writable:
+            os.makedirs(self.directory, exist_ok=True)
+        index = {'names': [], 'segments': {}}
+        if os.path.exists(self.path(INDEX)):
+            with open(self.path(INDEX)) as file:
+                index = json.load(file)
+        self.names = index['names']
+
+        files = sorted(os.listdir(self.directory), key=lambda file: (len(file), file))
+        plain = []
+        for file in files:
+            if file.endswith('.segz'):
+                if file in index['segments']:
+                    first, last, count = index['segments'][file]
+                    self.closed.append(Segment(self.path(file), int(file[:-5]), first, last, count, True))
+                else:
+                    # Sealed right before a crash, before the index was written
+                    self.closed.append(self.scan(Segment(self.path(file), int(file[:-5]), sealed=True)))
+            elif file.endswith('.seg'):
+                if file + 'z' not in files:
+                    plain.append(file)
+                elif writable:
+                    os.remove(self.path(file))
+
+        # Only the newest plain segment is active, the others still have to be sealed
+        for file in plain[:-1] if writable else plain:
+            self.closed.append(self.scan(Segment(self.path(file), int(file[:-4]))))
+        if plain and writable:
+            self.active = self.recover(Segment(self.path(plain[-1]), int(plain[-1][:-4])))
+        self.closed.sort(key=lambda segment: segment.base)
+        if writable:
+            self.save_index()
+
+    def close(self):
+        if self.active is not None and self.active.file is not None:
+            self.active.file.close()
+            self.active.file = None
+
+    def path(self, file):
+        return os.path.join(self.directory, file)
+
+    def scan(self, segment):
+        # Find the time range and the last totals of a segment by reading all of it
+        for timestamp, index, _, received, send in segment.decode(self.data(segment)):
+            if segment.first is None:
+                segment.first = timestamp
+            segment.last = timestamp
+            segment.count += 1
+            segment.previous[index] = received, send
+        return segment
+
+    def recover(self, segment):
+        # A crash can leave half a record at the end, it is cut off
+        size = os.path.getsize(segment.path)
+        whole = HEADER.size + max(0, size - HEADER.size) // RECORD.size * RECORD.size
+        if size < HEADER.size:
+            with open(segment.path, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, segment.base))
+        elif size != whole:
+            os.truncate(segment.path, whole)
+        self.scan(segment)
+        segment.seal_at = self.seal_time(segment.first if segment.first is not None else segment.base)
+        segment.file = open(segment.path, 'ab')
+        return segment
+
+    def seal_time(self, timestamp):
+        return self.boundary(timestamp) if self.boundary is not None else None
+
+    def create(self, timestamp):
+        # Start a new active segment at a timestamp
+        segment = Segment(self.path(f'{timestamp}.seg'), timestamp)
+        segment.seal_at = self.seal_time(timestamp)
+        segment.file = open(segment.path, 'wb')
+        segment.file.write(HEADER.pack(MAGIC, timestamp))
+        return segment
+
+    def rotate(self):
+        """Close the active segment, the next append starts a new one"""
+        segment, self.active = self.active, None
+        if segment is None:
+            return
+        segment.file.close()
+        segment.file = None
+        if segment.count:
+            self.closed.append(segment)
+        else:
+            os.remove(segment.path)
+
+    def seal(self):
+        """Compress the oldest closed segment that isn't sealed yet.
+
+        Returns:
+            True when there are more segments waiting.
+        """
+        waiting = [segment for segment in self.closed if not segment.sealed]
+        if not waiting:
+            return False
+        segment = waiting[0]
+        with open(segment.path, 'rb') as file:
+            data = zlib.compress(file.read())
+        path = segment.path + 'z'
+        self.write_atomic(path, data)
+        plain, segment.path, segment.sealed, segment.previous = segment.path, path, True, {}
+        self.save_index()
+        os.remove(plain)
+        return len(waiting) > 1
+
+    def write_atomic(self, path, data):
+        # Write a file next to its place and rename it, so it is either the old or the new file after a crash
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def save_index(self):
+        segments = {os.path.basename(segment.path): [segment.first, segment.last, segment.count]
+                    for segment in self.closed if segment.sealed}
+        self.write_atomic(self.path(INDEX), json.dumps({'names': self.names, 'segments': segments}).encode())
+
+    def interface(self, name):
+        # Number of an interface, new interfaces are added to the index right away
+        try:
+            return self.names.index(name)
+        except ValueError:
+            self.names.append(name)
+            self.save_index()
+            return len(self.names) - 1
+
+    def append(self, rows):
+        """Add rows to the end of the log.
+
+        The log is sorted by time, a row older than the last record gets the timestamp of the last record.
+
+        Args:
+            rows: the timestamp, interface, received bytes, send bytes and special of each row.
+        """
+        pending = bytearray()
+        for timestamp, name, received, send, special in rows:
+            timestamp = int(timestamp)
+            segment = self.active
+            if segment is not None:
+                if segment.last is not None:
+                    timestamp = max(timestamp, segment.last)
+                full = segment.size + len(pending) + RECORD.size > self.segment_size
+                if full or (segment.seal_at is not None and timestamp >= segment.seal_at) \
+                        or timestamp - segment.base > 0xffffffff:
+                    self.write(pending)
+                    pending = bytearray()
+                    self.rotate()
+                    segment = None
+            if segment is None:
+                if self.closed:
+                    timestamp = max(timestamp, self.closed[-1].last)
+                segment = self.active = self.create(timestamp)
+
+            index = self.interface(name)
+            last_rx, last_tx = segment.previous.get(index, (0, 0))
+            pending += RECORD.pack(timestamp - segment.base, index, special, received - last_rx, send - last_tx)
+            segment.previous[index] = received, send
+            if segment.first is None:
+                segment.first = timestamp
+            segment.last = timestamp
+        self.write(pending)
+
+    def write(self, data):
+        # Append encoded records to the active segment
+        if not data:
+            return
+        segment = self.active
+        segment.file.write(data)
+        segment.file.flush()
+        if self.sync:
+            os.fsync(segment.file.fileno())
+        segment.count += len(data) // RECORD.size
+
+    def data(self, segment):
+        """Receive the records of a segment, a memory map of the file when it isn't sealed"""
+        if segment.sealed:
+            path, data = self.cache
+            if path != segment.path:
+                with open(segment.path, 'rb') as file:
+                    data = memoryview(zlib.decompress(file.read()))[HEADER.size:]
+                self.cache = segment.path, data
+            return data
+
+        # Only whole records are read, a crash can leave half a record at the end
+        size = os.path.getsize(segment.path)
+        if size < HEADER.size + RECORD.size:
+            return b''
+        with open(segment.path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[HEADER.size:size - (size - HEADER.size) % RECORD.size]
+
+    def segments(self, start=None, end=None):
+        # The segments that overlap a time range, oldest first
+        for segment in self.closed + ([self.active] if self.active is not None else []):
+            if segment.count == 0:
+                continue
+            if (start is None or segment.last >= start) and (end is None or segment.first < end):
+                yield segment
+
+    def records(self, start, end):
+        """Read the records in a time range in order of time.
+
+        Args:
+            start: timestamp where the range starts.
+            end: timestamp where the range ends, this one isn't included.
+        Yields:
+            The timestamp, interface, received bytes, send bytes and special of each record.
+        """
+        for segment in self.segments(start, end):
+            data = self.data(segment)
+            first = segment.position(data, start) if segment.first < start else 0
+            for timestamp, index, special, received, send in segment.decode(data, first):
+                if timestamp >= end:
+                    break
+                if timestamp >= start:
+                    yield timestamp, self.names[index], received, send, special
+
+    def read(self, start, end):
+        """The same rows as SELECT_RANGE on RECORDS, with the timestamp, interface, received and send bytes"""
+        return [row[:4] for row in self.records(start, end)]
+
+    def next_timestamp(self, timestamp):
+        """Timestamp of the first record at or after timestamp, None when there is none
+
+        The first and last timestamp of every segment are known, so at most one segment is searched.
+        """
+        for segment in self.segments(timestamp):
+            if segment.first >= timestamp:
+                return segment.first
+            data = self.data(segment)
+            position = segment.position(data, timestamp)
+            if position < len(data) // RECORD.size:
+                return segment.base + OFFSET.unpack_from(data, position * RECORD.size)[0]
+        return None
+
+    def first(self, timestamp):
+        """Receive the first totals of each interface at or after timestamp, like SELECT_FIRST_TODAY"""
+        found = {}
+        for _, name, received, send, _ in self.records(timestamp, 2 ** 62):
+            found.setdefault(name, (received, send))
+            if len(found) == len(self.names):
+                break
+        return found
+
+    def oldest(self):
+        """Timestamp of the oldest record, None when the log is empty"""
+        for segment in self.segments():
+            return segment.first
+        return None
+
+    def newest(self):
+        """Timestamp of the newest record, None when the log is empty"""
+        if self.active is not None and self.active.last is not None:
+            return self.active.last
+        return self.closed[-1].last if self.closed else None
+
+    def last(self):
+        """Receive the timestamp and last totals of each interface, like SELECT_LAST"""
+        found = {}
+        for segment in reversed(list(self.segments())):
+            newest = {}
+            for timestamp, index, _, received, send in segment.decode(self.data(segment)):
+                newest[index] = timestamp, received, send
+            for index, values in newest.items():
+                found.setdefault(self.names[index], values)
+            if len(found) == len(self.names):
+                break
+        return found
+
+    def expire(self, cutoff):
+        """Delete the closed segments that only have records before cutoff
+
+        Returns:
+            Amount of deleted segments.
+        """
+        old = [segment for segment in self.closed if segment.last < cutoff]
+        if not old:
+            return 0
+        self.closed = [segment for segment in self.closed if segment.last >= cutoff]
+        self.save_index()
+        for segment in old:
+            os.remove(segment.path)
+        if self.cache[0] in [segment.path for segment in old]:
+            self.cache = None, None
+        return len(old)
+
+    def disk_size(self):
+        """Bytes of all files of the log"""
+        return sum(os.path.getsize(self.path(file)) for file in os.listdir(self.directory))
+
+
+def import_records(connection, log, batch=10000):
+    """Move the rows of RECORDS into the log.
+
+    Rows older than the newest record in the log are already covered by it and are left out.
+
+    Args:
+        connection: the database connection.
+        log: the opened log.
+        batch: amount of rows that are read at once.
+    Returns:
+        Amount of rows that were moved.
+    """
+    newest = max((segment.last for segment in log.segments()), default=-1)
+    cursor = connection.execute('SELECT TIMESTAMP, INTERFACE, RECEIVED, SEND, SPECIAL FROM RECORDS \
+        WHERE TIMESTAMP > ? ORDER BY TIMESTAMP;', (newest,))
+    moved = 0
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            break
+        log.append(rows)
+        moved += len(rows)
+    with connection:
+        connection.execute('DELETE FROM RECORDS;')
+    return moved
+
+
+def export_records(log, connection):
+    """Copy all records of the log into RECORDS
+
+    Returns:
+        Amount of rows that were copied.
+    """
+    copied = 0
+    with connection:
+        for segment in log.segments():
+            rows = [(timestamp, log.names[index], received, send, special)
+                    for timestamp, index, special, received, send in segment.decode(log.data(segment))]
+            connection.executemany(database.INSERT_RECORD, rows)
+            copied += len(rows)
+    return copied
+
+
+def convert(path, to_segments, segment_size=4 * 1024 * 1024):
+    """Move the raw rows of a database file to the log next to it or back
+
+    Returns:
+        Amount of rows that were moved.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        directory = path + SUFFIX
+        if to_segments:
+            log = SegmentLog(directory, segment_size, boundary=database.TIERS[-1].next_bucket)
+            log.open()
+            try:
+                moved = import_records(connection, log)
+                log.rotate()
+                while log.seal():
+                    pass
+                return moved
+            finally:
+                log.close()
+        if not os.path.isdir(directory):
+            return 0
+        log = SegmentLog(directory)
+        log.open(writable=False)
+        moved = export_records(log, connection)
+        shutil.rmtree(directory)
+        return moved
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='database file')
+    direction = parser.add_mutually_exclusive_group(required=True)
+    direction.add_argument('--to-segments', action='store_true', help='move RECORDS into the segment log')
+    direction.add_argument('--to-sqlite', action='store_true', help='move the segment log back into RECORDS')
+    parser.add_argument('--segment-size', type=int, default=4 * 1024 * 1024, help='most bytes of a segment')
+    args = parser.parse_args()
+    try:
+        print(f'Moved {convert(args.database, args.to_segments, args.segment_size)} rows')
+    except (OSError, sqlite3.Error, ValueError) as e:
+        sys.exit(f'Can\'t convert: {e}')
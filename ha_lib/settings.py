@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that turns the config file into typed settings
+
+The config file is parsed and checked once into frozen dataclasses.
+The program reads its settings from these attributes instead of parsing the same strings over and over.
+A new snapshot is made when the config file is reloaded, a snapshot itself never changes.
+"""
+
+import ipaddress
+import configparser
+from statistics import NormalDist
+from types import MappingProxyType
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class InterfaceSettings:
+    """Settings of a single interface, from [NETWORK:<name>] or else [NETWORK]"""
+    name: str
+    disable_trigger: bool
+    disable_threshold: int
+    disable_command: str
+
+
+@dataclass(frozen=True)
+class NetworkSettings:
+    interfaces: tuple
+    measure_delay: float
+    start_on_boot: bool
+    sample_interval: float
+    slow_start_warning: float
+
+    @property
+    def names(self):
+        """Names of all interfaces in the order of the config file"""
+        return [settings.name for settings in self.interfaces]
+
+    def get(self, name):
+        """Receive the settings of an interface, None when it isn't monitored"""
+        for settings in self.interfaces:
+            if settings.name == name:
+                return settings
+        return None
+
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    enabled: bool
+    file: str
+    data_move_interval: int
+    flush_rows: int
+    flush_interval: float
+    synchronous: str
+    raw_retention: int
+    minute_retention: int
+    hour_retention: int
+    day_retention: int
+    compact_batch: int
+    engine: str
+    segment_size: int
+
+
+@dataclass(frozen=True)
+class EmailSettings:
+    enabled: bool
+    ssl: bool
+    timeout: int
+    file: str
+    host: str
+    port: int
+    login: bool
+    username: str
+    password: str
+    receiver: str
+    client_name: str
+    subject: str
+    notification_threshold: int
+    reset_after_trigger: bool
+    idle_timeout: float
+    batch_delay: float
+
+
+@dataclass(frozen=True)
+class FeedSettings:
+    """Path and publish settings of a single MQTT feed"""
+    nick: str
+    path: str
+    deadband: float
+    min_interval: float
+    max_interval: float
+
+
+@dataclass(frozen=True)
+class MQTTSettings:
+    enabled: bool
+    backend: str
+    username: str
+    key: str
+    host: str
+    port: int
+    tls: bool
+    prefix: str
+    qos: int
+    keepalive: int
+    max_inflight: int
+    reconnect_min: float
+    reconnect_max: float
+    feeds: MappingProxyType
+    queue_size: int
+    drain_batch: int
+    drain_delay: float
+
+
+@dataclass(frozen=True)
+class NumpadSettings:
+    enabled: bool
+    subscribe_path: str
+    commands: MappingProxyType
+
+
+@dataclass(frozen=True)
+class CommandSettings:
+    max_concurrent: int
+    timeout: float
+
+
+@dataclass(frozen=True)
+class ApiSettings:
+    enabled: bool
+    host: str
+    port: int
+    max_points: int
+    max_queries: int
+    cache_bytes: int
+
+
+@dataclass(frozen=True)
+class StatsSettings:
+    horizons: tuple
+    window: float
+    accuracy: float
+
+
+@dataclass(frozen=True)
+class LoggingSettings:
+    enabled: bool
+    level: int
+    file: str
+    max_bytes: int
+    backup_count: int
+    queue_size: int
+
+
+@dataclass(frozen=True)
+class ForecastSettings:
+    enabled: bool
+    alpha: float
+    beta: float
+    gamma: float
+    confidence: float
+
+    @property
+    def z(self):
+        """Standard deviations on each side of the projection that hold the confidence of the outcomes"""
+        return NormalDist().inv_cdf(0.5 + self.confidence / 2)
+
+
+@dataclass(frozen=True)
+class ConntrackSettings:
+    enabled: bool
+    file: str
+    interval: float
+    capacity: int
+    top: int
+    networks: tuple
+
+
+@dataclass(frozen=True)
+class CheckpointSettings:
+    enabled: bool
+    file: str
+    interval: float
+
+
+@dataclass(frozen=True)
+class RuleSettings:
+    """A threshold rule from [RULE:<name>], the disable trigger or the notification threshold"""
+    name: str
+    metric: str
+    interface: str
+    threshold: float
+    action: str
+    command: str
+    path: str
+    hysteresis: float
+    rearm: str
+    cooldown: float
+
+
+@dataclass(frozen=True)
+class Settings:
+    network: NetworkSettings
+    database: DatabaseSettings
+    email: EmailSettings
+    mqtt: MQTTSettings
+    numpad: NumpadSettings
+    commands: CommandSettings
+    stats: StatsSettings
+    api: ApiSettings
+    logging: LoggingSettings
+    rules: tuple
+    forecast: ForecastSettings
+    conntrack: ConntrackSettings
+    checkpoint: CheckpointSettings
+
+
+class ConfigParser(configparser.ConfigParser):
+    """ConfigParser that names the section and option of a value that isn't a number or boolean"""
+
+    def getint(self, section, option, **kwargs):
+        return self.convert(super().getint, section, option, **kwargs)
+
+    def getfloat(self, section, option, **kwargs):
+        return self.convert(super().getfloat, section, option, **kwargs)
+
+    def getboolean(self, section, option, **kwargs):
+        return self.convert(super().getboolean, section, option, **kwargs)
+
+    def convert(self, get, section, option, **kwargs):
+        try:
+            return get(section, option, **kwargs)
+        except ValueError as e:
+            raise ValueError(f'{option} in [{section}] has an invalid value: {e}') from e
+
+
+# Names of the options with the path of each MQTT feed
+FEEDS = ['recievepath', 'sendpath', 'recieveplussendpath', 'totalnetworkusagepath', 'todaynetworkusagepath',
+         'recieveaveragepath', 'sendaveragepath', 'forecastpath', 'forecasthighpath',
+         'toptalkerspath']
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+ENGINES = ('sqlite', 'segments')
+BACKENDS = ('adafruit', 'mqtt')
+
+# Values a rule can watch, what it can do and when it can fire again
+RULE_METRICS = ('total', 'received', 'send', 'today', 'rate', 'forecast')
+RULE_ACTIONS = ('command', 'email', 'mqtt', 'down')
+REARM_MODES = ('below', 'never')
+
+# Multipliers of the units that can be put behind a size
+UNITS = {'k': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4}
+
+# The notification threshold is doubled after every E-Mail up to this total when ResetAfterTrigger is set
+NOTIFICATION_LIMIT = 1000 ** 5
+
+
+def load(path='config.cfg', overrides=None):
+    """Read the config file and turn it into settings
+
+    Args:
+        path: path of the config file.
+        overrides: dictionary with sections of options that replace the ones in the file.
+    Returns:
+        The settings of the whole program.
+    Raises:
+        ValueError: the config file can't be read, misses an option or has an invalid value.
+    """
+    config = ConfigParser()
+    try:
+        if not config.read(path):
+            raise ValueError(f'Config file "{path}" can\'t be read')
+        config.read_dict(overrides or {})
+    except configparser.Error as e:
+        raise ValueError(e.message) from e
+    return parse(config)
+
+
+def parse(config):
+    """Turn a parsed config file into settings
+
+    Args:
+        config: the parsed config file.
+    Returns:
+        The settings of the whole program.
+    Raises:
+        ValueError: an option is missing or has an invalid value.
+    """
+    try:
+        network, email = parse_network(config), parse_email(config)
+        settings = Settings(network, parse_database(config), email,
+                            parse_mqtt(config), parse_numpad(config), parse_commands(config),
+                            parse_stats(config), parse_api(config), parse_logging(config),
+                            parse_rules(config, network, email), parse_forecast(config),
+                            parse_conntrack(config), parse_checkpoint(config))
+    except configparser.Error as e:
+        raise ValueError(e.message) from e
+
+    if settings.network.measure_delay <= 0:
+        raise ValueError('MeasureDelay in [NETWORK] must be more than 0')
+    if settings.network.slow_start_warning <= 0:
+        raise ValueError('SlowStartWarning in [NETWORK] must be more than 0')
+    if not settings.network.interfaces:
+        raise ValueError('There are no interfaces set in [NETWORK]')
+    if settings.database.synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f'Synchronous in [DATABASE] must be one of {", ".join(SYNCHRONOUS_MODES)}')
+    if settings.database.engine not in ENGINES:
+        raise ValueError(f'Engine in [DATABASE] must be one of {", ".join(ENGINES)}')
+    if settings.mqtt.enabled and settings.mqtt.backend not in BACKENDS:
+        raise ValueError(f'Backend in [MQTT] must be one of {", ".join(BACKENDS)}')
+    if not settings.stats.horizons or min(settings.stats.horizons) <= 0 or settings.stats.window <= 0:
+        raise ValueError('Horizons and Window in [STATS] must be more than 0')
+    if not 0 < settings.stats.accuracy < 1:
+        raise ValueError('Accuracy in [STATS] must be between 0 and 1')
+    if settings.api.max_points < 1 or settings.api.max_queries < 1:
+        raise ValueError('MaxPoints and MaxQueries in [API] must be at least 1')
+    if not 0 <= settings.mqtt.qos <= 2:
+        raise ValueError('QoS in [MQTT] must be 0, 1 or 2')
+    if not all(0 < value < 1 for value in (settings.forecast.alpha, settings.forecast.beta,
+                                           settings.forecast.gamma, settings.forecast.confidence)):
+        raise ValueError('Alpha, Beta, Gamma and Confidence in [FORECAST] must be between 0 and 1')
+    if settings.conntrack.interval <= 0 or not 1 <= settings.conntrack.top <= settings.conntrack.capacity:
+        raise ValueError('Interval in [CONNTRACK] must be more than 0 and Top between 1 and Capacity')
+    if settings.checkpoint.interval <= 0:
+        raise ValueError('Interval in [CHECKPOINT] must be more than 0')
+    for rule in settings.rules:
+        check_rule(rule, settings.network.names)
+    return settings
+
+
+def check_rule(rule, names):
+    # Raise a ValueError when a rule can't work
+    section = f'[RULE:{rule.name}]'
+    if rule.metric not in RULE_METRICS:
+        raise ValueError(f'Metric in {section} must be one of {", ".join(RULE_METRICS)}')
+    if rule.action not in RULE_ACTIONS:
+        raise ValueError(f'Action in {section} must be one of {", ".join(RULE_ACTIONS)}')
+    if rule.rearm not in REARM_MODES:
+        raise ValueError(f'Rearm in {section} must be one of {", ".join(REARM_MODES)}')
+    if rule.interface != 'all' and rule.interface not in names:
+        raise ValueError(f'Interface in {section} must be all or one of the interfaces in [NETWORK]')
+    if rule.action == 'command' and not rule.command:
+        raise ValueError(f'{section} needs a Command')
+    if rule.action == 'mqtt' and not rule.path:
+        raise ValueError(f'{section} needs a Path')
+    if rule.hysteresis < 0 or rule.cooldown < 0:
+        raise ValueError(f'Hysteresis and Cooldown in {section} can\'t be negative')
+
+
+def parse_size(text):
+    """Turn a size like 500M or 20G into a number, k, M, G and T are multiples of 1000"""
+    text = text.strip()
+    if text[-1:] in UNITS:
+        return float(text[:-1]) * UNITS[text[-1]]
+    return float(text)
+
+
+def parse_network(config):
+    # Every interface can overrule the options in [NETWORK] in its own section
+    names = [name.strip() for name in config.get('NETWORK', 'interface').split(',') if name.strip()]
+    interfaces = []
+    for name in names:
+        section = f'NETWORK:{name}' if config.has_section(f'NETWORK:{name}') else 'NETWORK'
+        trigger = config.getboolean(section, 'disabletrigger',
+                                    fallback=config.getboolean('NETWORK', 'disabletrigger', fallback=False))
+        threshold = config.getint(section, 'disablethreshold',
+                                  fallback=config.getint('NETWORK', 'disablethreshold', fallback=0))
+        command = config.get(section, 'disablecommand',
+                             fallback=config.get('NETWORK', 'disablecommand', fallback=''))
+        interfaces.append(InterfaceSettings(name, trigger, threshold, command))
+
+    return NetworkSettings(tuple(interfaces), config.getfloat('NETWORK', 'measuredelay'),
+                           config.getboolean('NETWORK', 'startonboot', fallback=False),
+                           config.getfloat('NETWORK', 'sampleinterval', fallback=0),
+                           config.getfloat('NETWORK', 'slowstartwarning', fallback=10))
+
+
+def parse_database(config):
+    section = 'DATABASE'
+    return DatabaseSettings(
+        enabled=config.getboolean(section, 'enabled'),
+        file=config.get(section, 'file'),
+        data_move_interval=config.getint(section, 'datamoveinterval'),
+        flush_rows=config.getint(section, 'flushrows', fallback=1),
+        flush_interval=config.getfloat(section, 'flushinterval', fallback=0),
+        synchronous=config.get(section, 'synchronous', fallback='NORMAL').upper(),
+        raw_retention=config.getint(section, 'rawretention', fallback=2 * 86400),
+        minute_retention=config.getint(section, 'minuteretention', fallback=7 * 86400),
+        hour_retention=config.getint(section, 'hourretention', fallback=90 * 86400),
+        day_retention=config.getint(section, 'dayretention', fallback=0),
+        compact_batch=config.getint(section, 'compactbatch', fallback=500),
+        engine=config.get(section, 'engine', fallback='sqlite').lower(),
+        segment_size=config.getint(section, 'segmentsize', fallback=4 * 1024 * 1024))
+
+
+def parse_email(config):
+    section = 'EMAIL'
+    return EmailSettings(
+        enabled=config.getboolean(section, 'enabled'),
+        ssl=config.getboolean(section, 'ssl'),
+        timeout=config.getint(section, 'timeout'),
+        file=config.get(section, 'file'),
+        host=config.get(section, 'host'),
+        port=config.getint(section, 'port'),
+        login=config.getboolean(section, 'login'),
+        username=config.get(section, 'username'),
+        password=config.get(section, 'password'),
+        receiver=config.get(section, 'emailreciever'),
+        client_name=config.get(section, 'clientname'),
+        subject=config.get(section, 'subject'),
+        notification_threshold=config.getint(section, 'notificationthreshold'),
+        reset_after_trigger=config.getboolean(section, 'resetaftertrigger', fallback=False),
+        idle_timeout=config.getfloat(section, 'idletimeout', fallback=60),
+        batch_delay=config.getfloat(section, 'batchdelay', fallback=5))
+
+
+def parse_mqtt(config):
+    section = 'MQTT'
+
+    # Every feed setting can be set for a single feed by putting the option name of the feed before it
+    deadband = config.getfloat(section, 'deadband', fallback=0)
+    min_interval = config.getfloat(section, 'mininterval', fallback=0)
+    max_interval = config.getfloat(section, 'maxinterval', fallback=0)
+    feeds = {}
+    for nick in FEEDS:
+        path = config.get(section, nick, fallback=None)
+        if path is None:
+            continue
+        feeds[nick] = FeedSettings(nick, path, config.getfloat(section, f'{nick}deadband', fallback=deadband),
+                                   config.getfloat(section, f'{nick}mininterval', fallback=min_interval),
+                                   config.getfloat(section, f'{nick}maxinterval', fallback=max_interval))
+
+    return MQTTSettings(
+        enabled=config.getboolean(section, 'enabled'),
+        backend=config.get(section, 'backend', fallback='adafruit').lower(),
+        username=config.get(section, 'username', fallback=None),
+        key=config.get(section, 'key', fallback=None),
+        host=config.get(section, 'host', fallback='localhost'),
+        port=config.getint(section, 'port', fallback=1883),
+        tls=config.getboolean(section, 'tls', fallback=False),
+        prefix=config.get(section, 'prefix', fallback=''),
+        qos=config.getint(section, 'qos', fallback=0),
+        keepalive=config.getint(section, 'keepalive', fallback=60),
+        max_inflight=config.getint(section, 'maxinflight', fallback=20),
+        reconnect_min=config.getfloat(section, 'reconnectmin', fallback=1),
+        reconnect_max=config.getfloat(section, 'reconnectmax', fallback=120),
+        feeds=MappingProxyType(feeds),
+        queue_size=config.getint(section, 'queuesize', fallback=100),
+        drain_batch=config.getint(section, 'drainbatch', fallback=10),
+        drain_delay=config.getfloat(section, 'draindelay', fallback=1))
+
+
+def parse_numpad(config):
+    section = 'MQTTNUMPAD'
+
+    # The commands are named command<button>, the button is the payload that is received
+    commands = {option[len('command'):]: value for option, value in config.items(section)
+                if option.startswith('command')}
+    return NumpadSettings(config.getboolean(section, 'enabled'), config.get(section, 'subcribepath', fallback=''),
+                          MappingProxyType(commands))
+
+
+def parse_commands(config):
+    return CommandSettings(config.getint('COMMANDS', 'maxconcurrent', fallback=4),
+                           config.getfloat('COMMANDS', 'timeout', fallback=60))
+
+
+def parse_stats(config):
+    horizons = config.get('STATS', 'horizons', fallback='60, 300, 900')
+    return StatsSettings(tuple(float(horizon) for horizon in horizons.split(',')),
+                         config.getfloat('STATS', 'window', fallback=900),
+                         config.getfloat('STATS', 'accuracy', fallback=0.02))
+
+
+def parse_api(config):
+    section = 'API'
+    return ApiSettings(
+        enabled=config.getboolean(section, 'enabled', fallback=False),
+        host=config.get(section, 'host', fallback='127.0.0.1'),
+        port=config.getint(section, 'port', fallback=8080),
+        max_points=config.getint(section, 'maxpoints', fallback=2000),
+        max_queries=config.getint(section, 'maxqueries', fallback=2),
+        cache_bytes=config.getint(section, 'cachebytes', fallback=4000000))
+
+
+def parse_logging(config):
+    section = 'LOGGING'
+    return LoggingSettings(
+        enabled=config.getboolean(section, 'enabled'),
+        level=config.getint(section, 'level'),
+        file=config.get(section, 'file', fallback=''),
+        max_bytes=config.getint(section, 'maxbytes', fallback=1000000),
+        backup_count=config.getint(section, 'backupcount', fallback=3),
+        queue_size=config.getint(section, 'queuesize', fallback=1000))
+
+
+def parse_rules(config, network, email):
+    # The disable trigger of each interface and the notification threshold are rules as well
+    rules = [disable_rule(settings.name, settings.disable_threshold, settings.disable_command)
+             for settings in network.interfaces if settings.disable_trigger]
+    if email.enabled:
+        rules += notification_rules(email.notification_threshold, email.reset_after_trigger)
+
+    for section in config.sections():
+        if not section.startswith('RULE:'):
+            continue
+        try:
+            threshold = parse_size(config.get(section, 'threshold'))
+            hysteresis = parse_size(config.get(section, 'hysteresis', fallback='0'))
+        except ValueError:
+            raise ValueError(f'Threshold and Hysteresis in [{section}] must be sizes like 500M or 20G')
+        rules.append(RuleSettings(
+            name=section[len('RULE:'):],
+            metric=config.get(section, 'metric', fallback='total').lower(),
+            interface=config.get(section, 'interface', fallback='all'),
+            threshold=threshold,
+            action=config.get(section, 'action').lower(),
+            command=config.get(section, 'command', fallback=''),
+            path=config.get(section, 'path', fallback=''),
+            hysteresis=hysteresis,
+            rearm=config.get(section, 'rearm', fallback='below').lower(),
+            cooldown=config.getfloat(section, 'cooldown', fallback=0)))
+    return tuple(rules)
+
+
+def disable_rule(interface, threshold, command='', name=None):
+    """The disable trigger of an interface as a rule, it fires when the total of the interface passes the threshold"""
+    return RuleSettings(name or f'disable-{interface}', 'total', interface, threshold,
+                        'command', command, '', 0, 'below', 0)
+
+
+def notification_rules(threshold, double=False, prefix='notification'):
+    """The rules of the notification E-Mail, with double every doubling of the threshold is its own rule
+
+    Args:
+        threshold: total of all interfaces in bytes at which the first E-Mail is send.
+        double: keep sending an E-Mail every time the total doubled, like ResetAfterTrigger.
+        prefix: start of the name of each rule, the threshold is added to it.
+    Returns:
+        List with the rules, empty when the threshold is 0.
+    """
+    rules = []
+    while 0 < threshold <= NOTIFICATION_LIMIT:
+        rules.append(RuleSettings(f'{prefix}-{threshold}', 'total', 'all', threshold, 'email', '', '', 0, 'below', 0))
+        if not double:
+            break
+        threshold *= 2
+    return rules
+
+
+def parse_forecast(config):
+    section = 'FORECAST'
+    return ForecastSettings(
+        enabled=config.getboolean(section, 'enabled', fallback=True),
+        alpha=config.getfloat(section, 'alpha', fallback=0.3),
+        beta=config.getfloat(section, 'beta', fallback=0.05),
+        gamma=config.getfloat(section, 'gamma', fallback=0.2),
+        confidence=config.getfloat(section, 'confidence', fallback=0.9))
+
+
+def parse_conntrack(config):
+    section = 'CONNTRACK'
+    networks = config.get(section, 'networks', fallback='')
+    try:
+        networks = tuple(ipaddress.ip_network(network.strip(), strict=False)
+                         for network in networks.split(',') if network.strip())
+    except ValueError:
+        raise ValueError('Networks in [CONNTRACK] must be addresses like 192.168.1.0/24 separated by commas')
+    return ConntrackSettings(
+        enabled=config.getboolean(section, 'enabled', fallback=False),
+        file=config.get(section, 'file', fallback='/proc/net/nf_conntrack'),
+        interval=config.getfloat(section, 'interval', fallback=60),
+        capacity=config.getint(section, 'capacity', fallback=64),
+        top=config.getint(section, 'top', fallback=10),
+        networks=networks)
+
+
+def parse_checkpoint(config):
+    section = 'CHECKPOINT'
+    return CheckpointSettings(
+        enabled=config.getboolean(section, 'enabled', fallback=True),
+        file=config.get(section, 'file', fallback='./checkpoint.json'),
+        interval=config.getfloat(section, 'interval', fallback=60))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module that keeps running statistics of the rates of each interface
+
+Every measurement updates the statistics in constant time and memory:
+exponentially weighted averages over several horizons like the load average,
+the minimum, maximum and mean over a sliding window and percentiles from a fixed size sketch.
+The results are stored as attributes, so other modules read them without any calculation or query.
+Only the percentiles walk the buckets of the sketch, they are calculated when they are read after an update.
+"""
+
+import math
+from array import array
+from collections import deque
+from . import processor
+
+# Statistics of the received and send rate of each interface, None holds the sum of all interfaces
+stats = {}
+
+# Percentiles that are estimated
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Sketch:
+    """Histogram with logarithmic buckets to estimate percentiles in fixed memory.
+
+    Every bucket is a factor gamma wider than the previous one,
+    so each estimate is within the relative accuracy of the actual value.
+    Values can be removed again, which makes it usable for a sliding window.
+
+    Args:
+        accuracy: relative error of the estimates, 0.02 is 2%.
+        maximum: the largest value, larger values are counted in the last bucket.
+    """
+
+    def __init__(self, accuracy=0.02, maximum=1e10):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = array('Q', bytes(8 * (math.ceil(math.log(maximum) / self.log_gamma) + 2)))
+        self.count = 0
+
+    def bucket(self, value):
+        """Index of the bucket a value is counted in, values below 1 are in the first bucket"""
+        if value < 1:
+            return 0
+        return min(len(self.counts) - 1, 1 + math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, bucket):
+        self.counts[bucket] += 1
+        self.count += 1
+
+    def remove(self, bucket):
+        self.counts[bucket] -= 1
+        self.count -= 1
+
+    def quantiles(self, qs):
+        """Estimate the values below which each fraction in qs of the values are.
+
+        All estimates are found in a single pass over the buckets.
+
+        Args:
+            qs: the fractions in increasing order.
+        Returns:
+            List with the estimate of each fraction, None when the sketch is empty.
+        """
+        if not self.count:
+            return [None] * len(qs)
+        results = []
+        seen = 0
+        buckets = iter(enumerate(self.counts))
+        for q in qs:
+            rank = q * (self.count - 1)
+            while seen <= rank:
+                bucket, count = next(buckets)
+                seen += count
+
+            # The middle of the bucket has the smallest relative error
+            results.append(0.0 if bucket == 0 else 2 * self.gamma ** (bucket - 1) / (self.gamma + 1))
+        return results
+
+
+class RateStats:
+    """Statistics of a single rate.
+
+    Args:
+        horizons: seconds of each exponentially weighted average.
+        window: seconds of the sliding window.
+        accuracy: relative accuracy of the percentiles.
+
+    Attributes:
+        rate: the last rate.
+        averages: the exponentially weighted average of each horizon.
+        minimum, maximum, mean: of the rates in the sliding window.
+        percentiles: estimate of each quantile in QUANTILES over the sliding window.
+    """
+
+    def __init__(self, horizons, window, accuracy=0.02):
+        self.horizons = horizons
+        self.window = window
+        self.sketch = Sketch(accuracy)
+
+        # Rates in the window with their time and sketch bucket and the running sum of them
+        self.samples = deque()
+        self.total = 0.0
+
+        # Candidates for the minimum and maximum, the first one is the current minimum or maximum
+        self.lows = deque()
+        self.highs = deque()
+
+        self.rate = None
+        self.averages = [None] * len(horizons)
+        self.minimum = self.maximum = self.mean = None
+
+        # The percentiles since the last update, None when they have to be estimated again
+        self.estimated = None
+
+    def update(self, now, rate, elapsed):
+        """Add a new rate.
+
+        Args:
+            now: monotonic time of the measurement.
+            rate: the new rate.
+            elapsed: seconds since the previous rate.
+        """
+        self.rate = rate
+
+        # The weight depends on the time that passed, so irregular measurements are averaged correctly
+        for i, horizon in enumerate(self.horizons):
+            average = self.averages[i]
+            if average is None:
+                self.averages[i] = rate
+            else:
+                self.averages[i] = average + (1 - math.exp(-elapsed / horizon)) * (rate - average)
+
+        bucket = self.sketch.bucket(rate)
+        self.sketch.add(bucket)
+        self.samples.append((now, rate, bucket))
+        self.total += rate
+
+        # Rates that can never be the minimum or maximum anymore are dropped right away
+        while self.lows and self.lows[-1][1] >= rate:
+            self.lows.pop()
+        self.lows.append((now, rate))
+        while self.highs and self.highs[-1][1] <= rate:
+            self.highs.pop()
+        self.highs.append((now, rate))
+
+        # Remove the rates that left the window
+        cutoff = now - self.window
+        while self.samples[0][0] <= cutoff:
+            _, old, old_bucket = self.samples.popleft()
+            self.total -= old
+            self.sketch.remove(old_bucket)
+        while self.lows[0][0] <= cutoff:
+            self.lows.popleft()
+        while self.highs[0][0] <= cutoff:
+            self.highs.popleft()
+
+        self.minimum = self.lows[0][1]
+        self.maximum = self.highs[0][1]
+        self.mean = self.total / len(self.samples)
+        self.estimated = None
+
+    @property
+    def percentiles(self):
+        """Estimate of each quantile in QUANTILES, only the first read after an update walks the sketch"""
+        if self.estimated is None:
+            self.estimated = dict(zip(QUANTILES, self.sketch.quantiles(QUANTILES)))
+        return self.estimated
+
+
+def enable():
+    # Create the statistics of every interface and of the sum of all interfaces
+    settings = processor.settings.stats
+    for name in processor.settings.network.names + [None]:
+        stats[name] = (RateStats(settings.horizons, settings.window, settings.accuracy),
+                       RateStats(settings.horizons, settings.window, settings.accuracy))
+
+
+def update(sample):
+    # Update the statistics with the received and send bytes per second of a measurement
+    if sample.elapsed <= 0:
+        return
+    total_rx, total_tx = 0, 0
+    for name, (rx, tx) in sample.deltas.items():
+        total_rx += rx
+        total_tx += tx
+        rx_stats, tx_stats = stats[name]
+        rx_stats.update(sample.monotonic, rx / sample.elapsed, sample.elapsed)
+        tx_stats.update(sample.monotonic, tx / sample.elapsed, sample.elapsed)
+
+    rx_stats, tx_stats = stats[None]
+    rx_stats.update(sample.monotonic, total_rx / sample.elapsed, sample.elapsed)
+    tx_stats.update(sample.monotonic, total_tx / sample.elapsed, sample.elapsed)
+
+
+def get(name=None):
+    """Receive the statistics of an interface
+
+    Args:
+        name: name of the interface, None for the sum of all interfaces.
+    Returns:
+        The statistics of the received and send rate in bytes per second.
+    """
+    return stats[name]
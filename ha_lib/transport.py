@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module with the ways values can be send to an MQTT server
+
+Every transport publishes without blocking the caller.
+Messages are handed to a background thread that sends them and reconnects when the connection drops.
+Paho is only imported when a transport that needs it is made, so it isn't loaded when MQTT is disabled.
+"""
+
+import abc
+import random
+import threading
+from . import logger
+
+# The paho client module, None until it is needed
+paho = None
+
+
+class Transport(abc.ABC):
+    """Base class of all transports, a transport that doesn't implement publish can't be made.
+
+    Attributes:
+        on_message: function that is called with the feed and payload of received messages.
+            This is called from the thread of the transport.
+        published: amount of messages handed over to the server.
+        failed: amount of messages that couldn't be send.
+    """
+
+    def __init__(self):
+        self.on_message = None
+        self.published = 0
+        self.failed = 0
+
+    def connect(self):
+        """Start connecting in the background, this never blocks"""
+
+    def close(self):
+        """Disconnect and stop the background thread"""
+
+    def is_connected(self):
+        """Check if messages can be send right now"""
+        return True
+
+    @abc.abstractmethod
+    def publish(self, feed, value):
+        """Send a value to a feed without waiting for it.
+
+        Returns:
+            True when the message has been handed over.
+        """
+
+    def subscribe(self, feed):
+        """Receive the messages of a feed, this is kept after reconnecting"""
+
+    def in_flight(self):
+        """Amount of messages that have been published but aren't confirmed by the server yet"""
+        return 0
+
+
+class MQTTTransport(Transport):
+    """Transport to any MQTT server, for example mosquitto on localhost.
+
+    Args:
+        host: hostname of the server.
+        port: port of the server.
+        username: username to login with, None to not login.
+        password: password to login with.
+        tls: use an encrypted connection.
+        prefix: text put in front of each feed to make its topic.
+        qos: quality of service of published messages.
+        keepalive: seconds between two keepalive messages.
+        max_inflight: most messages that may wait for a confirmation of the server at the same time.
+        reconnect_min: seconds before the first reconnect attempt.
+        reconnect_max: most seconds between two reconnect attempts.
+    """
+
+    def __init__(self, host, port=1883, username=None, password=None, tls=False, prefix='',
+                 qos=0, keepalive=60, max_inflight=20, reconnect_min=1, reconnect_max=120):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.qos = qos
+        self.keepalive = keepalive
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.subscriptions = set()
+        self.connected = False
+        self.closing = False
+        self.unconfirmed = set()
+        self.lock = threading.Lock()
+
+        # Messages the server confirmed before publish registered them, paho runs that on its own thread
+        self.confirmed = set()
+
+        import_paho()
+
+        # Paho 2 wants to know which version of the callbacks we use
+        try:
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+        except AttributeError:
+            self.client = paho.Client()
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        if tls:
+            self.client.tls_set()
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(reconnect_min, reconnect_max)
+        self.client.on_connect = self.handle_connect
+        self.client.on_disconnect = self.handle_disconnect
+        self.client.on_message = self.handle_message
+        self.client.on_publish = self.handle_publish
+
+    def connect(self):
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def close(self):
+        self.closing = True
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, feed, value):
+        info = self.client.publish(self.prefix + feed, value, qos=self.qos)
+        if info.rc != paho.MQTT_ERR_SUCCESS:
+            self.failed += 1
+            return False
+        self.published += 1
+        if self.qos > 0:
+            with self.lock:
+                if info.mid in self.confirmed or info.is_published():
+                    self.confirmed.discard(info.mid)
+                else:
+                    self.unconfirmed.add(info.mid)
+        return True
+
+    def subscribe(self, feed):
+        self.subscriptions.add(feed)
+        if self.connected:
+            self.client.subscribe(self.prefix + feed)
+
+    def in_flight(self):
+        return len(self.unconfirmed)
+
+    def handle_connect(self, client, userdata, flags, rc, *args):
+        if rc != 0:
+            logger.warn(f'MQTT server refused the connection: {rc}')
+            return
+        self.connected = True
+        self.client.reconnect_delay_set(self.reconnect_min, self.reconnect_max)
+        for feed in self.subscriptions:
+            self.client.subscribe(self.prefix + feed)
+        logger.debug(f'Connected to MQTT server {self.host}')
+
+    def handle_disconnect(self, client, userdata, *args):
+        self.connected = False
+        if self.closing:
+            return
+
+        # Spread the reconnects of many gateways so they don't all hit the server at the same time
+        self.client.reconnect_delay_set(random.uniform(self.reconnect_min, 2 * self.reconnect_min),
+                                        self.reconnect_max)
+        logger.warn('MQTT disconnected! Values are queued until it reconnects')
+
+    def handle_message(self, client, userdata, message):
+        if self.on_message is None or not message.topic.startswith(self.prefix):
+            return
+        feed = message.topic[len(self.prefix):]
+        self.on_message(feed, message.payload.decode('utf-8', 'replace'))
+
+    def handle_publish(self, client, userdata, mid, *args):
+        if self.qos == 0:
+            return
+        with self.lock:
+            if mid in self.unconfirmed:
+                self.unconfirmed.discard(mid)
+            else:
+                self.confirmed.add(mid)
+
+
+class AdafruitTransport(MQTTTransport):
+    """Transport to Adafruit IO, feeds are published under the feeds of the user.
+
+    Args:
+        username: Adafruit IO username.
+        key: Adafruit IO key.
+        qos: quality of service, Adafruit IO only supports 0 and 1.
+        keepalive: seconds between two keepalive messages.
+        max_inflight: most messages that may wait for a confirmation of the server at the same time.
+    """
+
+    def __init__(self, username, key, qos=0, keepalive=60, max_inflight=20, **kwargs):
+        super().__init__('io.adafruit.com', 8883, username, key, tls=True, prefix=f'{username}/feeds/',
+                         qos=min(qos, 1), keepalive=keepalive, max_inflight=max_inflight, **kwargs)
+
+
+class MemoryTransport(Transport):
+    """Transport that keeps the messages in memory, a stand-in for a server in tests and benchmarks.
+
+    It can't be set as Backend in the config file because it sends nothing, tests make it themselves.
+
+    Attributes:
+        values: the last value published on each feed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def publish(self, feed, value):
+        self.values[feed] = value
+        self.published += 1
+        return True
+
+
+def import_paho():
+    # Import the paho client the first time it is needed
+    global paho
+    if paho is None:
+        import paho.mqtt.client as client
+        paho = client
+    return paho
+
+
+def from_settings(settings):
+    """Create the transport set in the [MQTT] section of the config file
+
+    Args:
+        settings: the MQTT settings.
+    Returns:
+        A transport that isn't connected yet.
+    """
+    options = {
+        'qos': settings.qos,
+        'keepalive': settings.keepalive,
+        'max_inflight': settings.max_inflight,
+        'reconnect_min': settings.reconnect_min,
+        'reconnect_max': settings.reconnect_max,
+    }
+    if settings.backend == 'adafruit':
+        return AdafruitTransport(settings.username, settings.key, **options)
+    if settings.backend == 'mqtt':
+        return MQTTTransport(settings.host, settings.port, settings.username, settings.key,
+                             settings.tls, settings.prefix, **options)
+    raise ValueError(f'Unknown MQTT backend "{settings.backend}"')
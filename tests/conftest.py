@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import pytest
+
+# The tests import ha_lib from the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ha_lib import processor, settings as settings_module
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    """Load the config file of the repository as the settings of the program
+
+    Returns:
+        Function that loads the settings with the given sections of options replaced.
+    """
+    def load(overrides=None):
+        loaded = settings_module.load(os.path.join(ROOT, 'config.cfg'), overrides)
+        monkeypatch.setattr(processor, 'settings', loaded)
+        return loaded
+    return load
+
+
+@pytest.fixture(params=['sqlite', 'segments'])
+def stored(request, settings, tmp_path):
+    """Database with a measurement every 5 minutes of the last 30 days, compacted like a running program
+
+    The raw measurements are kept in both engines.
+
+    Returns:
+        The timestamp the measurements end at.
+    """
+    from ha_lib import database
+    settings({'DATABASE': {'File': str(tmp_path / 'data.sqlite'), 'Engine': request.param},
+              'CHECKPOINT': {'Enabled': 'False'}})
+    database.enable()
+    assert database.enabled
+    now = int(time.time()) // 3600 * 3600
+    rows = [(timestamp, 'eth0', timestamp - now + 30 * 86400, 0, 0)
+            for timestamp in range(now - 30 * 86400, now, 300)]
+
+    def fill():
+        database.buffer.extend(rows)
+        database.flush()
+        while database.maintain(now):
+            pass
+    database.worker.submit(fill).result()
+    yield now
+    database.close()
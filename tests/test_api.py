@@ -0,0 +1,62 @@
+import json
+import asyncio
+from ha_lib import api, processor
+
+
+async def get(target):
+    """Send a request to a running API and receive the status and the decoded body"""
+    server = await asyncio.start_server(api.handle, '127.0.0.1', 0)
+    async with server:
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = int(head.split()[1])
+    if b'Transfer-Encoding: chunked' in head:
+        chunks = []
+        while True:
+            size, _, body = body.partition(b'\r\n')
+            if int(size, 16) == 0:
+                break
+            chunks.append(body[:int(size, 16)])
+            body = body[int(size, 16) + 2:]
+        body = b''.join(chunks)
+    return status, json.loads(body)
+
+
+def history(target, monkeypatch):
+    monkeypatch.setattr(api, 'queries', asyncio.Semaphore(processor.settings.api.max_queries))
+    monkeypatch.setattr(api, 'cache', type(api.cache)())
+    monkeypatch.setattr(api, 'cache_size', 0)
+    return asyncio.run(get(target))
+
+
+def test_history_past_minute_retention(stored, monkeypatch):
+    # With MaxPoints a range of 30 days asks for a row every 1296 seconds, which the minutes only have for 7 days
+    status, content = history(f'/history?start={stored - 30 * 86400}&end={stored}', monkeypatch)
+    assert status == 200
+    assert content['columns'] == ['timestamp', 'interface', 'received', 'send']
+    timestamps = [row[0] for row in content['rows']]
+    assert len(timestamps) <= processor.settings.api.max_points
+    assert timestamps[0] <= stored - 29 * 86400
+    assert max(timestamps) >= stored - 1296
+
+    # The hours fill in the days before the retention of the minutes
+    assert len([timestamp for timestamp in timestamps if timestamp < stored - 8 * 86400]) >= 20 * 24
+
+    # The range is over, so the whole response is cached
+    assert len(api.cache) == 1
+
+
+def test_history_points(stored, monkeypatch):
+    status, content = history(f'/history?start={stored - 10 * 86400}&end={stored - 8 * 86400}&points=48',
+                              monkeypatch)
+    assert status == 200
+    assert len(content['rows']) == 48
+
+
+def test_history_bad_range(stored, monkeypatch):
+    status, content = history(f'/history?start={stored}&end={stored - 1}', monkeypatch)
+    assert status == 400 and 'error' in content
@@ -0,0 +1,106 @@
+import ipaddress
+import pytest
+from ha_lib import conntrack
+
+# A table with a TCP and UDP connection from the LAN, one from the internet and one without accounting
+TABLE = '''\
+ipv4     2 tcp      6 431999 ESTABLISHED src=192.168.1.10 dst=1.1.1.1 sport=50000 dport=443 packets=10 bytes=1000 src=1.1.1.1 dst=192.168.1.10 sport=443 dport=50000 packets=20 bytes=5000 [ASSURED] mark=0 use=1
+ipv4     2 udp      17 30 src=192.168.1.11 dst=8.8.8.8 sport=5353 dport=53 packets=1 bytes=60 src=8.8.8.8 dst=192.168.1.11 sport=53 dport=5353 packets=1 bytes=120 mark=0 use=1
+ipv4     2 tcp      6 30 ESTABLISHED src=203.0.113.5 dst=192.168.1.10 sport=40000 dport=22 packets=1 bytes=70 src=192.168.1.10 dst=203.0.113.5 sport=22 dport=40000 packets=1 bytes=90 mark=0 use=1
+ipv4     2 tcp      6 30 ESTABLISHED src=192.168.1.12 dst=1.1.1.1 sport=50001 dport=443 src=1.1.1.1 dst=192.168.1.12 sport=443 dport=50001 mark=0 use=1
+'''
+
+LAN = [ipaddress.ip_network('192.168.0.0/16')]
+
+
+@pytest.fixture
+def table(tmp_path):
+    """Write a conntrack table and return a function that replaces it"""
+    path = tmp_path / 'nf_conntrack'
+
+    def write(content):
+        path.write_text(content)
+        return str(path)
+    write(TABLE)
+    return write
+
+
+def grow(send, received):
+    # The first connection with other byte counts
+    line = TABLE.splitlines()[0]
+    return line.replace('bytes=1000', f'bytes={send}').replace('bytes=5000', f'bytes={received}')
+
+
+def test_parse():
+    connections = list(conntrack.parse(TABLE.splitlines()))
+    assert [(address, send, received) for _, address, send, received in connections] == [
+        ('192.168.1.10', 1000, 5000), ('192.168.1.11', 60, 120), ('203.0.113.5', 70, 90)]
+    assert len({key for key, *_ in connections}) == 3
+
+
+def test_scan(table):
+    hosts, flows = conntrack.scan(table(TABLE), {})
+    assert hosts == {'192.168.1.10': (5000, 1000), '192.168.1.11': (120, 60), '203.0.113.5': (90, 70)}
+    assert len(flows) == 3
+
+
+def test_scan_networks(table):
+    hosts, flows = conntrack.scan(table(TABLE), {}, LAN)
+    assert hosts == {'192.168.1.10': (5000, 1000), '192.168.1.11': (120, 60)}
+
+    # The connections of hosts that aren't counted aren't kept either
+    assert len(flows) == 2
+
+
+def test_scan_growth(table):
+    _, flows = conntrack.scan(table(TABLE), {}, LAN)
+    lines = TABLE.splitlines()
+    hosts, flows = conntrack.scan(table(grow(1500, 9000) + '\n' + lines[1]), flows, LAN)
+    assert hosts == {'192.168.1.10': (4000, 500), '192.168.1.11': (0, 0)}
+
+
+def test_scan_expires_flows(table):
+    _, flows = conntrack.scan(table(TABLE), {}, LAN)
+
+    # The kernel dropped the UDP connection, it is forgotten
+    _, flows = conntrack.scan(table(TABLE.splitlines()[0]), flows, LAN)
+    assert len(flows) == 1
+
+    # When the same connection shows up again it counts from zero
+    hosts, flows = conntrack.scan(table(TABLE), flows, LAN)
+    assert hosts['192.168.1.11'] == (120, 60)
+
+
+def test_scan_reused_connection(table):
+    _, flows = conntrack.scan(table(TABLE), {}, LAN)
+
+    # The kernel reused the connection, it has less bytes than before
+    hosts, _ = conntrack.scan(table(grow(10, 20)), flows, LAN)
+    assert hosts == {'192.168.1.10': (20, 10)}
+
+
+def test_space_saving():
+    counter = conntrack.SpaceSaving(2)
+    counter.offer('a', 100, 0)
+    counter.offer('b', 50, 0)
+    counter.offer('a', 0, 10)
+
+    # c replaces b, the smallest, and starts at its count
+    counter.offer('c', 5, 5)
+    assert counter.top(3) == [('a', 100, 10, 0), ('c', 5, 5, 50)]
+    assert counter.top(1) == [('a', 100, 10, 0)]
+
+
+def test_scan_skips_bad_lines(table):
+    bad = [
+        'ipv4     2 tcp      6 30 src=fe80::zz dst=1.1.1.1 sport=1 dport=2 bytes=10 src=1.1.1.1 dst=x sport=2 dport=1 bytes=20',
+        'ipv4     2 tcp      6 30 src=192.168.1.13 dst=1.1.1.1 sport=1 dport=2 bytes=ten src=1.1.1.1 bytes=20',
+        'src=192.168.1.14',
+        '',
+    ]
+    hosts, flows = conntrack.scan(table('\n'.join(bad) + '\n' + TABLE), {})
+    assert hosts == {'192.168.1.10': (5000, 1000), '192.168.1.11': (120, 60), '203.0.113.5': (90, 70)}
+    assert len(flows) == 3
+
+    hosts, _ = conntrack.scan(table('\n'.join(bad) + '\n' + TABLE), {}, LAN)
+    assert hosts == {'192.168.1.10': (5000, 1000), '192.168.1.11': (120, 60)}
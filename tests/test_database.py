@@ -0,0 +1,47 @@
+from ha_lib import database
+
+
+def read(start, end, resolution):
+    return database.worker.submit(database.read_range, start, end, resolution, None).result()
+
+
+def test_tiers_after_compaction(stored):
+    oldest = [database.worker.submit(database.first_timestamp, tier).result()
+              for tier in [database.RAW] + database.TIERS]
+
+    # Every tier only keeps its retention, the days are kept forever
+    # The segment log deletes a whole day at once
+    assert oldest[0] >= stored - 3 * 86400 - 3600
+    assert oldest[1] >= stored - 7 * 86400 - 3600
+    assert oldest[3] <= stored - 29 * 86400
+
+
+def test_range_within_retention(stored):
+    rows = read(stored - 86400, stored, 60)
+    assert len(rows) == 288
+    assert all(b[0] - a[0] == 300 for a, b in zip(rows, rows[1:]))
+
+
+def test_range_past_minute_retention(stored):
+    # The minutes are only kept for 7 days, the older part comes from the hours and days
+    rows = read(stored - 30 * 86400, stored, 1296)
+    timestamps = [row[0] for row in rows]
+    assert timestamps == sorted(timestamps)
+    assert timestamps[0] <= stored - 29 * 86400
+    assert max(b - a for a, b in zip(timestamps, timestamps[1:])) <= 86400
+    assert max(timestamps) >= stored - 300
+
+    # The hours are used as far back as they go, not the days
+    hours = [timestamp for timestamp in timestamps if stored - 20 * 86400 < timestamp < stored - 10 * 86400]
+    assert len(hours) >= 10 * 24 - 1
+
+
+def test_range_past_raw_retention(stored):
+    # Even a range that asks for every measurement gets the minutes of the days the raw ones are gone
+    rows = read(stored - 4 * 86400, stored - 3 * 86400, 1)
+    assert len(rows) == 288
+
+
+def test_range_with_coarse_resolution(stored):
+    rows = read(stored - 30 * 86400, stored, 86400)
+    assert rows[0][0] <= stored - 29 * 86400
@@ -0,0 +1,90 @@
+import pytest
+from ha_lib import interface
+
+# Contents of /proc/net/dev with a wrapped interface name and one that isn't read
+PROC_NET_DEV = b'''Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:   12345      10    0    0    0     0          0         0    12345      10    0    0    0     0       0          0
+  eth0:1234567890 1000    0    0    0     0          0         0 987654321    900    0    0    0     0       0          0
+wlan0: 5 1 0 0 0 0 0 0 7 1 0 0 0 0 0 0
+'''
+
+
+@pytest.fixture
+def root(tmp_path):
+    """Directory that looks like the root of a filesystem with /proc/net/dev"""
+    (tmp_path / 'proc' / 'net').mkdir(parents=True)
+    (tmp_path / 'proc' / 'net' / 'dev').write_bytes(PROC_NET_DEV)
+    return tmp_path
+
+
+def write_sysfs(root, name, rx, tx):
+    statistics = root / 'sys' / 'class' / 'net' / name / 'statistics'
+    statistics.mkdir(parents=True, exist_ok=True)
+    (statistics / 'rx_bytes').write_text(f'{rx}\n')
+    (statistics / 'tx_bytes').write_text(f'{tx}\n')
+
+
+def test_parse_procfs():
+    values = interface.parse_procfs(PROC_NET_DEV, ['eth0', 'wlan0'])
+    assert values == {'eth0': (1234567890, 987654321), 'wlan0': (5, 7)}
+
+
+def test_parse_procfs_skips_missing_interfaces():
+    assert interface.parse_procfs(PROC_NET_DEV, ['ppp0']) == {}
+
+
+def test_parse_procfs_skips_header():
+    # The names in the header look like interfaces as well
+    assert interface.parse_procfs(PROC_NET_DEV, ['Inter-|   Receive', 'face']) == {}
+
+
+@pytest.mark.parametrize('last, new, delta', [
+    (0, 0, 0),
+    (100, 250, 150),
+    # A 32 bit counter wrapped around
+    (2 ** 32 - 100, 50, 150),
+    # The interface was made again and its counter started at zero
+    (2 ** 31 - 1000, 500, 500),
+    (5 * 2 ** 32, 1000, 1000),
+    # A 64 bit counter doesn't wrap
+    (2 ** 40, 2 ** 40 + 1, 1),
+])
+def test_counter_delta(last, new, delta):
+    assert interface.counter_delta(last, new) == delta
+
+
+def test_reader_procfs(root):
+    reader = interface.CounterReader(['eth0', 'lo'], root=str(root))
+    try:
+        assert reader.source == 'procfs'
+        assert reader.read() == {'eth0': (1234567890, 987654321), 'lo': (12345, 12345)}
+
+        # The file is read again on every measurement
+        (root / 'proc' / 'net' / 'dev').write_bytes(PROC_NET_DEV.replace(b'12345 ', b'22345 '))
+        assert reader.read()['lo'] == (22345, 22345)
+    finally:
+        reader.close()
+
+
+def test_reader_keeps_last_values(root):
+    reader = interface.CounterReader(['eth0'], root=str(root))
+    try:
+        (root / 'proc' / 'net' / 'dev').write_bytes(PROC_NET_DEV.replace(b'eth0', b'eth1'))
+        assert reader.read() == {'eth0': (1234567890, 987654321)}
+        with pytest.raises(ValueError):
+            reader.read(strict=True)
+    finally:
+        reader.close()
+
+
+def test_reader_sysfs(tmp_path):
+    write_sysfs(tmp_path, 'eth0', 10, 20)
+    reader = interface.CounterReader(['eth0'], root=str(tmp_path))
+    try:
+        assert reader.source == 'sysfs'
+        assert reader.read() == {'eth0': (10, 20)}
+        write_sysfs(tmp_path, 'eth0', 11, 22)
+        assert reader.read() == {'eth0': (11, 22)}
+    finally:
+        reader.close()
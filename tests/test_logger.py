@@ -0,0 +1,41 @@
+import io
+import time
+import threading
+from ha_lib import logger
+
+
+class Blocked(io.StringIO):
+    """Terminal that doesn't take any output until it is released"""
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+
+    def write(self, text):
+        self.released.wait()
+        return super().write(text)
+
+
+def test_full_queue_never_waits(monkeypatch):
+    terminal = Blocked()
+    monkeypatch.setattr(logger.sys, 'stdout', terminal)
+    monkeypatch.setattr(logger, 'dropped', 0)
+    monkeypatch.setattr(logger, 'dropped_total', 0)
+    monkeypatch.setattr(logger, 'level', 4)
+    monkeypatch.setattr(logger, 'enabled', True)
+    monkeypatch.setattr(logger, 'file', '')
+    logger.start(2)
+    try:
+        # The writer hangs on the first message, the next two fill the queue
+        start = time.monotonic()
+        for i in range(10):
+            logger.err(f'error {i}')
+        assert time.monotonic() - start < 0.5
+        assert logger.dropped_total >= 7
+    finally:
+        terminal.released.set()
+        logger.stop()
+
+    output = terminal.getvalue()
+    assert 'error 0' in output
+    assert f'{logger.dropped_total} messages dropped because logging is too slow' in output
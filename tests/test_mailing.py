@@ -0,0 +1,104 @@
+import pytest
+from ha_lib import mailing
+
+DOCUMENT = '<html><head><title>Usage</title></head><body class="mail"><p>{user} used {tt_int}{tt_unit}</p></body></html>'
+FRAGMENT = '<p>{user} used {tt_int}{tt_unit}</p>'
+
+
+class Server:
+    """Smtp session that keeps the E-Mails instead of sending them"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, sender, receiver, email):
+        self.sent.append(email)
+
+    def quit(self):
+        self.closed = True
+
+
+def values(user, total):
+    return {'user': user, 'tt_int': total, 'tt_unit': 'GB'}
+
+
+@pytest.fixture
+def server(settings, tmp_path, monkeypatch):
+    """Use a template in a temporary file and a session that keeps the E-Mails"""
+    template = tmp_path / 'email.html'
+    template.write_text(DOCUMENT)
+    settings({'EMAIL': {'File': str(template), 'Login': 'False'}})
+    monkeypatch.setattr(mailing, 'template', None)
+    monkeypatch.setattr(mailing, 'template_mtime', None)
+    server = Server()
+    monkeypatch.setattr(mailing, 'connect_to_smtp', lambda: server)
+    return server
+
+
+def test_merge_single():
+    assert mailing.merge(['<p>a</p>']) == '<p>a</p>'
+
+
+def test_merge_fragments():
+    assert mailing.merge(['<p>a</p>', '<p>b</p>']) == '<div><p>a</p></div><hr><div><p>b</p></div>'
+
+
+def test_merge_documents():
+    old = DOCUMENT.format(**values('old', 1))
+    new = DOCUMENT.format(**values('new', 2))
+    merged = mailing.merge([old, new])
+
+    # One document with the body of both E-Mails in it, the oldest first
+    assert merged.count('<html>') == 1 and merged.count('<body') == 1
+    assert merged.startswith('<html><head><title>Usage</title></head><body class="mail"><div><p>old used 1GB</p></div>')
+    assert merged.endswith('<hr><div><p>new used 2GB</p></div></body></html>')
+
+
+def test_batch(server):
+    mailer = mailing.Mailer(idle_timeout=60, batch_delay=0.05)
+    futures = [mailer.submit(values(user, total)) for user, total in (('a', 1), ('b', 2), ('c', 3))]
+
+    # The sender of b stopped waiting before the mailer picked it up
+    assert futures[1].cancel()
+    mailer.start()
+    mailer.stop()
+
+    assert futures[0].result() is True and futures[2].result() is True
+    assert futures[1].cancelled()
+    assert not mailer.is_alive() and server.closed
+    assert len(server.sent) == 1
+    email = server.sent[0]
+    assert 'a used 1GB' in email and 'c used 3GB' in email and 'b used' not in email
+    assert email.count('<html>') == 1
+
+
+def test_batch_all_cancelled(server):
+    mailer = mailing.Mailer(idle_timeout=60, batch_delay=0.05)
+    mailer.submit(values('a', 1)).cancel()
+    mailer.start()
+    mailer.stop()
+    assert server.sent == []
+
+
+def test_separate_batches(server):
+    mailer = mailing.Mailer(idle_timeout=60, batch_delay=0.05)
+    mailer.start()
+    assert mailer.submit(values('a', 1)).result(timeout=5)
+    assert mailer.submit(values('b', 2)).result(timeout=5)
+    mailer.stop()
+
+    # The session is kept open between the batches
+    assert len(server.sent) == 2 and 'a used' in server.sent[0] and 'b used' in server.sent[1]
+
+
+def test_invalid_template(server, tmp_path):
+    (tmp_path / 'email.html').write_text('<p>{unknown}</p>')
+    mailer = mailing.Mailer(idle_timeout=60, batch_delay=0.05)
+    future = mailer.submit(values('a', 1))
+    mailer.start()
+    mailer.stop()
+
+    # The mailer keeps running and the E-Mail is reported as not send
+    assert future.result() is False
+    assert server.sent == []
@@ -0,0 +1,15 @@
+import re
+from ha_lib import metrics, stats
+
+
+def test_rate_units(settings, monkeypatch):
+    settings()
+    stats.enable()
+    metrics.enable()
+    monkeypatch.setattr(metrics, 'exposition', None)
+    text = metrics.render()
+
+    # Rates are named after their unit like Prometheus does
+    assert 'gateway_rate_bytes_per_second{interface="all",direction="received"}' in text
+    assert '# TYPE gateway_average_rate_bytes_per_second gauge' in text
+    assert not re.search(r'^gateway_(average_)?rate_bytes[{ ]', text, re.MULTILINE)
@@ -0,0 +1,30 @@
+import asyncio
+from ha_lib import processor, logger
+
+
+def fail():
+    raise ValueError('Unknown MQTT backend "nothing"')
+
+
+def test_enable_step_logs_failure(settings, monkeypatch):
+    settings()
+    errors, loops = [], []
+    monkeypatch.setattr(logger, 'err', errors.append)
+
+    async def loop():
+        loops.append(True)
+    asyncio.run(processor.enable_step('MQTT', fail, loop))
+
+    # The failure is logged right away and the loop of the module isn't started
+    assert errors == ['Enabling MQTT failed: Unknown MQTT backend "nothing"']
+    assert loops == []
+
+
+def test_enable_step_starts_loop(settings):
+    settings()
+    loops = []
+
+    async def loop():
+        loops.append(True)
+    asyncio.run(processor.enable_step('MQTT', lambda: None, loop))
+    assert loops == [True]
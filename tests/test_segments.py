@@ -0,0 +1,60 @@
+import random
+import pytest
+from ha_lib import segments
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    """Log of two interfaces with a record every 7 seconds, spread over sealed, closed and active segments"""
+    monkeypatch.setattr(segments, 'MARK', 16)
+    made = segments.SegmentLog(str(tmp_path / 'data.sqlite.segments'), segment_size=2000)
+    made.open()
+    generator = random.Random(1)
+    totals = {'eth0': [0, 0], 'wlan0': [0, 0]}
+    rows = []
+    for timestamp in range(1000, 9000, 7):
+        for name, values in totals.items():
+            values[0] += generator.randrange(10 ** 6)
+            values[1] += generator.randrange(10 ** 4)
+            rows.append((timestamp, name, values[0], values[1], 0))
+    made.append(rows)
+    made.rotate()
+    made.seal()
+    rows.append((9000, 'eth0', *totals['eth0'], 0))
+    made.append(rows[-1:])
+    yield made, rows
+    made.close()
+
+
+def test_layout(log):
+    made, _ = log
+    assert any(segment.sealed for segment in made.closed)
+    assert any(not segment.sealed for segment in made.closed)
+    assert made.active is not None
+
+
+@pytest.mark.parametrize('start, end', [(0, 2 ** 62), (1000, 1001), (1001, 1008), (2345, 6789), (5000, 9000)])
+def test_read(log, start, end):
+    made, rows = log
+    expected = [row[:4] for row in rows if start <= row[0] < end]
+    assert made.read(start, end) == expected
+
+    # Reading again uses the marks that were saved by the first read
+    assert made.read(start, end) == expected
+
+
+@pytest.mark.parametrize('timestamp', [0, 1000, 1001, 1007, 4444, 8995, 8996, 9000])
+def test_next_timestamp(log, timestamp):
+    made, rows = log
+    assert made.next_timestamp(timestamp) == min(row[0] for row in rows if row[0] >= timestamp)
+
+
+def test_next_timestamp_after_end(log):
+    made, _ = log
+    assert made.next_timestamp(9001) is None
+
+
+def test_first(log):
+    made, rows = log
+    assert made.first(4445) == {name: (received, send) for timestamp, name, received, send, _ in rows
+                                if timestamp == 4451}
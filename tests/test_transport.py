@@ -0,0 +1,85 @@
+import pytest
+from ha_lib import transport
+
+
+class Info:
+    def __init__(self, mid, published=False):
+        self.mid = mid
+        self.rc = 0
+        self.published = published
+
+    def is_published(self):
+        return self.published
+
+
+class Client:
+    """Paho client that confirms messages on the moments the network thread of paho can"""
+
+    def __init__(self, owner, confirm):
+        self.owner = owner
+        self.confirm = confirm
+        self.mid = 0
+
+    def publish(self, topic, value, qos=0):
+        self.mid += 1
+        info = Info(self.mid)
+        if self.confirm == 'before':
+            # The server confirmed it before publish returned, paho runs on_publish before is_published is set
+            self.owner.handle_publish(self, None, self.mid)
+        elif self.confirm == 'published':
+            info.published = True
+        return info
+
+
+@pytest.fixture
+def mqtt():
+    pytest.importorskip('paho.mqtt.client')
+
+    def make(confirm, qos=1):
+        made = transport.MQTTTransport('localhost', qos=qos)
+        made.client = Client(made, confirm)
+        return made
+    return make
+
+
+def test_abstract():
+    with pytest.raises(TypeError):
+        transport.Transport()
+
+
+@pytest.mark.parametrize('confirm', ['before', 'published'])
+def test_confirmed_before_registered(mqtt, confirm):
+    made = mqtt(confirm)
+    for _ in range(10):
+        assert made.publish('feed', 1)
+    assert made.in_flight() == 0
+    assert not made.confirmed
+
+
+def test_confirmed_after(mqtt):
+    made = mqtt('later')
+    for _ in range(10):
+        made.publish('feed', 1)
+    assert made.in_flight() == 10
+    for mid in range(1, 11):
+        made.handle_publish(made.client, None, mid)
+    assert made.in_flight() == 0
+    assert not made.confirmed
+
+
+def test_qos_zero(mqtt):
+    made = mqtt('before', qos=0)
+    made.publish('feed', 1)
+    assert made.in_flight() == 0 and not made.confirmed
+
+
+def test_memory():
+    made = transport.MemoryTransport()
+    assert made.publish('feed', 1) and made.publish('feed', 2)
+    assert made.values == {'feed': 2} and made.published == 2
+
+
+def test_memory_not_in_config(settings):
+    # A transport that sends nothing can't be set by accident
+    with pytest.raises(ValueError):
+        settings({'MQTT': {'Enabled': 'True', 'Backend': 'memory'}})